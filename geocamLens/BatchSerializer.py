@@ -0,0 +1,165 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Load features for serialization in batches.  Searches return instances
+of the base feature model, and resolving each one to its concrete class
+(e.g. Photo) and then walking its author, folders and so on costs
+several queries per feature.  Here a batch of features is loaded with a
+fixed number of queries: one per concrete model, plus one per
+many-to-many or generic relation of that model, no matter how many
+features are in the batch.
+"""
+
+from django.apps import apps
+from django.db import models
+from django.contrib.contenttypes.fields import GenericRelation
+
+from geocamLens.models import FeatureFragment
+
+CONCRETE_MODELS_CACHE = {}
+
+
+def getConcreteModels(baseModel):
+    """
+    Returns @baseModel and its concrete subclasses, most derived first,
+    so each feature is loaded as the most specific model it belongs to.
+    """
+    if baseModel not in CONCRETE_MODELS_CACHE:
+        subclasses = [m for m in apps.get_models()
+                      if issubclass(m, baseModel)
+                      and not m._meta.abstract
+                      and not m._meta.proxy]
+        subclasses.sort(key=lambda m: len(m._meta.get_parent_list()),
+                        reverse=True)
+        CONCRETE_MODELS_CACHE[baseModel] = subclasses
+    return CONCRETE_MODELS_CACHE[baseModel]
+
+
+def getRootModel(model):
+    """
+    Returns the concrete model at the top of @model's inheritance
+    chain, which every feature in a mixed list of subclasses shares.
+    """
+    for parent in model._meta.get_parent_list():
+        if not parent._meta.get_parent_list():
+            return parent
+    return model
+
+
+def getRelatedFieldNames(model):
+    """
+    Returns (foreignKeyNames, multiValuedNames) for @model.  Foreign
+    keys are joined in with select_related, multi-valued relations are
+    loaded with prefetch_related.
+    """
+    foreignKeyNames = [f.name for f in model._meta.fields
+                       if isinstance(f, models.ForeignKey)
+                       and not f.rel.parent_link]
+    multiValuedNames = ([f.name for f in model._meta.many_to_many]
+                        + [f.name for f in model._meta.virtual_fields
+                           if isinstance(f, GenericRelation)])
+    return foreignKeyNames, multiValuedNames
+
+
+def getProjectionColumns(model, fields):
+    """
+    Returns the columns of @model needed to serialize only the
+    properties in @fields, or None if it needs the whole feature.
+    """
+    if fields is None or not hasattr(model, 'getProjectionColumns'):
+        return None
+    return model.getProjectionColumns(fields)
+
+
+def loadFeatures(baseModel, featureIds, fields=None):
+    """
+    Returns the features with ids @featureIds as instances of their
+    concrete models, with related objects loaded, in the order of
+    @featureIds.  If @fields is given, models that can serialize just
+    those properties are loaded with only the columns they need and no
+    related objects.
+    """
+    found = {}
+    remaining = set(featureIds)
+    for model in getConcreteModels(baseModel):
+        if not remaining:
+            break
+        # the base manager skips any per-row subclass resolution done by
+        # custom managers
+        query = model._base_manager.filter(pk__in=remaining)
+        columns = getProjectionColumns(model, fields)
+        if columns is not None:
+            query = query.only(*columns)
+        else:
+            foreignKeyNames, multiValuedNames = getRelatedFieldNames(model)
+            if foreignKeyNames:
+                query = query.select_related(*foreignKeyNames)
+            if multiValuedNames:
+                query = query.prefetch_related(*multiValuedNames)
+        for feature in query:
+            found[feature.pk] = feature
+        remaining.difference_update(found.iterkeys())
+    return [found[featureId] for featureId in featureIds
+            if featureId in found]
+
+
+def iterFeatureIdBatches(features, batchSize):
+    """
+    Yield (baseModel, featureIds) for @features in batches of at most
+    @batchSize.  @features is a queryset, in which case only its ids are
+    fetched, or a list of instances.
+    """
+    if hasattr(features, 'values_list'):
+        baseModel = features.model
+        featureIds = features.values_list('pk', flat=True).iterator()
+    else:
+        features = list(features)
+        if not features:
+            return
+        baseModel = getRootModel(features[0].__class__)
+        featureIds = iter([f.pk for f in features])
+
+    batch = []
+    for featureId in featureIds:
+        batch.append(featureId)
+        if len(batch) == batchSize:
+            yield baseModel, batch
+            batch = []
+    if batch:
+        yield baseModel, batch
+
+
+def iterFeatureBatches(features, batchSize, fields=None):
+    """
+    Yield the features in @features in batches of at most @batchSize,
+    each loaded by loadFeatures().
+    """
+    for baseModel, featureIds in iterFeatureIdBatches(features, batchSize):
+        yield loadFeatures(baseModel, featureIds, fields)
+
+
+def iterFragmentBatches(features, batchSize):
+    """
+    Yield the FeatureFragments for @features in batches of at most
+    @batchSize.  Fragments that are missing or out of date are rendered
+    from features loaded by loadFeatures() and stored for next time.
+    """
+    version = FeatureFragment.getCurrentVersion()
+    for baseModel, featureIds in iterFeatureIdBatches(features, batchSize):
+        fragments = dict(((fragment.featureId, fragment)
+                          for fragment in (FeatureFragment.objects
+                                           .filter(featureId__in=featureIds,
+                                                   version=version))))
+        missingIds = [featureId for featureId in featureIds
+                      if featureId not in fragments]
+        if missingIds:
+            for feature in loadFeatures(baseModel, missingIds):
+                fragment = FeatureFragment.updateForFeature(feature, version)
+                if fragment is not None:
+                    fragments[feature.pk] = fragment
+        yield [fragments[featureId] for featureId in featureIds
+               if featureId in fragments]
@@ -0,0 +1,108 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Compact columnar encoding of point features for large map layers,
+served by features.json?format=columns.  Instead of one GeoJSON object
+per feature, each attribute is a packed little-endian array that a
+browser can wrap in a typed array without parsing.  The layout is:
+
+  4 bytes   MAGIC
+  uint32    number of features
+  uint32    length of the header in bytes
+  header    UTF-8 JSON, space padded so the data section starts at a
+            multiple of 8 bytes
+  data      the columns, at the offsets (relative to the start of the
+            data section) and with the types listed in the header
+
+The header also holds the icon names that the icon column indexes into
+and any extra FeatureCollection members (e.g. the 'since' token).
+Missing coordinates and timestamps are NaN, a missing icon is
+NULL_ICON.  A response that doesn't start with MAGIC is a JSON error.
+"""
+
+import sys
+import array
+import struct
+import calendar
+
+from geocamUtil import anyjson as json
+
+MAGIC = 'GLC1'
+
+NULL_ICON = 0xffff
+
+NAN = float('nan')
+
+# (name, array typecode, typed array name).  8-byte columns first so
+# every column is aligned for its type.
+COLUMNS = (('latitude', 'd', 'float64'),
+           ('longitude', 'd', 'float64'),
+           # ms since the epoch, UTC
+           ('timestamp', 'd', 'float64'),
+           ('id', 'I', 'uint32'),
+           ('icon', 'H', 'uint16'))
+
+
+def getEpochMs(timestamp):
+    if timestamp is None:
+        return NAN
+    return (calendar.timegm(timestamp.utctimetuple()) * 1000.0
+            + timestamp.microsecond / 1000.0)
+
+
+def encodeColumns(rows, extras=None):
+    """
+    Encode @rows, an iterable of (id, latitude, longitude, timestamp,
+    iconName) tuples.  Returns the encoding as a list of byte strings.
+    """
+    arrays = dict([(name, array.array(typecode))
+                   for name, typecode, _typeName in COLUMNS])
+    icons = []
+    iconLookup = {}
+    for featureId, lat, lon, timestamp, icon in rows:
+        arrays['id'].append(featureId)
+        arrays['latitude'].append(NAN if lat is None else lat)
+        arrays['longitude'].append(NAN if lon is None else lon)
+        arrays['timestamp'].append(getEpochMs(timestamp))
+        if icon is None:
+            arrays['icon'].append(NULL_ICON)
+        else:
+            iconIndex = iconLookup.get(icon)
+            if iconIndex is None:
+                iconIndex = len(icons)
+                iconLookup[icon] = iconIndex
+                icons.append(icon)
+            arrays['icon'].append(iconIndex)
+
+    if sys.byteorder == 'big':
+        for a in arrays.itervalues():
+            a.byteswap()
+
+    count = len(arrays['id'])
+    columns = []
+    offset = 0
+    for name, _typecode, typeName in COLUMNS:
+        numBytes = arrays[name].itemsize * count
+        columns.append(dict(name=name, type=typeName, offset=offset, length=numBytes))
+        # keep the next column aligned
+        offset += (numBytes + 7) // 8 * 8
+
+    header = json.dumps(dict(count=count,
+                             icons=icons,
+                             columns=columns,
+                             extras=extras or {}),
+                        separators=(',', ':'))
+    if isinstance(header, unicode):
+        header = header.encode('utf-8')
+    prefixLength = len(MAGIC) + 8
+    header += ' ' * (-(prefixLength + len(header)) % 8)
+
+    chunks = [MAGIC + struct.pack('<II', count, len(header)), header]
+    for column in columns:
+        data = arrays[column['name']].tostring()
+        chunks.append(data + '\0' * (-len(data) % 8))
+    return chunks
@@ -0,0 +1,134 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Response compression negotiated with Accept-Encoding, done in the views
+so that streaming responses are compressed as they're generated and
+cached responses can be stored already compressed.  Brotli is used when
+the optional brotli module is installed and the client accepts it,
+otherwise gzip.
+"""
+
+import zlib
+
+from django.utils.cache import patch_vary_headers
+
+from django.conf import settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def getSupportedEncodings():
+    if brotli is not None and hasattr(brotli, 'Compressor'):
+        return ('br', 'gzip')
+    else:
+        return ('gzip',)
+
+
+def parseAcceptEncoding(header):
+    """
+    Returns {coding: qvalue} for an Accept-Encoding header.
+    """
+    result = {}
+    for part in header.split(','):
+        params = part.strip().split(';')
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            name, _sep, val = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(val)
+                except ValueError:
+                    q = 0.0
+        result[coding] = q
+    return result
+
+
+def getResponseEncoding(request):
+    """
+    Returns the content coding to use for the response to @request, or
+    None to send it uncompressed.
+    """
+    if not settings.GEOCAM_LENS_COMPRESS_RESPONSES:
+        return None
+    accepted = parseAcceptEncoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    for encoding in getSupportedEncodings():
+        # '*' covers codings the client didn't mention
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def getCompressor(encoding):
+    if encoding == 'br':
+        return brotli.Compressor(quality=settings.GEOCAM_LENS_BROTLI_QUALITY)
+    else:
+        return zlib.compressobj(settings.GEOCAM_LENS_GZIP_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+
+
+def iterCompressed(chunks, encoding):
+    """
+    Compress @chunks with @encoding as they're generated.  Each chunk is
+    flushed, so the client can start on the response before it's done.
+    """
+    compressor = getCompressor(encoding)
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        if not chunk:
+            continue
+        if encoding == 'br':
+            out = compressor.process(chunk) + compressor.flush()
+        else:
+            out = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if out:
+            yield out
+    if encoding == 'br':
+        yield compressor.finish()
+    else:
+        yield compressor.flush()
+
+
+def compress(content, encoding):
+    return ''.join(iterCompressed([content], encoding))
+
+
+def setEncodingHeaders(response, encoding):
+    # vary even when uncompressed, so caches don't hand the plain
+    # version to clients that asked for a compressed one
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if encoding:
+        response['Content-Encoding'] = encoding
+        if response.has_header('Content-Length'):
+            del response['Content-Length']
+    return response
+
+
+def compressResponse(request, response):
+    """
+    Compress @response, streaming or not, if the client accepts it.
+    For content that isn't cached, so it's compressed on each request.
+    """
+    if response.has_header('Content-Encoding'):
+        return response
+    encoding = getResponseEncoding(request)
+    if encoding:
+        if response.streaming:
+            response.streaming_content = iterCompressed(response.streaming_content, encoding)
+        else:
+            response.content = compress(response.content, encoding)
+    setEncodingHeaders(response, encoding)
+    if encoding and not response.streaming:
+        response['Content-Length'] = str(len(response.content))
+    return response
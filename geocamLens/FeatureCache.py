@@ -0,0 +1,109 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Cache of serialized feed responses, keyed by the normalized request
+parameters and a data generation that changes whenever a feature is
+saved or deleted.
+"""
+
+import hashlib
+
+from django.core.cache import caches
+
+from geocamLens.models import FeatureChange
+
+from django.conf import settings
+
+# pylint: disable=C1001
+
+# request parameters that affect the feed contents
+KEY_PARAMS = ('q', 'n', 'cursor', 'bbox', 'since', 'fields', 'debug')
+
+
+class FeatureCache(object):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+
+    def isEnabled(self):
+        return settings.GEOCAM_LENS_FEATURE_CACHE is not None
+
+    def getCache(self):
+        return caches[settings.GEOCAM_LENS_FEATURE_CACHE]
+
+    def getGeneration(self):
+        """
+        The generation is the latest FeatureChange sequence number,
+        which the signal handlers advance on every save or delete of a
+        feature.  It's shared by every process through the db, whichever
+        cache backend is in use.
+        """
+        return str(FeatureChange.getLatestSeq())
+
+    def getKey(self, kind, request, encoding=None):
+        """
+        Key for the @kind of response to @request, stored compressed
+        with content coding @encoding (None for uncompressed).
+        """
+        params = []
+        for name in KEY_PARAMS:
+            val = request.GET.get(name)
+            if name == 'q' and val is None:
+                val = request.REQUEST.get('q')
+            if val is not None:
+                # extra whitespace doesn't change a search
+                params.append((name, ' '.join(val.split())))
+        digest = hashlib.md5(repr(params)).hexdigest()
+        return 'geocamLens.%s.%s.%s.%s' % (kind, encoding or 'identity',
+                                           self.getGeneration(), digest)
+
+    def get(self, key):
+        content = self.getCache().get(key)
+        if content is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return content
+
+    def set(self, key, content):
+        self.getCache().set(key, content,
+                            settings.GEOCAM_LENS_FEATURE_CACHE_SECONDS)
+
+    def iterAndStore(self, key, chunks):
+        """
+        Pass @chunks through while collecting them, then store the
+        whole response under @key.  Responses over the size limit are
+        passed through without being cached.
+        """
+        maxBytes = settings.GEOCAM_LENS_FEATURE_CACHE_MAX_BYTES
+        collected = []
+        numBytes = 0
+        for chunk in chunks:
+            if collected is not None:
+                collected.append(chunk)
+                numBytes += len(chunk)
+                if numBytes > maxBytes:
+                    collected = None
+                    self.uncacheable += 1
+            yield chunk
+        if collected is not None:
+            self.set(key, ''.join(collected))
+
+    def getStats(self):
+        total = self.hits + self.misses
+        if total:
+            hitRate = float(self.hits) / total
+        else:
+            hitRate = None
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    hitRate=hitRate,
+                    uncacheable=self.uncacheable,
+                    generation=self.getGeneration())
+
+featureCacheSingleton = FeatureCache()
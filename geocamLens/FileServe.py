@@ -0,0 +1,149 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Streaming file responses with conditional GET, byte ranges and optional
+offload to the front-end server via X-Sendfile or X-Accel-Redirect.
+"""
+
+import os
+import re
+import stat
+
+from django.http import HttpResponse, StreamingHttpResponse, HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe
+
+from django.conf import settings
+
+BLOCK_SIZE = 64 * 1024
+
+
+def iterFileRange(path, start, length, blockSize=BLOCK_SIZE):
+    f = open(path, 'rb')
+    try:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            block = f.read(min(blockSize, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+    finally:
+        f.close()
+
+
+def getETag(st):
+    return '"%x-%x-%x"' % (st[stat.ST_INO], st[stat.ST_MTIME], st[stat.ST_SIZE])
+
+
+def isNotModified(request, etag, mtime):
+    ifNoneMatch = request.META.get('HTTP_IF_NONE_MATCH')
+    if ifNoneMatch is not None:
+        tags = [t.strip() for t in ifNoneMatch.split(',')]
+        return etag in tags or '*' in tags
+    ifModifiedSince = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if ifModifiedSince is not None:
+        sinceTime = parse_http_date_safe(ifModifiedSince.split(';')[0])
+        return sinceTime is not None and int(mtime) <= sinceTime
+    return False
+
+
+def parseRange(rangeHeader, size):
+    """
+    Parse a Range header into an inclusive (first, last) byte pair.
+    Returns None if the header should be ignored (missing, malformed or
+    multiple ranges, in which case the full file is sent) and raises
+    ValueError if the range can't be satisfied.
+    """
+    if not rangeHeader:
+        return None
+    match = re.search(r'^bytes=(\d*)-(\d*)$', rangeHeader.strip())
+    if not match:
+        return None
+    firstStr, lastStr = match.groups()
+    if firstStr:
+        first = int(firstStr)
+        if lastStr:
+            last = min(int(lastStr), size - 1)
+        else:
+            last = size - 1
+        if first > last:
+            raise ValueError('unsatisfiable range')
+    elif lastStr:
+        # suffix range, the last N bytes
+        suffixLength = int(lastStr)
+        if suffixLength == 0:
+            raise ValueError('unsatisfiable range')
+        first = max(0, size - suffixLength)
+        last = size - 1
+    else:
+        return None
+    return (first, last)
+
+
+def getSendfileResponse(path, contentType):
+    mode = settings.GEOCAM_LENS_SENDFILE_MODE
+    response = HttpResponse(content_type=contentType)
+    if mode == 'X-Sendfile':
+        response['X-Sendfile'] = path
+    elif mode == 'X-Accel-Redirect':
+        root = settings.GEOCAM_LENS_SENDFILE_ROOT or settings.DATA_DIR
+        relPath = os.path.relpath(path, root)
+        response['X-Accel-Redirect'] = (settings.GEOCAM_LENS_ACCEL_REDIRECT_PREFIX.rstrip('/')
+                                        + '/' + relPath)
+    else:
+        raise ValueError('unknown GEOCAM_LENS_SENDFILE_MODE %s' % repr(mode))
+    return response
+
+
+def serveFile(request, path, contentType):
+    """
+    Return a response that sends the file at @path.  The file is never
+    read into memory all at once.
+    """
+    st = os.stat(path)
+    size = st[stat.ST_SIZE]
+    mtime = st[stat.ST_MTIME]
+    etag = getETag(st)
+
+    if isNotModified(request, etag, mtime):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(mtime)
+        return response
+
+    if settings.GEOCAM_LENS_SENDFILE_MODE:
+        # the front-end server handles ranges and streaming
+        response = getSendfileResponse(path, contentType)
+    else:
+        byteRange = None
+        ifRange = request.META.get('HTTP_IF_RANGE')
+        if ifRange is None or ifRange == etag:
+            try:
+                byteRange = parseRange(request.META.get('HTTP_RANGE'), size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */%d' % size
+                return response
+
+        if byteRange is None:
+            response = StreamingHttpResponse(iterFileRange(path, 0, size),
+                                             content_type=contentType)
+            response['Content-Length'] = str(size)
+        else:
+            first, last = byteRange
+            length = last - first + 1
+            response = StreamingHttpResponse(iterFileRange(path, first, length),
+                                             content_type=contentType,
+                                             status=206)
+            response['Content-Length'] = str(length)
+            response['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+        response['Accept-Ranges'] = 'bytes'
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(mtime)
+    return response
@@ -0,0 +1,107 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Helpers for getting incoming image files into storage without extra
+copies and reading their metadata in one pass.  Uploads are written to
+a staging dir on the same filesystem as DATA_DIR so they can later be
+renamed into place.
+"""
+
+import os
+import errno
+import shutil
+import tempfile
+
+import PIL.Image
+
+from geocamUtil.FileUtil import mkdirP
+from geocamUtil.Xmp import Xmp
+
+from django.conf import settings
+
+STAGING_PREFIX = 'upload-'
+PARTIAL_PREFIX = '.tmp-'
+
+
+def getStagingDir():
+    stagingDir = (settings.GEOCAM_LENS_UPLOAD_STAGING_DIR
+                  or os.path.join(settings.DATA_DIR, 'geocamLens', 'incoming'))
+    if not os.path.exists(stagingDir):
+        mkdirP(stagingDir)
+    return stagingDir
+
+
+def storeUpload(incoming, suffix='.jpg'):
+    """
+    Write the chunks of uploaded file @incoming to a new file in the
+    staging dir and return its path.  A partially written file is
+    removed if the upload fails.
+    """
+    fd, storePath = tempfile.mkstemp(suffix, STAGING_PREFIX, getStagingDir())
+    try:
+        storeFile = os.fdopen(fd, 'wb')
+        try:
+            for chunk in incoming.chunks():
+                storeFile.write(chunk)
+        finally:
+            storeFile.close()
+    except:
+        os.unlink(storePath)
+        raise
+    return storePath
+
+
+def copyIntoPlace(srcPath, dstPath):
+    """
+    Copy @srcPath to @dstPath via a temp file in the destination dir, so
+    that a crash never leaves a truncated file at @dstPath.
+    """
+    dstDir = os.path.dirname(dstPath)
+    fd, tempPath = tempfile.mkstemp('', PARTIAL_PREFIX, dstDir)
+    os.close(fd)
+    try:
+        shutil.copyfile(srcPath, tempPath)
+        os.rename(tempPath, dstPath)
+    except:
+        if os.path.exists(tempPath):
+            os.unlink(tempPath)
+        raise
+
+
+def moveIntoPlace(srcPath, dstPath):
+    """
+    Move @srcPath to @dstPath.  This is an atomic rename when both are on
+    the same filesystem, otherwise a crash-safe copy followed by removal
+    of the source.
+    """
+    try:
+        os.rename(srcPath, dstPath)
+    except OSError, e:
+        if e.errno != errno.EXDEV:
+            raise
+        copyIntoPlace(srcPath, dstPath)
+        os.unlink(srcPath)
+
+
+def readImageInfo(path):
+    """
+    Read everything the import path needs to know about the image at
+    @path: its XMP/EXIF values, pixel size and format.  PIL only parses
+    the header here, the pixel data is not decoded.  Pass the result to
+    Image.readImportVals(imageInfo=...) so later stages don't have to
+    open the file again.
+    """
+    im = PIL.Image.open(path)
+    widthPixels, heightPixels = im.size
+    imageFormat = im.format
+    del im
+
+    return dict(path=path,
+                xmpVals=Xmp(path).getDict(),
+                widthPixels=widthPixels,
+                heightPixels=heightPixels,
+                format=imageFormat)
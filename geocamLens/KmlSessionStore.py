@@ -0,0 +1,204 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Storage for Google Earth session state.  With the 'db' store every poll
+reads and writes a GoogleEarthSession row.  With the 'cache' store the
+sessions live in a Django cache.  New sessions are written to the db
+right away, so every server process can find them, and later changes
+(the poll time and change sequence) are written back in batches.  Use
+a cache shared between processes, such as memcached, when running more
+than one server process, otherwise a process may serve a poll from a
+copy that's behind and send the client some changes again, and the
+sweep can't see polls cached by other processes.  Pending changes are
+written back at the end of any request once they're due, and before
+expired sessions are swept.
+"""
+
+import sys
+import time
+import datetime
+import hashlib
+
+from django.core.cache import caches
+from django.core.signals import request_finished
+from django.db import transaction
+
+from geocamLens.models import GoogleEarthSession
+
+from django.conf import settings
+
+# pylint: disable=C1001
+
+# sessions checked against the cache per query when sweeping; keeps IN
+# lists under sqlite's limit on query parameters
+SWEEP_BATCH_SIZE = 500
+
+
+class KmlSessionStore(object):
+    def __init__(self):
+        self.lookups = 0
+        self.hits = 0
+        self.creates = 0
+        self.writes = 0
+        self.expired = 0
+        # sessions saved to the cache but not yet written back
+        self.dirty = {}
+        self.lastFlush = time.time()
+        self.lastSweep = 0
+
+    def useCache(self):
+        return settings.GEOCAM_LENS_KML_SESSION_STORE == 'cache'
+
+    def getCache(self):
+        return caches[settings.GEOCAM_LENS_KML_SESSION_CACHE]
+
+    def getKey(self, sessionId):
+        # session ids contain the search query, which isn't a safe key
+        return 'geocamLens.kmlSession.%s' % hashlib.md5(sessionId.encode('utf-8')).hexdigest()
+
+    def get(self, sessionId):
+        """
+        Returns the session, or None if it doesn't exist or has expired.
+        """
+        self.lookups += 1
+        if self.useCache():
+            session = self.dirty.get(sessionId)
+            if session is None:
+                session = self.getCache().get(self.getKey(sessionId))
+            if session is not None:
+                self.hits += 1
+                return session
+
+        session = GoogleEarthSession.objects.filter(sessionId=sessionId).first()
+        if session is not None and self.useCache():
+            self.getCache().set(self.getKey(sessionId), session,
+                                settings.GEOCAM_LENS_KML_SESSION_TTL_SECONDS)
+        return session
+
+    def getOrCreate(self, sessionId, utime):
+        session = self.get(sessionId)
+        if session is None:
+            self.creates += 1
+            session = GoogleEarthSession(sessionId=sessionId, utime=utime)
+        return session
+
+    def save(self, session):
+        if not self.useCache():
+            session.save()
+            self.writes += 1
+            self.sweepIfDue()
+            return
+
+        if session.pk is None:
+            # written through, so other processes can find the session
+            # before the next flush
+            session.save()
+            self.writes += 1
+            self.getCache().set(self.getKey(session.sessionId), session,
+                                settings.GEOCAM_LENS_KML_SESSION_TTL_SECONDS)
+            return
+
+        self.getCache().set(self.getKey(session.sessionId), session,
+                            settings.GEOCAM_LENS_KML_SESSION_TTL_SECONDS)
+        self.dirty[session.sessionId] = session
+        if len(self.dirty) >= settings.GEOCAM_LENS_KML_SESSION_WRITE_BACK_BATCH:
+            self.flush()
+        else:
+            self.flushIfDue()
+
+    def flushIfDue(self):
+        if (self.dirty
+                and time.time() - self.lastFlush >= settings.GEOCAM_LENS_KML_SESSION_WRITE_BACK_SECONDS):
+            self.flush()
+
+    def flush(self):
+        """
+        Write back the sessions changed since the last flush in one
+        transaction.  Sessions are already in the db, so a change lost
+        before it's written back only rewinds the session to its last
+        written change sequence, and the client gets those changes
+        again.
+        """
+        self.writeBack()
+        self.sweepIfDue()
+
+    def writeBack(self):
+        with transaction.atomic():
+            for session in self.dirty.itervalues():
+                # another process may have written the row already
+                numUpdated = (GoogleEarthSession.objects
+                              .filter(sessionId=session.sessionId)
+                              .update(utime=session.utime,
+                                      query=session.query,
+                                      extras=session.extras))
+                if not numUpdated:
+                    session.save()
+        self.writes += len(self.dirty)
+        self.dirty = {}
+        self.lastFlush = time.time()
+
+    def sweepIfDue(self):
+        if time.time() - self.lastSweep >= settings.GEOCAM_LENS_KML_SESSION_SWEEP_SECONDS:
+            self.expireSessions()
+
+    def expireSessions(self, ttlSeconds=None):
+        """
+        Delete sessions that haven't polled in @ttlSeconds.  Cached
+        sessions expire from the cache on their own.  With the 'cache'
+        store the db poll time may lag behind, so a session is only
+        deleted if its cached copy is missing or also out of date.
+        """
+        if ttlSeconds is None:
+            ttlSeconds = settings.GEOCAM_LENS_KML_SESSION_TTL_SECONDS
+        if self.dirty:
+            self.writeBack()
+        # utime is local time, see ViewKml
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=ttlSeconds)
+        staleIds = list(GoogleEarthSession.objects
+                        .filter(utime__lt=cutoff)
+                        .values_list('sessionId', flat=True))
+        numExpired = 0
+        for i in xrange(0, len(staleIds), SWEEP_BATCH_SIZE):
+            batch = staleIds[i:(i + SWEEP_BATCH_SIZE)]
+            if self.useCache():
+                keys = dict([(self.getKey(sessionId), sessionId) for sessionId in batch])
+                activeIds = set([keys[key]
+                                 for key, session in self.getCache().get_many(keys.keys()).iteritems()
+                                 if session.utime >= cutoff])
+                batch = [sessionId for sessionId in batch if sessionId not in activeIds]
+            if batch:
+                GoogleEarthSession.objects.filter(sessionId__in=batch, utime__lt=cutoff).delete()
+                numExpired += len(batch)
+        if numExpired:
+            print >> sys.stderr, 'KmlSessionStore: expired %d sessions' % numExpired
+        self.expired += numExpired
+        self.lastSweep = time.time()
+        return numExpired
+
+    def getStats(self):
+        if self.lookups:
+            hitRate = float(self.hits) / self.lookups
+        else:
+            hitRate = None
+        return dict(store=settings.GEOCAM_LENS_KML_SESSION_STORE,
+                    lookups=self.lookups,
+                    hits=self.hits,
+                    hitRate=hitRate,
+                    creates=self.creates,
+                    writes=self.writes,
+                    pendingWrites=len(self.dirty),
+                    expired=self.expired,
+                    numStoredSessions=GoogleEarthSession.objects.count())
+
+kmlSessionStoreSingleton = KmlSessionStore()
+
+
+def kmlSessionRequestFinished(sender, **kwargs):
+    # write back pending changes even if this process serves no more polls
+    kmlSessionStoreSingleton.flushIfDue()
+
+request_finished.connect(kmlSessionRequestFinished)
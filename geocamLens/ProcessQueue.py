@@ -0,0 +1,282 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+DB-backed job queue for running Image.process() outside of the HTTP
+request, with a pool of local worker processes to drain it.
+"""
+
+import os
+import sys
+import stat
+import time
+import datetime
+import traceback
+import multiprocessing
+
+from django.db import connection, transaction
+from django.contrib.contenttypes.models import ContentType
+
+from geocamLens import Ingest, ResumableUpload
+from geocamLens.KmlSessionStore import kmlSessionStoreSingleton
+from geocamLens.models import ProcessingJob, UploadSession, \
+    JOB_QUEUED, JOB_RUNNING, JOB_FAILED
+from django.conf import settings
+
+# how many queued jobs to consider per claim attempt
+CLAIM_BATCH_SIZE = 10
+
+# the image columns process() sets
+PROCESS_FIELDS = ('status', 'processed')
+
+# time of the last sweepStagingIfDue() sweep in this process
+LAST_STAGING_SWEEP = 0
+
+# how often runWorkerPool() checks on its workers, and how often it
+# looks for jobs left running by a worker that died
+SUPERVISOR_POLL_SECONDS = 5
+STALE_JOB_CHECK_SECONDS = 60
+
+
+def cancelQueuedJobs(imgType, imgIds):
+    """
+    Drop queued jobs for these images, e.g. because a higher-resolution
+    version has arrived and is about to be queued.
+    """
+    stale = ProcessingJob.objects.filter(imgType=imgType,
+                                         imgId__in=imgIds,
+                                         status=JOB_QUEUED)
+    for job in stale:
+        if job.importFile and os.path.exists(job.importFile):
+            os.unlink(job.importFile)
+    stale.delete()
+
+
+def enqueueProcess(img, importFile=None):
+    """
+    Queue a background process() call for @img, which must already be
+    saved.  The worker takes ownership of @importFile and deletes it
+    once the image has been imported.
+    """
+    imgType = ContentType.objects.get_for_model(img)
+    cancelQueuedJobs(imgType, [img.id])
+    job = ProcessingJob(imgType=imgType,
+                        imgId=img.id,
+                        importFile=importFile or '')
+    job.save()
+    return job
+
+
+def enqueueProcessBulk(imgsAndFiles):
+    """
+    Like enqueueProcess(), for a list of (img, importFile) pairs of the
+    same model, with one insert for all of the jobs.
+    """
+    if not imgsAndFiles:
+        return
+    imgType = ContentType.objects.get_for_model(imgsAndFiles[0][0])
+    cancelQueuedJobs(imgType, [img.id for img, _importFile in imgsAndFiles])
+    now = datetime.datetime.utcnow()
+    jobs = [ProcessingJob(imgType=imgType,
+                          imgId=img.id,
+                          importFile=importFile or '',
+                          dateCreated=now,
+                          dateUpdated=now)
+            for img, importFile in imgsAndFiles]
+    ProcessingJob.objects.bulk_create(jobs)
+
+
+def claimJob():
+    """
+    Atomically mark the oldest queued job as running and return it, or
+    return None if the queue is empty.  Safe to call from several
+    worker processes at once.
+    """
+    candidates = (ProcessingJob.objects
+                  .filter(status=JOB_QUEUED)
+                  .order_by('id')[:CLAIM_BATCH_SIZE])
+    for job in candidates:
+        now = datetime.datetime.utcnow()
+        claimed = (ProcessingJob.objects
+                   .filter(id=job.id, status=JOB_QUEUED)
+                   .update(status=JOB_RUNNING,
+                           attempts=job.attempts + 1,
+                           dateUpdated=now))
+        if claimed:
+            job.status = JOB_RUNNING
+            job.attempts += 1
+            job.dateUpdated = now
+            return job
+        # otherwise another worker got there first, try the next one
+    return None
+
+
+def saveProcessed(img):
+    """
+    Save the columns process() set on @img.  A newer upload of the same
+    uuid may have updated the row while we worked, so the row is
+    reloaded and left alone unless it's still the version we processed;
+    the newer upload has its own job.
+    """
+    with transaction.atomic():
+        current = (type(img)._base_manager
+                   .select_for_update()
+                   .filter(pk=img.pk)
+                   .first())
+        if current is None or current.version != img.version:
+            print >> sys.stderr, 'ProcessQueue: image %s changed during processing, not saving' % img.pk
+            return
+        for name in PROCESS_FIELDS:
+            setattr(current, name, getattr(img, name))
+        current.save(update_fields=PROCESS_FIELDS)
+
+
+def runJob(job):
+    """
+    Process the image for a claimed job.  Returns True on success.
+    """
+    try:
+        img = job.img
+        if img is not None:
+            img.process(importFile=job.importFile or None, moveImportFile=True)
+            saveProcessed(img)
+    except Exception:  # pylint: disable=W0703
+        job.errorMessage = traceback.format_exc()
+        print >> sys.stderr, 'ProcessQueue: job %s failed (attempt %d):\n%s' \
+            % (job.id, job.attempts, job.errorMessage)
+        if job.attempts >= settings.GEOCAM_LENS_PROCESS_MAX_ATTEMPTS:
+            job.status = JOB_FAILED
+        else:
+            job.status = JOB_QUEUED
+        job.save()
+        return False
+
+    # clean up if process() didn't consume the import file
+    if job.importFile and os.path.exists(job.importFile):
+        os.unlink(job.importFile)
+    job.delete()
+    return True
+
+
+def requeueStaleJobs():
+    """
+    Return running jobs whose worker apparently died to the queue.
+    """
+    cutoff = (datetime.datetime.utcnow()
+              - datetime.timedelta(seconds=settings.GEOCAM_LENS_PROCESS_TIMEOUT_SECONDS))
+    numRequeued = (ProcessingJob.objects
+                   .filter(status=JOB_RUNNING, dateUpdated__lt=cutoff)
+                   .update(status=JOB_QUEUED))
+    if numRequeued:
+        print >> sys.stderr, 'ProcessQueue: requeued %d stale jobs' % numRequeued
+    return numRequeued
+
+
+def cleanStagingDir(maxAgeSeconds=None):
+    """
+    Delete staged uploads left behind by crashed requests.  Files that a
+    job or resumable upload session still refers to are kept.
+    """
+    if maxAgeSeconds is None:
+        maxAgeSeconds = settings.GEOCAM_LENS_PROCESS_TIMEOUT_SECONDS
+    stagingDir = Ingest.getStagingDir()
+    pending = set(ProcessingJob.objects
+                  .exclude(importFile='')
+                  .values_list('importFile', flat=True))
+    # resumable uploads have their own, longer expiry
+    pending.update(UploadSession.objects.values_list('stagingPath', flat=True))
+    cutoff = time.time() - maxAgeSeconds
+    numDeleted = 0
+    for f in os.listdir(stagingDir):
+        path = os.path.join(stagingDir, f)
+        if path in pending:
+            continue
+        try:
+            if os.stat(path)[stat.ST_MTIME] < cutoff:
+                os.unlink(path)
+                numDeleted += 1
+        except OSError:
+            pass  # already consumed
+    if numDeleted:
+        print >> sys.stderr, 'ProcessQueue: deleted %d abandoned staging files' % numDeleted
+    return numDeleted
+
+
+def sweepStagingIfDue():
+    """
+    Expire abandoned resumable uploads and clean the staging dir, at
+    most once per GEOCAM_LENS_STAGING_SWEEP_SECONDS.  Called after
+    uploads, so sites that process in the foreground and never start
+    lensWorker are swept too.
+    """
+    global LAST_STAGING_SWEEP
+    now = time.time()
+    if now - LAST_STAGING_SWEEP < settings.GEOCAM_LENS_STAGING_SWEEP_SECONDS:
+        return
+    LAST_STAGING_SWEEP = now
+    ResumableUpload.expireSessions(settings.GEOCAM_LENS_UPLOAD_SESSION_TTL_SECONDS)
+    cleanStagingDir()
+
+
+def runWorker(pollSeconds=None, exitWhenIdle=False):
+    if pollSeconds is None:
+        pollSeconds = settings.GEOCAM_LENS_WORKER_POLL_SECONDS
+    while 1:
+        job = claimJob()
+        if job is None:
+            if exitWhenIdle:
+                break
+            time.sleep(pollSeconds)
+        else:
+            runJob(job)
+
+
+def startWorker(pollSeconds, exitWhenIdle):
+    # each worker must open its own db connection after the fork
+    connection.close()
+    worker = multiprocessing.Process(target=runWorker,
+                                     args=(pollSeconds, exitWhenIdle))
+    worker.start()
+    return worker
+
+
+def runWorkerPool(numWorkers=None, pollSeconds=None, exitWhenIdle=False):
+    """
+    Start @numWorkers worker processes and supervise them: a worker that
+    exits abnormally is replaced, and jobs left running by a worker that
+    died are requeued once they time out, without waiting for a
+    restart of the pool.
+    """
+    if numWorkers is None:
+        numWorkers = settings.GEOCAM_LENS_NUM_WORKERS
+    requeueStaleJobs()
+    ResumableUpload.expireSessions(settings.GEOCAM_LENS_UPLOAD_SESSION_TTL_SECONDS)
+    kmlSessionStoreSingleton.expireSessions()
+    cleanStagingDir()
+
+    workers = [startWorker(pollSeconds, exitWhenIdle)
+               for _ in xrange(numWorkers)]
+    print >> sys.stderr, 'ProcessQueue: started %d workers' % numWorkers
+    lastStaleCheck = time.time()
+    while workers:
+        time.sleep(SUPERVISOR_POLL_SECONDS)
+        for i, w in enumerate(workers):
+            if w.is_alive():
+                continue
+            w.join()
+            if exitWhenIdle and w.exitcode == 0:
+                workers[i] = None
+            else:
+                print >> sys.stderr, ('ProcessQueue: worker %d exited with code %s, restarting'
+                                      % (w.pid, w.exitcode))
+                workers[i] = startWorker(pollSeconds, exitWhenIdle)
+        workers = [w for w in workers if w is not None]
+
+        if time.time() - lastStaleCheck >= STALE_JOB_CHECK_SECONDS:
+            lastStaleCheck = time.time()
+            requeueStaleJobs()
+            # don't hold a connection a later fork would share
+            connection.close()
@@ -0,0 +1,178 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Resumable upload sessions.  A client starts a session keyed by the
+image uuid, sends the photo in chunks at increasing offsets (asking the
+server for the received offset after a dropped connection), then
+finalizes the session, which hands the staged file to the normal import
+path.
+"""
+
+import os
+import re
+import sys
+import time
+import datetime
+import tempfile
+
+from django.db import transaction, IntegrityError
+
+from geocamUtil import anyjson as json
+
+from geocamLens import Ingest
+from geocamLens.models import UploadSession
+
+BLOCK_SIZE = 64 * 1024
+
+# the uuid is part of the staging file name, so it's limited to hex
+# digits and dashes
+UUID_REGEX = re.compile(r'^[0-9a-fA-F][0-9a-fA-F\-]{0,47}$')
+
+
+class UploadOffsetError(Exception):
+    """
+    Raised when a chunk doesn't start at the received offset.
+    """
+    def __init__(self, message, offset):
+        super(UploadOffsetError, self).__init__(message)
+        self.offset = offset
+
+
+class UploadStartError(Exception):
+    """
+    Raised when a session can't be started, with the HTTP status to
+    return to the client.
+    """
+    def __init__(self, message, status):
+        super(UploadStartError, self).__init__(message)
+        self.status = status
+
+
+def isValidUuid(uuid):
+    return UUID_REGEX.match(uuid) is not None
+
+
+def makeStagingFile(uuid):
+    """
+    Create an empty staging file for a new session for @uuid and return
+    its path.  Each session gets a unique name, so a new upload of the
+    same uuid never touches the file of a finalized session that a job
+    may still hold.
+    """
+    if not isValidUuid(uuid):
+        raise ValueError('invalid upload uuid %r' % uuid)
+    fd, stagingPath = tempfile.mkstemp('.part', 'resumable-%s-' % uuid,
+                                       Ingest.getStagingDir())
+    os.close(fd)
+    return stagingPath
+
+
+def startSession(author, uuid, name, totalBytes, formFields):
+    """
+    Start a session for @uuid, or return the existing one if the client
+    is restarting after losing track of its progress.  Restarting with
+    a different size means the client is sending a different file, so
+    the session starts over.
+    """
+    if not isValidUuid(uuid):
+        raise UploadStartError('uuid may only contain hex digits and dashes', 400)
+    session = UploadSession.objects.filter(uuid=uuid).first()
+    if session is not None and session.author_id != author.id:
+        raise UploadStartError('an upload with uuid %s is already in progress for another user'
+                               % uuid, 409)
+
+    if session is None:
+        session = UploadSession(uuid=uuid,
+                                author=author,
+                                name=name,
+                                stagingPath=makeStagingFile(uuid),
+                                totalBytes=totalBytes,
+                                formData=json.dumps(formFields),
+                                dateCreated=datetime.datetime.utcnow())
+        try:
+            with transaction.atomic():
+                session.save()
+        except IntegrityError:
+            # a concurrent request started a session for this uuid first
+            os.unlink(session.stagingPath)
+            return startSession(author, uuid, name, totalBytes, formFields)
+        print >> sys.stderr, 'ResumableUpload: started session %s' % uuid
+    elif totalBytes is not None and totalBytes != session.totalBytes:
+        print >> sys.stderr, ('ResumableUpload: size of session %s changed from %s to %s, starting over'
+                              % (uuid, session.totalBytes, totalBytes))
+        session.name = name
+        session.totalBytes = totalBytes
+        session.formData = json.dumps(formFields)
+        session.save()
+        open(session.stagingPath, 'wb').close()
+    return session
+
+
+def writeChunk(session, offset, stream, length):
+    """
+    Append @length bytes read from file-like @stream to the staging file
+    and return the new received offset.  The chunk must start at the
+    received offset; a client resending after a dropped response gets
+    an UploadOffsetError carrying the offset to continue from, so data
+    already received is never rewritten.
+    """
+    received = session.getReceivedBytes()
+    if offset != received:
+        raise UploadOffsetError('chunk at offset %d does not start at received offset %d'
+                                % (offset, received), received)
+    if session.totalBytes is not None and offset + length > session.totalBytes:
+        raise UploadOffsetError('chunk extends past declared size %d' % session.totalBytes,
+                                received)
+
+    f = open(session.stagingPath, 'ab')
+    try:
+        remaining = length
+        while remaining > 0:
+            block = stream.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            f.write(block)
+            remaining -= len(block)
+    finally:
+        f.close()
+    return session.getReceivedBytes()
+
+
+def isComplete(session):
+    if session.totalBytes is None:
+        return session.getReceivedBytes() > 0
+    return session.getReceivedBytes() == session.totalBytes
+
+
+def finishSession(session):
+    """
+    Close @session once its staged file has been imported.  The file
+    itself now belongs to the import, so it's left alone.
+    """
+    session.delete()
+
+
+def expireSessions(ttlSeconds):
+    """
+    Delete sessions whose staging file hasn't been written to in
+    @ttlSeconds, along with their partial files.
+    """
+    cutoff = time.time() - ttlSeconds
+    numExpired = 0
+    for session in UploadSession.objects.all():
+        try:
+            mtime = os.path.getmtime(session.stagingPath)
+        except OSError:
+            mtime = 0
+        if mtime < cutoff:
+            if os.path.exists(session.stagingPath):
+                os.unlink(session.stagingPath)
+            session.delete()
+            numExpired += 1
+    if numExpired:
+        print >> sys.stderr, 'ResumableUpload: expired %d sessions' % numExpired
+    return numExpired
@@ -5,10 +5,18 @@
 # __END_LICENSE__
 
 import re
+import base64
+import datetime
 
-from django.db.models import Q
+from django.db.models import Q, Case, When, Value, IntegerField
 
 from geocamUtil import TimeUtil
+from geocamUtil import anyjson as json
+
+from geocamLens import SpatialIndex
+from geocamLens.models import SpatialKey, FeatureChange
+
+CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
 
 
 class BadQuery(Exception):
@@ -21,6 +29,8 @@ class SearchAbstract(object):
     fields = ()
     fieldAliases = ()
     timeField = 'timestamp'
+    latField = 'latitude'
+    lonField = 'longitude'
 
     def __init__(self):
         self.flookup = dict([(name, name) for name in self.fields])
@@ -143,4 +153,133 @@ class SearchAbstract(object):
         result = startSet
         if query:
             result = self.searchFeatures0(result, query)
-        return result.distinct().order_by('-' + self.timeField)
+        # newest first with null timestamps last, whatever the db's
+        # default null order is, and pk breaking ties so the order is
+        # stable for getPage()
+        timeIsNull = Case(When(then=Value(1), **{self.timeField + '__isnull': True}),
+                          default=Value(0),
+                          output_field=IntegerField())
+        return (result.distinct()
+                .annotate(timeIsNull=timeIsNull)
+                .order_by('timeIsNull', '-' + self.timeField, '-pk'))
+
+    @staticmethod
+    def encodeCursor(timestamp, pk):
+        if timestamp is None:
+            tsString = None
+        else:
+            tsString = timestamp.strftime(CURSOR_TIME_FORMAT)
+        return base64.urlsafe_b64encode(json.dumps([tsString, pk]))
+
+    @staticmethod
+    def decodeCursor(cursor):
+        try:
+            tsString, pk = json.loads(base64.urlsafe_b64decode(str(cursor)))
+            if tsString is None:
+                timestamp = None
+            else:
+                timestamp = datetime.datetime.strptime(tsString, CURSOR_TIME_FORMAT)
+            return timestamp, int(pk)
+        except (TypeError, ValueError):
+            raise BadQuery("Oops, can't understand cursor '%s'" % cursor)
+
+    def getPage(self, features, cursor, pageSize):
+        """
+        Keyset pagination over the output of searchFeatures().  Returns
+        the page of features after @cursor (all of them from the start
+        if @cursor is empty) and the cursor for the next page, or None on
+        the last page.  Each page is a range query, no matter how deep
+        into the result set it is.  Features with null timestamps come
+        after all others, ordered by pk.
+        """
+        if pageSize <= 0:
+            raise BadQuery("Oops, page size must be positive, not %s" % pageSize)
+        if cursor:
+            timestamp, pk = self.decodeCursor(cursor)
+            if timestamp is None:
+                # only null timestamps remain
+                after = Q(**{self.timeField + '__isnull': True, 'pk__lt': pk})
+            else:
+                # comparisons never match nulls, so they're added back
+                after = (Q(**{self.timeField + '__lt': timestamp})
+                         | Q(**{self.timeField: timestamp, 'pk__lt': pk})
+                         | Q(**{self.timeField + '__isnull': True}))
+            features = features.filter(after)
+        page = list(features[:pageSize + 1])
+        if len(page) > pageSize:
+            page = page[:pageSize]
+            last = page[-1]
+            nextCursor = self.encodeCursor(getattr(last, self.timeField), last.pk)
+        else:
+            nextCursor = None
+        return page, nextCursor
+
+    def parseBbox(self, bboxText):
+        try:
+            return SpatialIndex.parseBbox(bboxText)
+        except ValueError, msg:
+            raise BadQuery("Oops, %s in bbox '%s'. Use bbox=west,south,east,north in degrees."
+                           % (msg, bboxText))
+
+    def getQuadKeyFilter(self, bbox, maxLevel=SpatialIndex.QUADKEY_MAX_LEVEL):
+        """
+        Returns a filter on a quadKey field matching the tiles at or
+        below @maxLevel that cover @bbox.
+        """
+        keyFilter = Q()
+        for quadKey in SpatialIndex.getCoveringKeys(bbox, maxLevel=maxLevel):
+            low, high = SpatialIndex.getQuadKeyRange(quadKey)
+            keyFilter = keyFilter | Q(quadKey__gte=low, quadKey__lt=high)
+        return keyFilter
+
+    def filterBbox(self, features, bbox):
+        """
+        Restrict @features to those inside @bbox.  The quadtree key index
+        narrows the candidates to a few tile ranges, then the exact
+        lat/lon test is applied to those.
+        """
+        candidateIds = (SpatialKey.objects
+                        .filter(self.getQuadKeyFilter(bbox))
+                        .values('featureId'))
+
+        locFilter = Q()
+        for west, south, east, north in SpatialIndex.splitBbox(bbox):
+            locFilter = locFilter | Q(**{self.latField + '__range': (south, north),
+                                         self.lonField + '__range': (west, east)})
+        return features.filter(pk__in=candidateIds).filter(locFilter)
+
+    def parseSince(self, since):
+        """
+        Returns a filter on FeatureChange for changes after @since, which
+        is either a token from an earlier response or a timestamp.
+        """
+        if since.isdigit():
+            return Q(id__gt=int(since))
+        try:
+            utcDT = TimeUtil.stringToUtcDT(since)
+        except ValueError, msg:
+            raise BadQuery("Oops, %s in since '%s'. Use the since token from an earlier response or a timestamp."
+                           % (msg, since))
+        return Q(dateChanged__gt=utcDT)
+
+    def getDelta(self, features, since, latestSeq):
+        """
+        Restrict @features to those changed after @since and up to change
+        sequence number @latestSeq.  Returns (changedFeatures,
+        removedIds), where @removedIds are the features that changed but
+        no longer match: deleted ones (including soft deletes, whose
+        change is marked deleted even though the row is still there),
+        and any that were edited out of the search or not yet processed.
+        Clients should drop those.
+        """
+        changes = (FeatureChange.objects
+                   .filter(self.parseSince(since))
+                   .filter(id__lte=latestSeq))
+        changedFeatures = features.filter(pk__in=(changes
+                                                  .filter(deleted=False)
+                                                  .values('featureId')))
+        matchedIds = set(changedFeatures.values_list('pk', flat=True))
+        removedIds = [featureId
+                      for featureId in changes.order_by('id').values_list('featureId', flat=True)
+                      if featureId not in matchedIds]
+        return changedFeatures, removedIds
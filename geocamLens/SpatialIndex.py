@@ -0,0 +1,131 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Quadtree keys for indexing feature locations.  The world in lon/lat is
+split into 2^level x 2^level tiles at each level, and a tile is named by
+a string of digits 0-3, one per level, like Bing Maps quadkeys.  The key
+of a tile is a prefix of the keys of all tiles inside it, so "features
+inside this tile" is a range query on an indexed key column.
+"""
+
+import math
+
+# ~2.4 m tiles at the equator
+QUADKEY_MAX_LEVEL = 24
+
+
+def getTileXY(lat, lon, level):
+    n = 1 << level
+    x = int(math.floor((lon + 180.0) / 360.0 * n))
+    y = int(math.floor((90.0 - lat) / 180.0 * n))
+    return (min(max(x, 0), n - 1),
+            min(max(y, 0), n - 1))
+
+
+def tileToQuadKey(x, y, level):
+    digits = []
+    for i in xrange(level, 0, -1):
+        mask = 1 << (i - 1)
+        digit = 0
+        if x & mask:
+            digit += 1
+        if y & mask:
+            digit += 2
+        digits.append(str(digit))
+    return ''.join(digits)
+
+
+def quadKeyToTile(quadKey):
+    x = y = 0
+    level = len(quadKey)
+    for i, c in enumerate(quadKey):
+        mask = 1 << (level - i - 1)
+        digit = int(c)
+        if digit & 1:
+            x |= mask
+        if digit & 2:
+            y |= mask
+    return x, y, level
+
+
+def getQuadKey(lat, lon, level=QUADKEY_MAX_LEVEL):
+    x, y = getTileXY(lat, lon, level)
+    return tileToQuadKey(x, y, level)
+
+
+def getTileBounds(quadKey):
+    """
+    Returns (west, south, east, north) of the tile.
+    """
+    x, y, level = quadKeyToTile(quadKey)
+    n = float(1 << level)
+    return (x / n * 360.0 - 180.0,
+            90.0 - (y + 1) / n * 180.0,
+            (x + 1) / n * 360.0 - 180.0,
+            90.0 - y / n * 180.0)
+
+
+def getQuadKeyRange(quadKey):
+    """
+    Returns (low, high) such that low <= key < high exactly for the keys
+    of tiles inside @quadKey.
+    """
+    return (quadKey, quadKey + '4')
+
+
+def splitBbox(bbox):
+    """
+    Split a bbox that crosses the antimeridian (west > east) in two.
+    """
+    west, south, east, north = bbox
+    if west <= east:
+        return [bbox]
+    else:
+        return [(west, south, 180.0, north),
+                (-180.0, south, east, north)]
+
+
+def getTileRange(bbox, level):
+    west, south, east, north = bbox
+    x0, y0 = getTileXY(north, west, level)
+    x1, y1 = getTileXY(south, east, level)
+    return x0, y0, x1, y1
+
+
+def getCoveringKeys(bbox, maxTiles=16, maxLevel=QUADKEY_MAX_LEVEL):
+    """
+    Return the keys of the tiles at the deepest level where no more than
+    @maxTiles tiles are needed to cover @bbox.
+    """
+    keys = []
+    for part in splitBbox(bbox):
+        level = 0
+        while level < maxLevel:
+            x0, y0, x1, y1 = getTileRange(part, level + 1)
+            if (x1 - x0 + 1) * (y1 - y0 + 1) > maxTiles:
+                break
+            level += 1
+        x0, y0, x1, y1 = getTileRange(part, level)
+        for x in xrange(x0, x1 + 1):
+            for y in xrange(y0, y1 + 1):
+                keys.append(tileToQuadKey(x, y, level))
+    return keys
+
+
+def parseBbox(text):
+    """
+    Parse 'west,south,east,north' in degrees.  Raises ValueError.
+    """
+    vals = [float(v) for v in text.split(',')]
+    if len(vals) != 4:
+        raise ValueError('bbox must have 4 values')
+    west, south, east, north = vals
+    if not (-90 <= south <= north <= 90):
+        raise ValueError('bbox latitudes out of range')
+    if not (-180 <= west <= 180 and -180 <= east <= 180):
+        raise ValueError('bbox longitudes out of range')
+    return (west, south, east, north)
@@ -0,0 +1,147 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Disk cache for thumbnails rendered on demand, bounded by a byte budget
+with least-recently-used eviction.
+"""
+
+import os
+import stat
+import time
+import tempfile
+import threading
+
+from geocamUtil.FileUtil import mkdirP
+
+from django.conf import settings
+
+# pylint: disable=C1001
+
+
+class ThumbnailCache(object):
+    def __init__(self, cacheDir=None, maxBytes=None):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.totalBytes = None  # computed lazily by scanning cacheDir
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def getCacheDir(self):
+        if self.cacheDir is None:
+            self.cacheDir = (settings.GEOCAM_LENS_THUMB_CACHE_DIR
+                             or os.path.join(settings.DATA_DIR, 'geocamLens', 'thumbCache'))
+        return self.cacheDir
+
+    def getMaxBytes(self):
+        if self.maxBytes is None:
+            self.maxBytes = settings.GEOCAM_LENS_THUMB_CACHE_MAX_BYTES
+        return self.maxBytes
+
+    def getCachePath(self, img, width):
+        # the version is part of the key, so a higher-resolution
+        # re-upload naturally misses and old entries age out
+        return os.path.join(self.getCacheDir(),
+                            img.uuid[:2],
+                            '%s-v%d-w%d.jpg' % (img.uuid, img.version, width))
+
+    def scanEntries(self):
+        entries = []
+        for dirPath, _dirNames, fileNames in os.walk(self.getCacheDir()):
+            for f in fileNames:
+                if f.startswith('.tmp-'):
+                    continue  # still being rendered
+                path = os.path.join(dirPath, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue  # evicted by another process
+                entries.append((st[stat.ST_ATIME], st[stat.ST_SIZE], path))
+        return entries
+
+    def evict(self):
+        """
+        Delete least recently used entries until the cache is back under
+        90% of its byte budget.  Hits set the entry atime explicitly (see
+        touch()), which works on noatime mounts too.
+        """
+        entries = self.scanEntries()
+        entries.sort()
+        self.totalBytes = sum([size for _atime, size, _path in entries])
+        target = int(0.9 * self.getMaxBytes())
+        for _atime, size, path in entries:
+            if self.totalBytes <= target:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            self.totalBytes -= size
+            self.evictions += 1
+
+    def addBytes(self, numBytes):
+        with self.lock:
+            if self.totalBytes is None:
+                self.totalBytes = sum([size for _atime, size, _path in self.scanEntries()])
+            else:
+                self.totalBytes += numBytes
+            if self.totalBytes > self.getMaxBytes():
+                self.evict()
+
+    def touch(self, path):
+        """
+        Mark the entry at @path as recently used.  Only the atime is
+        changed: the mtime feeds the ETag and Last-Modified headers, so
+        it must stay put for conditional GETs to work.
+        """
+        try:
+            os.utime(path, (time.time(), os.stat(path)[stat.ST_MTIME]))
+        except OSError:
+            pass
+
+    def getThumbnail(self, img, width):
+        """
+        Return (path, hit) for a @width-pixel-wide thumbnail of @img,
+        rendering it into the cache if necessary.
+        """
+        cachePath = self.getCachePath(img, width)
+        if os.path.exists(cachePath):
+            self.touch(cachePath)
+            self.hits += 1
+            return cachePath, True
+
+        self.misses += 1
+        mkdirP(os.path.dirname(cachePath))
+        # render to a temp file in the same dir and rename into place so
+        # concurrent requests never see a partial thumbnail
+        fd, tempPath = tempfile.mkstemp('.jpg', '.tmp-', os.path.dirname(cachePath))
+        os.close(fd)
+        try:
+            img.writeThumbnail(img.getImagePath(), (width, (width * 3) // 4), tempPath)
+            os.rename(tempPath, cachePath)
+        except:
+            if os.path.exists(tempPath):
+                os.unlink(tempPath)
+            raise
+        self.addBytes(os.stat(cachePath)[stat.ST_SIZE])
+        return cachePath, False
+
+    def getStats(self):
+        total = self.hits + self.misses
+        if total:
+            hitRate = float(self.hits) / total
+        else:
+            hitRate = None
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    hitRate=hitRate,
+                    evictions=self.evictions,
+                    totalBytes=self.totalBytes,
+                    maxBytes=self.getMaxBytes())
+
+thumbnailCacheSingleton = ThumbnailCache()
@@ -4,34 +4,133 @@
 # All Rights Reserved.
 # __END_LICENSE__
 
+import os
+import re
+import hashlib
 import urllib
+import urlparse
 import datetime
 import sys
+import time
+from xml.sax.saxutils import escape
 
 from django.core import urlresolvers
+from django.http import HttpResponse, StreamingHttpResponse, Http404
 
 from geocamUtil import KmlUtil
+from geocamUtil import TimeUtil
+from geocamUtil import anyjson as json
 
-from geocamLens.models import GoogleEarthSession
+from geocamLens.models import GoogleEarthSession, FeatureChange, SpatialKey, ClusterCell, \
+    FeatureFragment
+from geocamLens.FeatureCache import featureCacheSingleton
+from geocamLens.KmlSessionStore import kmlSessionStoreSingleton
+from geocamLens.BatchSerializer import iterFeatureBatches, iterFragmentBatches
+from geocamLens import SpatialIndex
+from geocamLens import Compression
+from geocamLens.ZipStream import ZipStream
 from django.conf import settings
 
 # pylint: disable=C1001
 
 CACHED_CSS = None
 
+KML_CONTENT_TYPE = 'application/vnd.google-earth.kml+xml'
+KMZ_CONTENT_TYPE = 'application/vnd.google-earth.kmz'
+
+# number of features fetched and serialized per chunk of a streaming
+# KML response
+KML_CHUNK_FEATURES = 100
+
+# splits KmlUtil.wrapKml() output into the parts before and after the body
+WRAP_MARKER = '__GEOCAM_LENS_KML_BODY__'
+
+# turns a placemark from getKml() into the target of a <Change>
+PLACEMARK_ID_REGEX = re.compile(r'<Placemark\s+id=')
+
+
+class KmzStats(object):
+    """
+    Size and build time of the KMZ responses this process has sent.  A
+    KMZ is streamed, so these can't go in its response headers; they're
+    served at kml/kmzStats.json instead.
+    """
+    def __init__(self):
+        self.numSent = 0
+        self.totalBytes = 0
+        self.totalSeconds = 0.0
+        self.maxSeconds = 0.0
+        self.last = None
+
+    def record(self, numBytes, numThumbnails, buildSeconds):
+        self.numSent += 1
+        self.totalBytes += numBytes
+        self.totalSeconds += buildSeconds
+        self.maxSeconds = max(self.maxSeconds, buildSeconds)
+        self.last = dict(bytes=numBytes,
+                         thumbnails=numThumbnails,
+                         buildSeconds=buildSeconds)
+
+    def getStats(self):
+        if self.numSent:
+            meanBytes = self.totalBytes // self.numSent
+            meanSeconds = self.totalSeconds / self.numSent
+        else:
+            meanBytes = None
+            meanSeconds = None
+        return dict(numSent=self.numSent,
+                    meanBytes=meanBytes,
+                    meanBuildSeconds=meanSeconds,
+                    maxBuildSeconds=self.maxSeconds,
+                    last=self.last)
+
+kmzStatsSingleton = KmzStats()
+
 
 class BogusRequest:
     def build_absolute_uri(self, text):
         return text
 
 
+class KmzRequest(object):
+    """
+    Stands in for the request while rendering placemarks into a KMZ
+    with bundled thumbnails.  Balloon links to prebuilt description
+    thumbnails are pointed at copies in the archive, which are collected
+    in self.files as {archiveName: path}.  Thumbnails rendered on demand
+    stay on the server.
+    """
+    def __init__(self, request):
+        self.request = request
+        self.files = {}
+        self.thumbRegex = re.compile(r'/th%d\.jpg$' % settings.GEOCAM_AWARE_DESC_THUMB_SIZE[0])
+
+    def __getattr__(self, name):
+        return getattr(self.request, name)
+
+    def build_absolute_uri(self, location=None):
+        if (location
+                and location.startswith(settings.DATA_URL)
+                and self.thumbRegex.search(location)):
+            relPath = location[len(settings.DATA_URL):]
+            path = os.path.join(settings.DATA_DIR, relPath)
+            if os.path.exists(path):
+                archiveName = 'files/' + relPath
+                self.files[archiveName] = path
+                return archiveName
+        return self.request.build_absolute_uri(location)
+
+
 class ViewKml(object):
     search = None  # override in derived classes
 
     def kmlGetStartSessionKml(self, request, sessionId):
-        urlPath = urlresolvers.reverse('geocamLens_kmlGetSessionResponse',
-                                       args=[sessionId, 'initial'])
-        absUrl = request.build_absolute_uri(urlPath)
+        # startSession.kml?kmz=1 starts a KMZ session, add &thumbnails=1
+        # to bundle thumbnails
+        absUrl = self.kmlGetSessionUrl(request, sessionId, 'initial',
+                                       kmz=self.kmlIsFlagSet(request, 'kmz'))
+        if self.kmlIsFlagSet(request, 'thumbnails'):
+            absUrl += '?thumbnails=1'
         if settings.GEOCAM_LENS_KML_FLY_TO_VIEW:
             flyToView = '<flyToView>1</flyToView>'
         else:
@@ -54,41 +153,86 @@ class ViewKml(object):
         print >> sys.stderr, "ViewKml: started session %s" % sessionId
         return KmlUtil.wrapKmlDjango(self.kmlGetStartSessionKml(request, sessionId))
 
-    def kmlGetAllFeaturesFolder(self, request, searchQuery, newUtime=None):
+    def kmlGetMatchingFeatures(self, request, searchQuery, bboxText=None):
         allFeatures = self.search.getAllFeatures()
         features = self.search.searchFeatures(allFeatures, searchQuery)
-        if 0:
-            # TODO: update models so this filtering statement can work
-            features = features.filter(mtime__lte=newUtime,
-                                       deleted=False)
-        featuresKml = '\n'.join([f.getKml(request) for f in features])
-        return ("""
+        if bboxText is None:
+            # Google Earth's viewFormat sends BBOX in upper case
+            bboxText = request.GET.get('bbox') or request.GET.get('BBOX')
+        if bboxText:
+            features = self.search.filterBbox(features,
+                                              self.search.parseBbox(bboxText))
+        return features
+
+    def kmlIterFeatures(self, features):
+        """
+        Yield the output of searchFeatures() in pages of
+        KML_CHUNK_FEATURES.  Each page is a separate keyset query, so
+        neither Django nor the db driver holds the whole result set.
+        """
+        cursor = ''
+        while cursor is not None:
+            page, cursor = self.search.getPage(features, cursor, KML_CHUNK_FEATURES)
+            yield page
+
+    def kmlIterPlacemarkBatches(self, request, features):
+        """
+        Yield lists of KML placemarks for @features, from the stored
+        FeatureFragments if they're enabled.  KMZ thumbnail bundling
+        rewrites urls while rendering, so it always renders.
+        """
+        for batch in self.kmlIterIdPlacemarkBatches(request, features):
+            yield [placemarkKml for _featureId, placemarkKml in batch]
+
+    def kmlIterIdPlacemarkBatches(self, request, features):
+        """
+        Like kmlIterPlacemarkBatches() but yield lists of (featureId,
+        placemarkKml) pairs.
+        """
+        if settings.GEOCAM_LENS_USE_FRAGMENTS and not isinstance(request, KmzRequest):
+            for batch in iterFragmentBatches(features, KML_CHUNK_FEATURES):
+                yield [(fragment.featureId, FeatureFragment.getKml(fragment.kml, request))
+                       for fragment in batch]
+        else:
+            for batch in iterFeatureBatches(features, KML_CHUNK_FEATURES):
+                yield [(f.pk, f.getKml(request)) for f in batch]
+
+    def kmlIterAllFeaturesFolder(self, request, searchQuery, bboxText=None):
+        features = self.kmlGetMatchingFeatures(request, searchQuery, bboxText)
+        yield """
 <Folder id="allFeatures">
   <name>All features</name>
-  %s
+"""
+        for page in self.kmlIterFeatures(features):
+            for batch in self.kmlIterPlacemarkBatches(request, page):
+                yield '\n'.join(batch)
+        yield """
 </Folder>
-""" % featuresKml)
+"""
 
-    def kmlGetInitialKml(self, request, sessionId=None):
-        if sessionId:
-            newUtime = datetime.datetime.now()
-            session, _created = GoogleEarthSession.objects.get_or_create(sessionId=sessionId,
-                                                                         defaults=dict(utime=newUtime))
-            session.utime = newUtime
-            session.save()
-            query = session.getSearchQuery()
+    def kmlGetAllFeaturesFolder(self, request, searchQuery):
+        return ''.join(self.kmlIterAllFeaturesFolder(request, searchQuery))
+
+    def kmlIsFlagSet(self, request, name):
+        return request.GET.get(name, '') not in ('', '0')
+
+    def kmlGetSessionUrl(self, request, sessionId, method, kmz=False):
+        if kmz:
+            urlName = 'geocamLens_kmzGetSessionResponse'
         else:
-            newUtime = None
-            query = ''
+            urlName = 'geocamLens_kmlGetSessionResponse'
+        urlPath = urlresolvers.reverse(urlName, args=[sessionId, method])
+        return request.build_absolute_uri(urlPath)
 
-        allFeaturesFolder = self.kmlGetAllFeaturesFolder(request, query, newUtime)
+    def kmlGetCss(self):
         global CACHED_CSS
         if not CACHED_CSS:
             cssPath = '%sgeocamCore/css/share.css' % settings.STATIC_ROOT
             CACHED_CSS = file(cssPath, 'r').read()
-        result = ("""
-<Document id="allFeatures">
-  <name>%(SITE_TITLE)s</name>
+        return CACHED_CSS
+
+    def kmlGetShareCssStyle(self):
+        return ("""
   <Style id="shareCss">
     <BalloonStyle>
       <text><![CDATA[
@@ -99,43 +243,439 @@ class ViewKml(object):
       ]]></text>
     </BalloonStyle>
   </Style>
+""" % dict(CACHED_CSS=self.kmlGetCss()))
+
+    def kmlIterInitialKml(self, request, sessionId=None):
+        if sessionId:
+            # read the change sequence before the search, so a change
+            # that lands during it is sent again in the next update
+            # rather than missed
+            changeSeq = FeatureChange.getLatestSeq()
+            newUtime = datetime.datetime.now()
+            session = kmlSessionStoreSingleton.getOrCreate(sessionId, newUtime)
+            session.utime = newUtime
+            session.setChangeSeq(changeSeq)
+            # updates must name the document exactly as it was loaded,
+            # which may be a KMZ or carry parameters
+            session.setInitialUrl(request.build_absolute_uri())
+            kmlSessionStoreSingleton.save(session)
+            query = session.getSearchQuery()
+        else:
+            query = ''
+
+        yield ("""
+<Document id="allFeaturesDocument">
+  <name>%(SITE_TITLE)s</name>
+  %(style)s
 """ % dict(SITE_TITLE=settings.SITE_TITLE,
-           CACHED_CSS=CACHED_CSS))
-        if 0:
-            quotedId = urllib.quote_plus(sessionId)
-            updateUrl = request.build_absolute_uri('%skml/%s/update.kml' % (settings.SCRIPT_NAME, quotedId))
-            result += ("""
+           style=self.kmlGetShareCssStyle()))
+        if sessionId and settings.GEOCAM_LENS_KML_UPDATE_SECONDS:
+            # the update link carries the initial url, so a client whose
+            # session we lost can still be sent an update it will apply
+            updateUrl = (self.kmlGetSessionUrl(request, sessionId, 'update')
+                         + '?' + urllib.urlencode({'initial': request.build_absolute_uri()}))
+            yield ("""
   <NetworkLink>
     <name>Update</name>
     <Link>
       <href>%(updateUrl)s</href>
       <refreshMode>onInterval</refreshMode>
-      <refreshInterval>30</refreshInterval>
+      <refreshInterval>%(refreshInterval)s</refreshInterval>
     </Link>
   </NetworkLink>
-""" % dict(updateUrl=updateUrl))
-
-        result += ("""
-  %(allFeaturesFolder)s
+""" % dict(updateUrl=escape(updateUrl),
+           refreshInterval=settings.GEOCAM_LENS_KML_UPDATE_SECONDS))
 
+        for chunk in self.kmlIterAllFeaturesFolder(request, query):
+            yield chunk
+        yield """
 </Document>
-""" % dict(allFeaturesFolder=allFeaturesFolder))
-        return result
+"""
+
+    def kmlGetInitialKml(self, request, sessionId=None):
+        return ''.join(self.kmlIterInitialKml(request, sessionId))
+
+    def kmlIterWrapped(self, chunks):
+        header, footer = KmlUtil.wrapKml(WRAP_MARKER).split(WRAP_MARKER)
+        yield header
+        for chunk in chunks:
+            yield chunk
+        yield footer
+
+    def kmlStreamingResponse(self, request, chunks):
+        """
+        Like KmlUtil.wrapKmlDjango() for a KML body generated in
+        @chunks, without holding the whole document in memory.
+        Compressed as it's generated if the client accepts it.
+        """
+        response = StreamingHttpResponse(self.kmlIterWrapped(chunks),
+                                         content_type=KML_CONTENT_TYPE)
+        return Compression.compressResponse(request, response)
+
+    def kmlIterKmz(self, request, chunks):
+        """
+        Generate a KMZ with the KML body generated in @chunks.  If
+        @request is a KmzRequest, the files it collected while the KML
+        was rendered are added after it.
+        """
+        startTime = time.time()
+        kmz = ZipStream()
+        # google earth loads the first kml entry in the archive
+        for out in kmz.iterEntry('doc.kml', self.kmlIterWrapped(chunks)):
+            yield out
+        files = getattr(request, 'files', {})
+        for archiveName, path in sorted(files.iteritems()):
+            # jpegs don't get any smaller
+            for out in kmz.iterFile(archiveName, path):
+                yield out
+        for out in kmz.iterFinish():
+            yield out
+        buildSeconds = time.time() - startTime
+        kmzStatsSingleton.record(kmz.offset, len(files), buildSeconds)
+        print >> sys.stderr, ('ViewKml: sent %d byte kmz with %d thumbnails in %.3f seconds'
+                              % (kmz.offset, len(files), buildSeconds))
+
+    def kmlKmzResponse(self, request, sessionId=None):
+        """
+        Stream a KMZ of the initial KML as it's generated.  Its size
+        isn't known up front, so there's no Content-Length.
+        """
+        if self.kmlIsFlagSet(request, 'thumbnails'):
+            request = KmzRequest(request)
+        return StreamingHttpResponse(self.kmlIterKmz(request,
+                                                     self.kmlIterInitialKml(request, sessionId)),
+                                     content_type=KMZ_CONTENT_TYPE)
 
     def kmlGetUpdateKml(self, request, sessionId):
-        # TODO: implement me -- can use old version of geocam for reference
-        return ''
+        """
+        Send the changes since the session's last update as an <Update>
+        to the features loaded by its initial KML.  Features the client
+        already has get a <Change>.  The rest are replaced with Delete +
+        Create, since <Change> can't add a feature the client hasn't
+        loaded.  We don't track which features each client has: a client
+        that was sent every feature has all those that were servable at
+        its last update, but for a search or bbox session we can't tell
+        which of them matched.
+        """
+        session = kmlSessionStoreSingleton.get(sessionId)
+        if session is None:
+            return self.kmlGetReloadKml(request, sessionId)
+
+        changeSeq = FeatureChange.getLatestSeq()
+        lastSeq = session.getChangeSeq()
+        if lastSeq is None:
+            # session started before changes were tracked.  utime is
+            # local time, change times are UTC.
+            lastSeq = FeatureChange.getSeqAt(TimeUtil.localToUtcTime(session.utime))
+        features = self.kmlGetMatchingFeatures(request, session.getSearchQuery() or '',
+                                               self.kmlGetInitialBbox(session.getInitialUrl()) or '')
+        changed, removedIds = self.search.getDelta(features, str(lastSeq), changeSeq)
+
+        session.utime = datetime.datetime.now()
+        session.setChangeSeq(changeSeq)
+        kmlSessionStoreSingleton.save(session)
+
+        # placemarks come from the stored fragments if they're enabled
+        placemarks = [pair
+                      for batch in self.kmlIterIdPlacemarkBatches(request, changed)
+                      for pair in batch]
+        uuidLookup = dict(changed.values_list('pk', 'uuid'))
+        if self.kmlIsSessionFiltered(session):
+            sentIds = set()
+        else:
+            sentIds = FeatureChange.getServedIds([featureId for featureId, _kml in placemarks],
+                                                 lastSeq)
+        changeKml = []
+        createKml = []
+        deleteUuids = list(FeatureChange.getUuids(removedIds))
+        for featureId, placemarkKml in placemarks:
+            if featureId in sentIds:
+                placemarkKml, numTargets = PLACEMARK_ID_REGEX.subn('<Placemark targetId=',
+                                                                   placemarkKml, 1)
+                if numTargets:
+                    changeKml.append(placemarkKml)
+                    continue
+            deleteUuids.append(uuidLookup.get(featureId))
+            createKml.append(placemarkKml)
+
+        if not (deleteUuids or changeKml):
+            updateKml = ''
+        else:
+            # getKml() uses the feature uuid as the Placemark id
+            deleteKml = ''.join(['<Placemark targetId="%s"/>' % escape(uuid)
+                                 for uuid in deleteUuids
+                                 if uuid])
+            if deleteKml:
+                deleteKml = '<Delete>%s</Delete>' % deleteKml
+            if changeKml:
+                changeKml = '<Change>%s</Change>' % '\n'.join(changeKml)
+            else:
+                changeKml = ''
+            if createKml:
+                createKml = ("""
+    <Create>
+      <Folder targetId="allFeatures">
+        %s
+      </Folder>
+    </Create>
+""" % '\n'.join(createKml))
+            else:
+                createKml = ''
+            updateKml = ("""
+  <Update>
+    <targetHref>%(targetHref)s</targetHref>
+    %(deleteKml)s
+    %(changeKml)s
+    %(createKml)s
+  </Update>
+""" % dict(targetHref=escape(session.getInitialUrl()
+                             or self.kmlGetSessionUrl(request, sessionId, 'initial')),
+           deleteKml=deleteKml,
+           changeKml=changeKml,
+           createKml=createKml))
+            print >> sys.stderr, ('ViewKml: session %s update, %d changed, %d removed'
+                                  % (sessionId, len(placemarks), len(removedIds)))
+
+        return self.kmlGetNetworkLinkControl(updateKml)
+
+    def kmlIsSessionFiltered(self, session):
+        """
+        Whether the session's client was only sent the features matching
+        a search or bbox.
+        """
+        return (bool(session.getSearchQuery())
+                or self.kmlGetInitialBbox(session.getInitialUrl()) is not None)
+
+    def kmlGetInitialBbox(self, initialUrl):
+        """
+        The bbox a session's initial document was loaded with, or None.
+        Updates must match the same features, and the update link
+        doesn't carry it.
+        """
+        params = urlparse.parse_qs(urlparse.urlparse(initialUrl or '').query)
+        for name in ('bbox', 'BBOX'):
+            if params.get(name):
+                return params[name][0]
+        return None
+
+    def kmlGetNetworkLinkControl(self, updateKml):
+        return ("""
+<NetworkLinkControl>
+  <minRefreshPeriod>%(minRefreshPeriod)s</minRefreshPeriod>
+  %(updateKml)s
+</NetworkLinkControl>
+""" % dict(minRefreshPeriod=settings.GEOCAM_LENS_KML_MIN_REFRESH_SECONDS,
+           updateKml=updateKml))
+
+    def kmlIterReloadKml(self, request, sessionId):
+        """
+        Update for a client whose session we have no record of, e.g.
+        one that expired.  We don't know what the client has loaded, so
+        the session starts over and the update replaces all of its
+        features with the current ones matching the session's search
+        and bbox.  Generated in chunks like the initial document, since
+        it can be as large.
+        """
+        initialUrl = (request.GET.get('initial')
+                      or self.kmlGetSessionUrl(request, sessionId, 'initial'))
+        changeSeq = FeatureChange.getLatestSeq()
+        newUtime = datetime.datetime.now()
+        session = kmlSessionStoreSingleton.getOrCreate(sessionId, newUtime)
+        session.utime = newUtime
+        session.setChangeSeq(changeSeq)
+        session.setInitialUrl(initialUrl)
+        kmlSessionStoreSingleton.save(session)
+        print >> sys.stderr, 'ViewKml: session %s unknown, sending full reload' % sessionId
+
+        header, footer = self.kmlGetNetworkLinkControl(WRAP_MARKER).split(WRAP_MARKER)
+        yield header
+        yield """
+  <Update>
+    <targetHref>%(targetHref)s</targetHref>
+    <Delete><Folder targetId="allFeatures"/></Delete>
+    <Create>
+      <Document targetId="allFeaturesDocument">
+""" % dict(targetHref=escape(initialUrl))
+        for chunk in self.kmlIterAllFeaturesFolder(request, session.getSearchQuery() or '',
+                                                   self.kmlGetInitialBbox(initialUrl) or ''):
+            yield chunk
+        yield """
+      </Document>
+    </Create>
+  </Update>
+"""
+        yield footer
+
+    def kmlGetReloadKml(self, request, sessionId):
+        return ''.join(self.kmlIterReloadKml(request, sessionId))
 
     def kmlGetSessionResponse(self, request, quotedId, method):
         sessionId = urllib.unquote_plus(quotedId)
         #print 'sessionId:', sessionId
         #print 'method:', method
         if method == 'initial':
-            return KmlUtil.wrapKmlDjango(self.kmlGetInitialKml(request, sessionId))
+            return self.kmlStreamingResponse(request, self.kmlIterInitialKml(request, sessionId))
         elif method == 'update':
-            return KmlUtil.wrapKmlDjango(self.kmlGetUpdateKml(request, sessionId))
+            if kmlSessionStoreSingleton.get(sessionId) is None:
+                return self.kmlStreamingResponse(request, self.kmlIterReloadKml(request, sessionId))
+            return Compression.compressResponse(request,
+                                                KmlUtil.wrapKmlDjango(self.kmlGetUpdateKml(request, sessionId)))
         else:
             raise Exception('method must be "initial" or "update"')
 
+    def kmzGetSessionResponse(self, request, quotedId, method):
+        sessionId = urllib.unquote_plus(quotedId)
+        if method == 'initial':
+            return self.kmlKmzResponse(request, sessionId)
+        else:
+            raise Exception('method must be "initial"')
+
+    def kmlGetRegion(self, quadKey, minLodPixels, maxLodPixels):
+        west, south, east, north = SpatialIndex.getTileBounds(quadKey)
+        return ("""
+  <Region>
+    <LatLonAltBox>
+      <north>%(north)s</north>
+      <south>%(south)s</south>
+      <east>%(east)s</east>
+      <west>%(west)s</west>
+    </LatLonAltBox>
+    <Lod>
+      <minLodPixels>%(minLodPixels)s</minLodPixels>
+      <maxLodPixels>%(maxLodPixels)s</maxLodPixels>
+    </Lod>
+  </Region>
+""" % dict(north=north, south=south, east=east, west=west,
+           minLodPixels=minLodPixels,
+           maxLodPixels=maxLodPixels))
+
+    def kmlGetTileChildKml(self, request, cell):
+        """
+        A child tile as a marker showing the number of features, which
+        is swapped for the child's own content once the child region is
+        big enough on screen.
+        """
+        lodPixels = settings.GEOCAM_LENS_KML_TILE_LOD_PIXELS
+        lat, lon = cell.getCentroid()
+        tileUrl = request.build_absolute_uri(urlresolvers.reverse('geocamLens_kmlTile',
+                                                                  args=[cell.quadKey]))
+        return ("""
+<Folder>
+  %(markerRegion)s
+  <Placemark>
+    <name>%(count)s</name>
+    <Point>
+      <coordinates>%(lon)s,%(lat)s</coordinates>
+    </Point>
+  </Placemark>
+</Folder>
+<NetworkLink>
+  %(linkRegion)s
+  <Link>
+    <href>%(tileUrl)s</href>
+    <viewRefreshMode>onRegion</viewRefreshMode>
+  </Link>
+</NetworkLink>
+""" % dict(markerRegion=self.kmlGetRegion(cell.quadKey, 0, lodPixels),
+           count=cell.count,
+           lat=lat,
+           lon=lon,
+           linkRegion=self.kmlGetRegion(cell.quadKey, lodPixels, -1),
+           tileUrl=escape(tileUrl)))
+
+    def kmlGetTile(self, request, quadKey, cell):
+        """
+        One tile of the superoverlay.  A tile with few enough features,
+        or at the deepest cluster level, holds their placemarks;
+        otherwise it links to its non-empty child tiles.
+        """
+        if (cell.count <= settings.GEOCAM_LENS_KML_TILE_MAX_FEATURES
+                or len(quadKey) >= settings.GEOCAM_LENS_CLUSTER_MAX_LEVEL):
+            low, high = SpatialIndex.getQuadKeyRange(quadKey)
+            featureIds = (SpatialKey.objects
+                          .filter(clustered=True,
+                                  quadKey__gte=low,
+                                  quadKey__lt=high)
+                          .values('featureId'))
+            features = self.search.getAllFeatures().filter(pk__in=featureIds)
+            contents = '\n'.join([placemark
+                                  for batch in self.kmlIterPlacemarkBatches(request, features)
+                                  for placemark in batch])
+        else:
+            children = (ClusterCell.objects
+                        .filter(quadKey__in=[quadKey + digit for digit in '0123'])
+                        .order_by('quadKey'))
+            contents = ''.join([self.kmlGetTileChildKml(request, child)
+                                for child in children])
+        if quadKey:
+            region = self.kmlGetRegion(quadKey, settings.GEOCAM_LENS_KML_TILE_LOD_PIXELS, -1)
+        else:
+            region = ''
+        return ("""
+<Document>
+  <name>%(name)s</name>
+  %(region)s
+  %(style)s
+  %(contents)s
+</Document>
+""" % dict(name=escape(quadKey or settings.SITE_TITLE),
+           region=region,
+           style=self.kmlGetShareCssStyle(),
+           contents=contents))
+
+    def kmlTile(self, request, quadKey=''):
+        """
+        Region-based superoverlay over the quadtree of ClusterCell, so
+        Google Earth only fetches placemarks for the part of the map in
+        view at a useful zoom.  Covers all processed, non-deleted
+        features.  Tiles are cached until a feature inside them changes.
+        """
+        if len(quadKey) > settings.GEOCAM_LENS_CLUSTER_MAX_LEVEL:
+            raise Http404
+        try:
+            cell = ClusterCell.objects.get(quadKey=quadKey)
+        except ClusterCell.DoesNotExist:
+            return KmlUtil.wrapKmlDjango('<Document><name>%s</name></Document>'
+                                         % escape(quadKey or settings.SITE_TITLE))
+
+        # tiles are cached already compressed, one entry per encoding
+        encoding = Compression.getResponseEncoding(request)
+        if featureCacheSingleton.isEnabled():
+            # tiles contain absolute urls
+            key = ('geocamLens.kmlTile.%s.%s.%s.%s'
+                   % (hashlib.md5(request.build_absolute_uri('/')).hexdigest(),
+                      quadKey or 'root',
+                      encoding or 'identity',
+                      cell.version))
+            body = featureCacheSingleton.get(key)
+            if body is None:
+                body = self.kmlGetTileBody(request, quadKey, cell, encoding)
+                featureCacheSingleton.set(key, body)
+        else:
+            body = self.kmlGetTileBody(request, quadKey, cell, encoding)
+        response = HttpResponse(body, content_type=KML_CONTENT_TYPE)
+        return Compression.setEncodingHeaders(response, encoding)
+
+    def kmlGetTileBody(self, request, quadKey, cell, encoding):
+        body = KmlUtil.wrapKml(self.kmlGetTile(request, quadKey, cell))
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        if encoding:
+            body = Compression.compress(body, encoding)
+        return body
+
+    def kmlSessionStats(self, request):
+        return HttpResponse(json.dumps(kmlSessionStoreSingleton.getStats()),
+                            content_type='application/json')
+
+    def kmzStats(self, request):
+        return HttpResponse(json.dumps(kmzStatsSingleton.getStats()),
+                            content_type='application/json')
+
     def kmlFeed(self, request):
-        return KmlUtil.wrapKmlDjango(self.kmlGetInitialKml(request))
+        return self.kmlStreamingResponse(request, self.kmlIterInitialKml(request))
+
+    def kmzFeed(self, request):
+        response = self.kmlKmzResponse(request)
+        response['Content-Disposition'] = 'attachment; filename=feed.kmz'
+        return response
@@ -8,29 +8,49 @@
 
 import sys
 import os
-import tempfile
+import re
 
-import PIL.Image
-from django.http import HttpResponse, HttpResponseBadRequest
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, Http404, \
+    StreamingHttpResponse
 from django.shortcuts import render
 from django.template import RequestContext
 from django.contrib.auth.models import User
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 from django.views.decorators.csrf import csrf_exempt
 
 from geocamUtil import anyjson as json
 from geocamUtil.icons import cacheIcons
 from geocamUtil.models.UuidField import makeUuid
+from geocamFolder.models import Folder
 
-from geocamLens.models import Image
-from geocamLens.forms import UploadImageForm, EditImageForm
+from geocamLens.models import Image, UploadSession, ClusterCell, FeatureChange, STATUS_PENDING, \
+    pointFeaturesRelationsChangedBulk
+from geocamLens.forms import UploadImageForm, UploadSessionForm, EditImageForm
 from geocamLens.ViewKml import ViewKml
 from geocamLens.SearchAbstract import BadQuery
+from geocamLens.ProcessQueue import enqueueProcess, enqueueProcessBulk, sweepStagingIfDue
+from geocamLens.ThumbnailCache import thumbnailCacheSingleton
+from geocamLens.FeatureCache import featureCacheSingleton
+from geocamLens.FileServe import serveFile
+from geocamLens.BatchSerializer import iterFeatureBatches, iterFragmentBatches
+from geocamLens.Ingest import storeUpload, readImageInfo
+from geocamLens import ResumableUpload
+from geocamLens import ColumnarFormat
+from geocamLens import Compression
 from django.conf import settings
 
 cacheIcons(os.path.join(settings.STATIC_ROOT, 'geocamLens', 'icons', 'map'))
 cacheIcons(os.path.join(settings.STATIC_ROOT, 'geocamLens', 'icons', 'mapr'))
 
 
+FEATURES_CRS = dict(type='name',
+                    properties=dict(name='urn:ogc:def:crs:OGC:1.3:CRS84'))
+
+# number of features serialized per chunk of a streaming response
+STREAM_CHUNK_FEATURES = 100
+
+
 class ViewLensAbstract(ViewKml):
     # override in derived classes
     search = None
@@ -43,55 +63,272 @@ class ViewLensAbstract(ViewKml):
 
     def getMatchingFeatures(self, request):
         query = request.REQUEST.get('q', '')
-        return self.getMatchingFeaturesForQuery(query)
+        features = self.getMatchingFeaturesForQuery(query)
+        bboxText = request.GET.get('bbox')
+        if bboxText:
+            features = self.search.filterBbox(features,
+                                              self.search.parseBbox(bboxText))
+        return features
 
-    def dumps(self, obj):
-        if 1:
+    def dumps(self, obj, pretty=False):
+        if pretty:
             return json.dumps(obj, indent=4, sort_keys=True)  # pretty print for debugging
         else:
             return json.dumps(obj, separators=(',', ':'))  # compact
 
-    def getFeaturesGeoJson(self, request):
-        try:
-            matches = self.getMatchingFeatures(request)
-            errorMessage = None
-        except BadQuery, e:
-            errorMessage = e.message
+    def isPrettyRequested(self, request):
+        return request.GET.get('debug', '') not in ('', '0')
 
+    def getNumFeatures(self, request):
         numFeaturesParam = request.GET.get('n')
         if numFeaturesParam:
             if numFeaturesParam == 'all':
-                numFeatures = None
-            else:
+                return None
+            try:
                 numFeatures = int(numFeaturesParam)
+            except ValueError:
+                raise BadQuery("Oops, can't understand n=%s" % numFeaturesParam)
+            if numFeatures < 0:
+                raise BadQuery("Oops, n=%s can't be negative" % numFeaturesParam)
+            return numFeatures
         else:
-            numFeatures = settings.GEOCAM_LENS_DEFAULT_NUM_FEATURES
-        if numFeatures is not None:
-            matches = matches[:numFeatures]
-
-        if errorMessage:
-            response = {'error': {'code': -32099,
-                                  'message': errorMessage}}
+            return settings.GEOCAM_LENS_DEFAULT_NUM_FEATURES
+
+    def getPageSize(self, request):
+        numFeatures = self.getNumFeatures(request)
+        if numFeatures is None:
+            return settings.GEOCAM_LENS_DEFAULT_PAGE_SIZE
+        if numFeatures <= 0:
+            raise BadQuery("Oops, page size n=%s must be positive" % numFeatures)
+        return numFeatures
+
+    def getParamErrorResponse(self, request):
+        """
+        Returns a 400 response if the features request has a bad n
+        parameter, else None.  Checked before streaming starts, which
+        fixes the status at 200.
+        """
+        try:
+            if request.GET.get('cursor') is not None:
+                self.getPageSize(request)
+            else:
+                self.getNumFeatures(request)
+        except BadQuery, e:
+            return self.getUploadErrorResponse(e.message)
+        return None
+
+    def getFeaturesResult(self, request):
+        """
+        Run the search for a features request.  Returns (features,
+        extras, errorMessage), where @features is a queryset or list to
+        pass to BatchSerializer.iterFeatureBatches() and @extras holds
+        additional FeatureCollection members.
+        """
+        # passing the 'cursor' parameter (empty for the first page)
+        # turns on keyset pagination, with n as the page size
+        cursor = request.GET.get('cursor')
+        # passing the 'since' token from an earlier response returns
+        # only what changed after it, with no limit on the count
+        since = request.GET.get('since')
+        # read the sequence before the search, so a change that lands
+        # during it is sent again next time rather than missed
+        latestSeq = FeatureChange.getLatestSeq()
+        extras = {'since': str(latestSeq)}
+        try:
+            matches = self.getMatchingFeatures(request)
+            numFeatures = self.getNumFeatures(request)
+            if since:
+                matches, extras['deleted'] = self.search.getDelta(matches, since, latestSeq)
+            elif cursor is not None:
+                matches, extras['next'] = self.search.getPage(matches, cursor,
+                                                              self.getPageSize(request))
+            elif numFeatures is not None:
+                matches = matches[:numFeatures]
+        except BadQuery, e:
+            return [], extras, e.message
+        return matches, extras, None
+
+    def iterGeoJsonBatches(self, features):
+        """
+        Yield lists of compact GeoJSON strings for @features, from the
+        stored FeatureFragments if they're enabled.
+        """
+        if settings.GEOCAM_LENS_USE_FRAGMENTS:
+            for batch in iterFragmentBatches(features, STREAM_CHUNK_FEATURES):
+                yield [fragment.geoJson for fragment in batch]
+        else:
+            for batch in iterFeatureBatches(features, STREAM_CHUNK_FEATURES):
+                yield [self.dumps(f.getGeoJson()) for f in batch]
+
+    def getProjectionFields(self, request):
+        """
+        Returns the property names requested with fields=a,b,c, or None
+        for all of them.  The feature id and geometry are always sent.
+        """
+        fieldsText = request.GET.get('fields')
+        if not fieldsText:
+            return None
+        return [name.strip() for name in fieldsText.split(',') if name.strip()]
+
+    def projectGeoJson(self, geoJson, fields):
+        properties = geoJson.get('properties') or {}
+        geoJson['properties'] = dict([(name, properties[name])
+                                      for name in fields
+                                      if name in properties])
+        return geoJson
+
+    def getProjectedGeoJson(self, feature, fields):
+        if hasattr(feature, 'getProjectedGeoJson'):
+            return feature.getProjectedGeoJson(fields)
+        return self.projectGeoJson(feature.getGeoJson(), fields)
+
+    def iterProjectedGeoJsonBatches(self, features, fields):
+        """
+        Like iterGeoJsonBatches() but with only the properties in
+        @fields.  If the image model can build them from a few columns
+        (see Image.getProjectionColumns()), only those columns are
+        loaded.  Otherwise the stored FeatureFragments, if enabled, or
+        the full features are trimmed.
+        """
+        if (settings.GEOCAM_LENS_USE_FRAGMENTS
+                and self.defaultImageModel.getProjectionColumns(fields) is None):
+            for batch in iterFragmentBatches(features, STREAM_CHUNK_FEATURES):
+                yield [self.dumps(self.projectGeoJson(json.loads(fragment.geoJson), fields))
+                       for fragment in batch]
         else:
-            gjFeatures = [f.getGeoJson() for f in matches]
+            for batch in iterFeatureBatches(features, STREAM_CHUNK_FEATURES, fields):
+                yield [self.dumps(self.getProjectedGeoJson(f, fields))
+                       for f in batch]
+
+    def iterFeaturesGeoJson(self, request, pretty=False):
+        """
+        Generate the features response in chunks, so memory use and time
+        to first byte don't grow with the number of features.  Pretty
+        printing needs the whole response at once and is meant for
+        debugging only.
+        """
+        features, extras, errorMessage = self.getFeaturesResult(request)
+        if errorMessage:
+            yield self.dumps({'error': {'code': -32099,
+                                        'message': errorMessage}},
+                             pretty)
+            return
+
+        fields = self.getProjectionFields(request)
+        if pretty:
+            geoJsons = [f.getGeoJson() if fields is None else self.getProjectedGeoJson(f, fields)
+                        for batch in iterFeatureBatches(features, STREAM_CHUNK_FEATURES, fields)
+                        for f in batch]
             featureCollection = dict(type='FeatureCollection',
-                                     crs=dict(type='name',
-                                              properties=dict(name='urn:ogc:def:crs:OGC:1.3:CRS84')),
-                                     features=gjFeatures)
-            response = dict(result=featureCollection)
-        return self.dumps(response)
+                                     crs=FEATURES_CRS,
+                                     features=geoJsons)
+            featureCollection.update(extras)
+            yield self.dumps(dict(result=featureCollection), pretty)
+            return
+
+        yield ('{"result":{"type":"FeatureCollection","crs":%s,"features":['
+               % self.dumps(FEATURES_CRS))
+        if fields is not None:
+            batches = self.iterProjectedGeoJsonBatches(features, fields)
+        else:
+            batches = self.iterGeoJsonBatches(features)
+        sep = ''
+        for batch in batches:
+            yield sep + ','.join(batch)
+            sep = ','
+        yield ']%s}}' % ''.join([',%s:%s' % (self.dumps(k), self.dumps(v))
+                                  for k, v in sorted(extras.iteritems())])
+
+    def getFeaturesGeoJson(self, request, pretty=False):
+        return ''.join(self.iterFeaturesGeoJson(request, pretty))
+
+    def iterFeaturesColumns(self, request):
+        """
+        Generate the features response in the ColumnarFormat encoding.
+        Only the columns it needs are read, no models are loaded.
+        """
+        features, extras, errorMessage = self.getFeaturesResult(request)
+        if errorMessage:
+            yield self.dumps({'error': {'code': -32099,
+                                        'message': errorMessage}})
+            return
+
+        columns = ('pk',
+                   self.search.latField,
+                   self.search.lonField,
+                   self.search.timeField,
+                   'icon')
+        if hasattr(features, 'values_list'):
+            rows = features.values_list(*columns).iterator()
+        else:
+            rows = ([getattr(f, name) for name in columns] for f in features)
+        for chunk in ColumnarFormat.encodeColumns(rows, extras):
+            yield chunk
+
+    def getCachedChunks(self, request, kind, chunks):
+        """
+        Returns (chunks, cacheStatus, encoding) for a @kind of features
+        response generated by @chunks, compressed with the content
+        coding negotiated for @request, if any.  Responses are cached
+        compressed, so compression costs CPU once per cache generation.
+        """
+        encoding = Compression.getResponseEncoding(request)
+        if encoding:
+            chunks = Compression.iterCompressed(chunks, encoding)
+        if not featureCacheSingleton.isEnabled():
+            return chunks, 'off', encoding
+        # get the key before running the query, so a change that lands
+        # while we're working invalidates what we store
+        key = featureCacheSingleton.getKey(kind, request, encoding)
+        content = featureCacheSingleton.get(key)
+        if content is not None:
+            return [content], 'hit', encoding
+        return featureCacheSingleton.iterAndStore(key, chunks), 'miss', encoding
+
+    def getFeaturesResponse(self, chunks, cacheStatus, encoding, contentType):
+        response = StreamingHttpResponse(chunks, content_type=contentType)
+        response['X-Feature-Cache'] = cacheStatus
+        return Compression.setEncodingHeaders(response, encoding)
 
     def featuresJson(self, request):
-        return HttpResponse(self.getFeaturesGeoJson(request),
-                            mimetype='application/json')
+        errorResponse = self.getParamErrorResponse(request)
+        if errorResponse is not None:
+            return errorResponse
+        # format=columns selects the compact binary encoding for large
+        # map layers, see ColumnarFormat
+        if request.GET.get('format') == 'columns':
+            chunks, cacheStatus, encoding = self.getCachedChunks(request, 'featureColumns',
+                                                                 self.iterFeaturesColumns(request))
+            contentType = 'application/octet-stream'
+        else:
+            chunks, cacheStatus, encoding = self.getCachedChunks(request, 'features',
+                                                                 self.iterFeaturesGeoJson(request,
+                                                                                          self.isPrettyRequested(request)))
+            contentType = 'application/json'
+        return self.getFeaturesResponse(chunks, cacheStatus, encoding, contentType)
+
+    def iterFeaturesJsonJs(self, chunks):
+        yield 'geocamAware.handleNewFeatures('
+        for chunk in chunks:
+            yield chunk
+        yield ');\n'
 
     def featuresJsonJs(self, request):
-        response = self.getFeaturesGeoJson(request)
-        return HttpResponse('geocamAware.handleNewFeatures(%s);\n' % response,
-                            mimetype='text/javascript')
+        errorResponse = self.getParamErrorResponse(request)
+        if errorResponse is not None:
+            return errorResponse
+        chunks, cacheStatus, encoding = \
+            self.getCachedChunks(request, 'featuresJs',
+                                 self.iterFeaturesJsonJs(self.iterFeaturesGeoJson(request,
+                                                                                  self.isPrettyRequested(request))))
+        return self.getFeaturesResponse(chunks, cacheStatus, encoding, 'text/javascript')
+
+    def featureCacheStats(self, request):
+        return HttpResponse(json.dumps(featureCacheSingleton.getStats()),
+                            content_type='application/json')
 
     def galleryDebug(self, request):
-        return HttpResponse('<body><pre>%s</pre></body>' % self.getFeaturesGeoJson(request))
+        return HttpResponse('<body><pre>%s</pre></body>' % self.getFeaturesGeoJson(request, pretty=True))
 
     def getExportSettings(self):
         exportedVars = ['SCRIPT_NAME',
@@ -144,6 +381,108 @@ class ViewLensAbstract(ViewKml):
     def uploadImageAuth(self, request):
         return self.uploadImage(request, request.user.username)
 
+    def importUpload0(self, formData, author, name, imageInfo, existingImg,
+                      folderLookup=None):
+        """
+        Create or update and save the image record for an upload.
+        @existingImg is the image with the same uuid, or None.  Returns
+        (img, needsProcessing).
+        """
+        formData['name'] = name
+        formData['author'] = author
+        if existingImg is not None:
+            # if the incoming uuid matches an existing uuid, this is
+            # either (1) a duplicate upload of the same image or (2)
+            # the next higher resolution level in an incremental
+            # upload.
+            img = existingImg
+            print >> sys.stderr, 'upload: photo %s with same uuid %s posted' % (img.name, img.uuid)
+            newVersion = img.version + 1
+        else:
+            # create Image db record
+            img = self.defaultImageModel()  # pylint: disable=E1102
+            img.readImportVals(imageInfo=imageInfo,
+                               uploadImageFormData=formData,
+                               folderLookup=folderLookup)
+
+            # set version
+            newVersion = 0
+
+        newRes = (imageInfo['widthPixels'], imageInfo['heightPixels'])
+
+        if existingImg is not None:
+            oldRes = (img.widthPixels, img.heightPixels)
+            if newRes > oldRes:
+                print >> sys.stderr, 'upload: resolution increased from %d to %d' % (oldRes[0], newRes[0])
+                img.widthPixels, img.heightPixels = newRes
+                img.processed = False
+                needsProcessing = True
+            else:
+                print >> sys.stderr, 'upload: ignoring dupe, but telling the client it was received so it stops trying'
+                # a pending image already has a job queued
+                needsProcessing = (not img.processed
+                                   and img.status != STATUS_PENDING)
+        else:
+            img.widthPixels, img.heightPixels = newRes
+            needsProcessing = True
+
+        if needsProcessing:
+            img.version = newVersion
+            if settings.GEOCAM_LENS_PROCESS_IN_BACKGROUND:
+                img.status = STATUS_PENDING
+            # make sure the image gets an id if it doesn't already have one --
+            # the id will be used in process() to calculate the storage path
+            img.save()
+        return img, needsProcessing
+
+    def importUpload(self, tempStorePath, formData, author, name):
+        """
+        Create or update the image record for the staged upload at
+        @tempStorePath and process it (or queue it for processing).
+        @formData is cleaned UploadImageForm data.  Consumes
+        @tempStorePath and returns the image.
+        """
+        # parse the header once for everything the import needs
+        imageInfo = readImageInfo(tempStorePath)
+
+        uuid = formData.setdefault('uuid', makeUuid())
+        uuidMatches = self.defaultImageModel.objects.filter(uuid=uuid)
+        if uuidMatches.count() > 0:
+            existingImg = uuidMatches.get()
+        else:
+            existingImg = None
+        img, needsProcessing = self.importUpload0(formData, author, name,
+                                                  imageInfo, existingImg)
+
+        queued = False
+        if needsProcessing:
+            # generate thumbnails and any other processing
+            if settings.GEOCAM_LENS_PROCESS_IN_BACKGROUND:
+                # hand off to the worker pool, which takes
+                # ownership of the temp file
+                enqueueProcess(img, importFile=tempStorePath)
+                queued = True
+                print >> sys.stderr, 'upload: queued photo %s for processing' % img.name
+            else:
+                img.process(importFile=tempStorePath, moveImportFile=True)
+                img.save()
+
+        if not queued and os.path.exists(tempStorePath):
+            # not moved into place by process(), e.g. a dupe
+            os.unlink(tempStorePath)
+
+        sweepStagingIfDue()
+        return img
+
+    def getUploadPostedResponse(self, img):
+        # swfupload requires non-empty response text.
+        # also added a text pattern (in html comment) for clients to check against to make sure
+        # photo has actually arrived in share.  we also put a matching line in the error log so we
+        # never again run into the issue that the phone thinks it successfully uploaded but there
+        # is no record of the http post on the server.
+        print >> sys.stderr, 'GEOCAM_SHARE_POSTED %s' % img.name
+        return HttpResponse('file posted <!--\nGEOCAM_SHARE_POSTED %s\n-->' % img.name)
+
     def uploadImage(self, request, userName):
         author = User.objects.get(username=userName)
         if request.method == 'POST':
@@ -153,77 +492,16 @@ class ViewLensAbstract(ViewKml):
             if form.is_valid():
                 incoming = request.FILES['photo']
 
-                # store image data in temp file
-                fd, tempStorePath = tempfile.mkstemp('-uploadImage.jpg')
-                os.close(fd)
-                storeFile = file(tempStorePath, 'wb')
-                for chunk in incoming.chunks():
-                    storeFile.write(chunk)
-                storeFile.close()
-                print >> sys.stderr, 'upload: saved image data to temp file:', tempStorePath
-
-                # create image db record
-                uuid = form.cleaned_data.setdefault('uuid', makeUuid())
-                form.cleaned_data['name'] = incoming.name
-                form.cleaned_data['author'] = author
-                uuidMatches = self.defaultImageModel.objects.filter(uuid=uuid)
-                sameUuid = (uuidMatches.count() > 0)
-                if sameUuid:
-                    # if the incoming uuid matches an existing uuid, this is
-                    # either (1) a duplicate upload of the same image or (2)
-                    # the next higher resolution level in an incremental
-                    # upload.
-                    img = uuidMatches.get()
-                    print >> sys.stderr, 'upload: photo %s with same uuid %s posted' % (img.name, img.uuid)
-                    newVersion = img.version + 1
-                else:
-                    # create Image db record
-                    img = self.defaultImageModel()  # pylint: disable=E1102
-                    img.readImportVals(storePath=tempStorePath,
-                                       uploadImageFormData=form.cleaned_data)
-
-                    # set version
-                    newVersion = 0
-
-                # check the new image file on disk to get the dimensions
-                im = PIL.Image.open(tempStorePath, 'r')
-                newRes = im.size
-                del im
-
-                if sameUuid:
-                    oldRes = (img.widthPixels, img.heightPixels)
-                    if newRes > oldRes:
-                        print >> sys.stderr, 'upload: resolution increased from %d to %d' % (oldRes[0], newRes[0])
-                        img.widthPixels, img.heightPixels = newRes
-                        img.processed = False
-                    else:
-                        print >> sys.stderr, 'upload: ignoring dupe, but telling the client it was received so it stops trying'
-                else:
-                    img.widthPixels, img.heightPixels = newRes
-
-                if not img.processed:
-                    # generate thumbnails and any other processing
-                    # (better to do this part in the background, but we
-                    # don't have that set up yet)
-                    img.version = newVersion
-                    # make sure the image gets an id if it doesn't already have one --
-                    # the id will be used in process() to calculate the storage path
-                    img.save()
-                    img.process(importFile=tempStorePath)
-                    img.save()
-
-                # after import by process(), can delete redundant temp copy
-                os.unlink(tempStorePath)
+                # store image data in the staging dir, on the same
+                # filesystem as DATA_DIR so process() can move it into place
+                tempStorePath = storeUpload(incoming)
+                print >> sys.stderr, 'upload: saved image data to staging file:', tempStorePath
 
-                print >> sys.stderr, 'upload image end'
+                img = self.importUpload(tempStorePath, form.cleaned_data,
+                                        author, incoming.name)
 
-                # swfupload requires non-empty response text.
-                # also added a text pattern (in html comment) for clients to check against to make sure
-                # photo has actually arrived in share.  we also put a matching line in the error log so we
-                # never again run into the issue that the phone thinks it successfully uploaded but there
-                # is no record of the http post on the server.
-                print >> sys.stderr, 'GEOCAM_SHARE_POSTED %s' % img.name
-                return HttpResponse('file posted <!--\nGEOCAM_SHARE_POSTED %s\n-->' % img.name)
+                print >> sys.stderr, 'upload image end'
+                return self.getUploadPostedResponse(img)
 
             else:
                 print >> sys.stderr, "form is invalid"
@@ -245,7 +523,367 @@ class ViewLensAbstract(ViewKml):
         return resp
 
     def viewPhoto(self, request, imgId):
-        # this is not very efficient
-        img = Image.objects.get(id=imgId)
-        imgData = file(img.getImagePath(), 'r').read()
-        return HttpResponse(imgData, mimetype='image/jpeg')
+        try:
+            img = Image.objects.get(id=imgId)
+        except ObjectDoesNotExist:
+            raise Http404
+        return serveFile(request, img.getImagePath(), 'image/jpeg')
+
+    def viewThumbnail(self, request, imgId, width):
+        width = int(width)
+        try:
+            img = Image.objects.get(id=imgId)
+        except ObjectDoesNotExist:
+            raise Http404
+        if width not in img.getServableThumbWidths():
+            raise Http404
+
+        # a prebuilt width may be missing if the image was processed
+        # before GEOCAM_LENS_THUMB_SIZES changed, render it on demand
+        prebuiltPath = img.getThumbnailPath(width)
+        if os.path.exists(prebuiltPath):
+            thumbPath, cacheStatus = prebuiltPath, 'prebuilt'
+        else:
+            thumbPath, hit = thumbnailCacheSingleton.getThumbnail(img, width)
+            cacheStatus = 'hit' if hit else 'miss'
+        response = serveFile(request, thumbPath, 'image/jpeg')
+        response['X-Thumbnail-Cache'] = cacheStatus
+        return response
+
+    def thumbnailCacheStats(self, request):
+        return HttpResponse(json.dumps(thumbnailCacheSingleton.getStats()),
+                            content_type='application/json')
+
+    def getUploadSessionResponse(self, session, status=200):
+        return HttpResponse(json.dumps({'result': {'uuid': session.uuid,
+                                                   'offset': session.getReceivedBytes(),
+                                                   'size': session.totalBytes}}),
+                            content_type='application/json',
+                            status=status)
+
+    def getUploadErrorResponse(self, message, status=400, data=None):
+        error = {'code': -32099,
+                 'message': message}
+        if data is not None:
+            error['data'] = data
+        return HttpResponse(json.dumps({'error': error}),
+                            content_type='application/json',
+                            status=status)
+
+    def getUploadSession(self, request, uuid):
+        try:
+            return UploadSession.objects.get(uuid=uuid, author=request.user)
+        except UploadSession.DoesNotExist:
+            raise Http404
+
+    @csrf_exempt
+    def resumableUploadStart(self, request):
+        if request.method != 'POST':
+            return HttpResponseNotAllowed(['POST'])
+        form = UploadSessionForm(request.POST)
+        if not form.is_valid():
+            return self.getUploadErrorResponse('invalid value in form field',
+                                               data=form._get_errors())
+        uuid = form.cleaned_data['uuid']
+        try:
+            session = ResumableUpload.startSession(request.user,
+                                                   uuid,
+                                                   form.cleaned_data['filename'] or ('%s.jpg' % uuid),
+                                                   form.cleaned_data['size'],
+                                                   request.POST.dict())
+        except ResumableUpload.UploadStartError, e:
+            return self.getUploadErrorResponse(str(e), status=e.status)
+        return self.getUploadSessionResponse(session)
+
+    @csrf_exempt
+    def resumableUpload(self, request, uuid):
+        """
+        GET returns the number of bytes received so far.  PUT writes the
+        request body at the offset given by the 'offset' parameter or
+        the Content-Range header.
+        """
+        session = self.getUploadSession(request, uuid)
+        if request.method in ('GET', 'HEAD'):
+            return self.getUploadSessionResponse(session)
+        elif request.method not in ('PUT', 'POST'):
+            return HttpResponseNotAllowed(['GET', 'PUT'])
+
+        offsetParam = request.GET.get('offset')
+        contentRange = request.META.get('HTTP_CONTENT_RANGE', '')
+        rangeMatch = re.search(r'^bytes (\d+)-', contentRange)
+        if offsetParam is not None and offsetParam.isdigit():
+            offset = int(offsetParam)
+        elif rangeMatch:
+            offset = int(rangeMatch.group(1))
+        else:
+            return self.getUploadErrorResponse('missing offset parameter or Content-Range header')
+        try:
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            return self.getUploadErrorResponse('invalid Content-Length header')
+
+        try:
+            ResumableUpload.writeChunk(session, offset, request, length)
+        except ResumableUpload.UploadOffsetError, e:
+            return self.getUploadErrorResponse(str(e), status=409,
+                                               data={'offset': e.offset})
+        return self.getUploadSessionResponse(session)
+
+    @csrf_exempt
+    def resumableUploadFinalize(self, request, uuid):
+        if request.method != 'POST':
+            return HttpResponseNotAllowed(['POST'])
+        session = self.getUploadSession(request, uuid)
+        if not ResumableUpload.isComplete(session):
+            return self.getUploadErrorResponse('upload incomplete', status=409,
+                                               data={'offset': session.getReceivedBytes()})
+        form = UploadSessionForm(json.loads(session.formData))
+        if not form.is_valid():
+            return self.getUploadErrorResponse('invalid value in form field',
+                                               data=form._get_errors())
+        # keep the session until the import succeeds, so a failed
+        # finalize can be retried
+        img = self.importUpload(session.stagingPath, form.cleaned_data,
+                                session.author, session.name)
+        ResumableUpload.finishSession(session)
+        print >> sys.stderr, 'upload: finalized resumable upload %s' % uuid
+        return self.getUploadPostedResponse(img)
+
+    def getFolderLookup(self, folderNames):
+        """
+        Resolve @folderNames to Folder objects with one query.  The None
+        key maps to the default folder.
+        """
+        folderNames = [f for f in set(folderNames) if f]
+        lookup = dict(((f.name, f)
+                       for f in Folder.objects.filter(name__in=folderNames)))
+        lookup[None] = Folder.objects.get(id=1)
+        return lookup
+
+    def addFoldersBulk(self, imgs):
+        """
+        Link each newly created image in @imgs to the folders that
+        readImportVals() stored in its _folders attribute, with one
+        insert for all of them.
+        """
+        foldersField = self.defaultImageModel._meta.get_field('folders')
+        through = foldersField.rel.through
+        fromName = foldersField.m2m_column_name()
+        toName = foldersField.m2m_reverse_name()
+        links = []
+        for img in imgs:
+            for folder in getattr(img, '_folders', []):
+                links.append(through(**{fromName: img.id,
+                                        toName: folder.id}))
+        through.objects.bulk_create(links)
+        # bulk_create sends no m2m_changed signal, so refresh the
+        # fragments the signal handler would have
+        pointFeaturesRelationsChangedBulk(imgs)
+
+    def setBatchItemError(self, entry, message):
+        entry['status']['status'] = 'error'
+        entry['status']['message'] = message
+
+    @csrf_exempt
+    def uploadBatch(self, request):
+        """
+        Upload many photos in one request.  The 'metadata' field is a
+        JSON list with one dict of UploadImageForm fields per photo, where
+        the 'photo' entry names the file field holding the image data.
+        Returns a list with the status of each item.
+        """
+        if request.method != 'POST':
+            return HttpResponseNotAllowed(['POST'])
+        author = request.user
+        try:
+            items = json.loads(request.POST.get('metadata', ''))
+            if not isinstance(items, list):
+                raise ValueError('metadata must be a list')
+        except ValueError, e:
+            return self.getUploadErrorResponse('bad metadata field: %s' % e)
+        if len(items) > settings.GEOCAM_LENS_MAX_BATCH_UPLOAD_ITEMS:
+            return self.getUploadErrorResponse('too many items in batch, limit is %d'
+                                               % settings.GEOCAM_LENS_MAX_BATCH_UPLOAD_ITEMS)
+        print >> sys.stderr, 'upload batch start: %d items' % len(items)
+
+        # validate and stage every item.  A bad item gets an error
+        # status without failing the rest of the batch.
+        statuses = []
+        staged = []
+        for i, item in enumerate(items):
+            if not isinstance(item, dict):
+                statuses.append({'index': i,
+                                 'uuid': None,
+                                 'status': 'error',
+                                 'message': 'metadata entry must be an object'})
+                continue
+            fileField = item.get('photo')
+            if not isinstance(fileField, basestring):
+                fileField = None
+            form = UploadImageForm(item, {'photo': request.FILES.get(fileField)})
+            if not form.is_valid():
+                statuses.append({'index': i,
+                                 'uuid': item.get('uuid'),
+                                 'status': 'error',
+                                 'message': 'invalid value in form field',
+                                 'data': form._get_errors()})
+                continue
+            incoming = request.FILES[fileField]
+            tempStorePath = None
+            try:
+                tempStorePath = storeUpload(incoming)
+                imageInfo = readImageInfo(tempStorePath)
+            except Exception, e:  # pylint: disable=W0703
+                print >> sys.stderr, 'upload batch: could not read item %d: %s' % (i, e)
+                if tempStorePath is not None and os.path.exists(tempStorePath):
+                    os.unlink(tempStorePath)
+                statuses.append({'index': i,
+                                 'uuid': item.get('uuid'),
+                                 'status': 'error',
+                                 'message': "can't read image data: %s" % e})
+                continue
+            formData = form.cleaned_data
+            if not formData.get('uuid'):
+                formData['uuid'] = makeUuid()
+            status = {'index': i, 'uuid': formData['uuid']}
+            statuses.append(status)
+            staged.append(dict(status=status,
+                               tempStorePath=tempStorePath,
+                               formData=formData,
+                               name=incoming.name,
+                               imageInfo=imageInfo))
+
+        queuedPaths = set()
+        try:
+            # one query each for existing uuids and folders
+            existing = dict(((img.uuid, img)
+                             for img in (self.defaultImageModel.objects
+                                         .filter(uuid__in=[entry['formData']['uuid']
+                                                           for entry in staged]))))
+            folderLookup = self.getFolderLookup([entry['formData'].get('folder')
+                                                 for entry in staged])
+
+            toProcess = []
+            processByUuid = {}
+            with transaction.atomic():
+                newImgs = []
+                for entry in staged:
+                    uuid = entry['formData']['uuid']
+                    existingImg = existing.get(uuid)
+                    try:
+                        # a savepoint per item, so one bad row doesn't
+                        # roll back the rest of the batch
+                        with transaction.atomic():
+                            img, needsProcessing = self.importUpload0(entry['formData'], author,
+                                                                      entry['name'], entry['imageInfo'],
+                                                                      existingImg,
+                                                                      folderLookup=folderLookup)
+                    except Exception, e:  # pylint: disable=W0703
+                        print >> sys.stderr, 'upload batch: could not import item %d: %s' \
+                            % (entry['status']['index'], e)
+                        self.setBatchItemError(entry, "can't import image: %s" % e)
+                        # importUpload0() may have changed the instance
+                        # before the save failed
+                        if existingImg is not None:
+                            existing[uuid] = self.defaultImageModel.objects.get(pk=existingImg.pk)
+                        continue
+                    # later items in the batch may repeat this uuid
+                    existing[img.uuid] = img
+                    entry['img'] = img
+                    if existingImg is None:
+                        newImgs.append(img)
+                    if needsProcessing:
+                        # only the last copy of a uuid repeated in the batch
+                        # gets processed
+                        if img.uuid in processByUuid:
+                            toProcess.remove(processByUuid[img.uuid])
+                        processByUuid[img.uuid] = entry
+                        toProcess.append(entry)
+                        entry['status']['status'] = 'posted'
+                    else:
+                        entry['status']['status'] = 'duplicate'
+                self.addFoldersBulk(newImgs)
+                if settings.GEOCAM_LENS_PROCESS_IN_BACKGROUND:
+                    enqueueProcessBulk([(entry['img'], entry['tempStorePath'])
+                                        for entry in toProcess])
+
+            if not settings.GEOCAM_LENS_PROCESS_IN_BACKGROUND:
+                for entry in toProcess:
+                    try:
+                        entry['img'].process(importFile=entry['tempStorePath'], moveImportFile=True)
+                        entry['img'].save()
+                    except Exception, e:  # pylint: disable=W0703
+                        # the row stays unprocessed, so a retry of the
+                        # same uuid processes it again
+                        print >> sys.stderr, 'upload batch: could not process item %d: %s' \
+                            % (entry['status']['index'], e)
+                        self.setBatchItemError(entry, "can't process image: %s" % e)
+            else:
+                queuedPaths = set([entry['tempStorePath'] for entry in toProcess])
+        finally:
+            # the worker owns queued files, the rest are dupes, already
+            # moved into place, or left over from a failed batch
+            for entry in staged:
+                if entry['tempStorePath'] not in queuedPaths and os.path.exists(entry['tempStorePath']):
+                    os.unlink(entry['tempStorePath'])
+
+        sweepStagingIfDue()
+        for entry in staged:
+            if entry['status']['status'] != 'error':
+                print >> sys.stderr, 'GEOCAM_SHARE_POSTED %s' % entry['img'].name
+        print >> sys.stderr, 'upload batch end'
+        return HttpResponse(json.dumps({'result': statuses}),
+                            content_type='application/json')
+
+    def getClusters(self, zoom, bbox=None):
+        """
+        Returns the precomputed clusters for map zoom level @zoom inside
+        @bbox, with a representative thumbnail for each.
+        """
+        level = max(0, min(zoom + settings.GEOCAM_LENS_CLUSTER_ZOOM_OFFSET,
+                           settings.GEOCAM_LENS_CLUSTER_MAX_LEVEL))
+        cells = ClusterCell.objects.filter(level=level)
+        if bbox is not None:
+            cells = cells.filter(self.search.getQuadKeyFilter(bbox, maxLevel=level))
+        cells = list(cells)
+
+        repIds = [c.representativeId for c in cells if c.representativeId is not None]
+        reps = dict(((img.pk, img)
+                     for img in self.defaultImageModel.objects.filter(pk__in=repIds)))
+        thumbWidth = settings.GEOCAM_AWARE_GALLERY_THUMB_SIZE[0]
+
+        clusters = []
+        for cell in cells:
+            latitude, longitude = cell.getCentroid()
+            rep = reps.get(cell.representativeId)
+            if rep is None:
+                repInfo = None
+            else:
+                repInfo = dict(localId=rep.pk,
+                               thumbnailUrl=rep.getThumbnailUrl(thumbWidth))
+            clusters.append(dict(quadKey=cell.quadKey,
+                                 count=cell.count,
+                                 latitude=latitude,
+                                 longitude=longitude,
+                                 representative=repInfo))
+        return dict(level=level, clusters=clusters)
+
+    def clustersJson(self, request):
+        try:
+            try:
+                zoom = int(request.GET.get('zoom', 0))
+            except ValueError:
+                raise BadQuery("Oops, can't understand zoom=%s" % request.GET.get('zoom'))
+            bboxText = request.GET.get('bbox')
+            if bboxText:
+                bbox = self.search.parseBbox(bboxText)
+            else:
+                bbox = None
+            response = dict(result=self.getClusters(zoom, bbox))
+        except BadQuery, e:
+            response = {'error': {'code': -32099,
+                                  'message': e.message}}
+        return HttpResponse(self.dumps(response, self.isPrettyRequested(request)),
+                            content_type='application/json')
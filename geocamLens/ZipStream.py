@@ -0,0 +1,149 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Write a zip archive as a stream of chunks, so a KMZ response can start
+before the archive is complete.  The zipfile module needs each entry's
+data up front.  Here an entry generated on the fly is deflated as it
+goes, with its CRC and sizes in a data descriptor after the data.
+Files already on disk are stored with their sizes in the header.  No
+zip64 support, so entries and the archive are limited to 4 GB.
+"""
+
+import os
+import time
+import zlib
+import struct
+
+from geocamLens.FileServe import BLOCK_SIZE
+
+# pylint: disable=C1001
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# general purpose flag: CRC and sizes follow the data
+FLAG_DATA_DESCRIPTOR = 0x08
+
+ZIP_VERSION = 20
+
+LOCAL_HEADER_SIGNATURE = 0x04034b50
+DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+CENTRAL_HEADER_SIGNATURE = 0x02014b50
+END_SIGNATURE = 0x06054b50
+
+# regular file, rw-r--r--
+EXTERNAL_ATTR = 0100644 << 16
+
+
+def getDosTime(timestamp):
+    t = time.localtime(timestamp)
+    dosDate = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    dosTime = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    return dosTime, dosDate
+
+
+class ZipStream(object):
+    def __init__(self):
+        self.offset = 0
+        # (name, flags, method, dosTime, dosDate, crc, compressedSize,
+        #  size, headerOffset) for the central directory
+        self.entries = []
+
+    def getLocalHeader(self, name, flags, method, dosTime, dosDate, crc, compressedSize, size):
+        return (struct.pack('<IHHHHHIIIHH',
+                            LOCAL_HEADER_SIGNATURE, ZIP_VERSION, flags, method,
+                            dosTime, dosDate, crc, compressedSize, size,
+                            len(name), 0)
+                + name)
+
+    def emit(self, data):
+        self.offset += len(data)
+        return data
+
+    def iterEntry(self, name, chunks):
+        """
+        Yield a deflated entry @name holding the data generated in
+        @chunks.
+        """
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        headerOffset = self.offset
+        dosTime, dosDate = getDosTime(time.time())
+        yield self.emit(self.getLocalHeader(name, FLAG_DATA_DESCRIPTOR, ZIP_DEFLATED,
+                                            dosTime, dosDate, 0, 0, 0))
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        crc = 0
+        size = 0
+        compressedSize = 0
+        for chunk in chunks:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            out = compressor.compress(chunk)
+            if out:
+                compressedSize += len(out)
+                yield self.emit(out)
+        out = compressor.flush()
+        compressedSize += len(out)
+        yield self.emit(out)
+        crc &= 0xffffffff
+        yield self.emit(struct.pack('<IIII', DATA_DESCRIPTOR_SIGNATURE,
+                                    crc, compressedSize, size))
+        self.entries.append((name, FLAG_DATA_DESCRIPTOR, ZIP_DEFLATED, dosTime, dosDate,
+                             crc, compressedSize, size, headerOffset))
+
+    def iterFile(self, name, path):
+        """
+        Yield a stored (uncompressed) entry @name with the contents of
+        the file at @path.  The file is read twice, once for its CRC,
+        so it should be small, e.g. a thumbnail.
+        """
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        crc = 0
+        size = 0
+        f = open(path, 'rb')
+        try:
+            for block in iter(lambda: f.read(BLOCK_SIZE), ''):
+                crc = zlib.crc32(block, crc)
+                size += len(block)
+            crc &= 0xffffffff
+            headerOffset = self.offset
+            dosTime, dosDate = getDosTime(os.path.getmtime(path))
+            yield self.emit(self.getLocalHeader(name, 0, ZIP_STORED,
+                                                dosTime, dosDate, crc, size, size))
+            f.seek(0)
+            remaining = size
+            while remaining > 0:
+                # the file may have shrunk since we read its CRC
+                block = f.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    raise IOError('%s changed while adding it to the archive' % path)
+                remaining -= len(block)
+                yield self.emit(block)
+        finally:
+            f.close()
+        self.entries.append((name, 0, ZIP_STORED, dosTime, dosDate,
+                             crc, size, size, headerOffset))
+
+    def iterFinish(self):
+        """
+        Yield the central directory, which ends the archive.
+        """
+        centralOffset = self.offset
+        for (name, flags, method, dosTime, dosDate,
+             crc, compressedSize, size, headerOffset) in self.entries:
+            yield self.emit(struct.pack('<IHHHHHHIIIHHHHHII',
+                                        CENTRAL_HEADER_SIGNATURE, ZIP_VERSION, ZIP_VERSION,
+                                        flags, method, dosTime, dosDate,
+                                        crc, compressedSize, size,
+                                        len(name), 0, 0, 0, 0, EXTERNAL_ATTR, headerOffset)
+                            + name)
+        yield self.emit(struct.pack('<IHHHHIIH', END_SIGNATURE, 0, 0,
+                                    len(self.entries), len(self.entries),
+                                    self.offset - centralOffset, centralOffset, 0))
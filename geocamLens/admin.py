@@ -11,3 +11,5 @@ from geocamLens.models import *  # pylint: disable=W0401
 admin.site.register(Snapshot)
 admin.site.register(GoogleEarthSession)
 admin.site.register(Photo)
+admin.site.register(ProcessingJob)
+admin.site.register(UploadSession)
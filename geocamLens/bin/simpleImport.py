@@ -25,6 +25,7 @@ from geocamFolder.models import Folder
 
 from geocamLens.UploadClient import UploadClient
 from geocamLens.models import Photo
+from geocamLens.Ingest import readImageInfo
 from django.conf import settings
 
 
@@ -53,7 +54,8 @@ def importImageDirect(imagePath, attributes):
         print 'skipping already imported', unicode(matchingPhotos[0])
     else:
         photo = Photo()
-        photo.readImportVals(storePath=imagePath, uploadImageFormData=attributes)
+        imageInfo = readImageInfo(imagePath)
+        photo.readImportVals(imageInfo=imageInfo, uploadImageFormData=attributes)
         photo.save()
 
         # must defer saving m2m fields until after base object is in db
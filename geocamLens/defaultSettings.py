@@ -8,6 +8,46 @@ GEOCAM_LENS_DEFAULT_ICON = 'camera'
 
 GEOCAM_LENS_KML_FLY_TO_VIEW = True
 
+# How often Google Earth sessions poll for incremental updates, in
+# seconds.  None turns off the update link, so sessions only reload.
+GEOCAM_LENS_KML_UPDATE_SECONDS = 30
+
+# Minimum interval between polls that the server asks Google Earth to
+# respect, in seconds.
+GEOCAM_LENS_KML_MIN_REFRESH_SECONDS = 10
+
+# Superoverlay tiles (kml/tiles/t.kml) with no more than this many
+# features hold their placemarks instead of linking to child tiles.
+GEOCAM_LENS_KML_TILE_MAX_FEATURES = 100
+
+# Size on screen, in pixels, at which Google Earth loads a superoverlay
+# tile in place of its parent's marker for it.
+GEOCAM_LENS_KML_TILE_LOD_PIXELS = 256
+
+# Where Google Earth session state is kept between polls: 'db' reads and
+# writes a GoogleEarthSession row on every poll, 'cache' keeps sessions
+# in the Django cache GEOCAM_LENS_KML_SESSION_CACHE and writes them
+# back to the db in batches.  Use a cache shared between processes
+# (e.g. memcached) with 'cache' if you run more than one server process:
+# the default per-process LocMemCache only holds that process's polls,
+# so its copies can be behind and its sweeps can't see other processes'
+# sessions.
+GEOCAM_LENS_KML_SESSION_STORE = 'cache'
+GEOCAM_LENS_KML_SESSION_CACHE = 'default'
+
+# Sessions that haven't polled for this many seconds are deleted.
+GEOCAM_LENS_KML_SESSION_TTL_SECONDS = 24 * 60 * 60
+
+# With the 'cache' store, changed sessions are written back to the db
+# once this many are pending, or at the end of a request once this many
+# seconds have passed.
+GEOCAM_LENS_KML_SESSION_WRITE_BACK_BATCH = 100
+GEOCAM_LENS_KML_SESSION_WRITE_BACK_SECONDS = 60
+
+# How often expired sessions are swept from the db, in seconds.
+# lensWorker also sweeps them at startup.
+GEOCAM_LENS_KML_SESSION_SWEEP_SECONDS = 60 * 60
+
 GEOCAM_LENS_RENDER_SVG_ICONS = True
 
 GEOCAM_LENS_VIEW_MODULE = 'geocamLens.ViewLensSimple'
@@ -16,3 +56,126 @@ GEOCAM_LENS_VIEW_MODULE = 'geocamLens.ViewLensSimple'
 # return all features. You can override the limit with the URL parameter
 # n. For example, "?n=100" or "?n=all".
 GEOCAM_LENS_DEFAULT_NUM_FEATURES = None
+
+# Page size for features.json when paging with the cursor parameter and
+# no n parameter.  Start with "?cursor=" and pass the returned "next"
+# token as the cursor for each following page.
+GEOCAM_LENS_DEFAULT_PAGE_SIZE = 500
+
+# Marker clusters for clusters.json are precomputed for quadtree levels
+# 0 through GEOCAM_LENS_CLUSTER_MAX_LEVEL.  A request for map zoom z uses
+# level z + GEOCAM_LENS_CLUSTER_ZOOM_OFFSET, so an offset of 2 gives
+# clusters roughly 64 pixels across on a 256-pixel-tile map.
+GEOCAM_LENS_CLUSTER_MAX_LEVEL = 16
+GEOCAM_LENS_CLUSTER_ZOOM_OFFSET = 2
+
+# Django cache alias (see CACHES) used to cache features.json and
+# featuresJson.js responses, or None to disable caching.  Both the
+# local-memory and file-based backends work; entries are invalidated
+# across processes whenever a feature is saved or deleted.
+GEOCAM_LENS_FEATURE_CACHE = 'default'
+
+# Lifetime of cached feature responses, in seconds.
+GEOCAM_LENS_FEATURE_CACHE_SECONDS = 60 * 60
+
+# Responses larger than this are streamed without being cached.
+GEOCAM_LENS_FEATURE_CACHE_MAX_BYTES = 5 * 1024 * 1024
+
+# Store each processed feature's GeoJSON and KML placemark when it's
+# saved, so feeds don't render features on every request.
+GEOCAM_LENS_USE_FRAGMENTS = True
+
+# Bump this after changing how features are rendered (e.g. templates or
+# getProperties()) to stop using stored fragments, then run
+# lensRebuildFragments.
+GEOCAM_LENS_FRAGMENT_VERSION = 1
+
+# Compress feature and KML feed responses for clients that send
+# Accept-Encoding.  Brotli is used if the brotli module is installed and
+# the client accepts it, otherwise gzip.  Cached responses are stored
+# compressed.
+GEOCAM_LENS_COMPRESS_RESPONSES = True
+
+# zlib compression level (1-9) for gzip responses.
+GEOCAM_LENS_GZIP_LEVEL = 6
+
+# Brotli quality (0-11) for br responses.  Higher levels compress
+# better but are much slower, and streamed responses pay that on every
+# request.
+GEOCAM_LENS_BROTLI_QUALITY = 5
+
+# List of (maxWidth, maxHeight) thumbnail sizes that process() builds for
+# each image.  All sizes are derived from a single decode of the
+# original.  None means GEOCAM_AWARE_GALLERY_THUMB_SIZE and
+# GEOCAM_AWARE_DESC_THUMB_SIZE.
+GEOCAM_LENS_THUMB_SIZES = None
+
+# Thumbnail decoding quality.  'draft' decodes JPEGs at reduced
+# resolution (DCT scaling) before antialiasing down to size, which is
+# several times faster for large photos with little visible difference.
+# 'antialias' always decodes the full-resolution image first.
+GEOCAM_LENS_THUMB_QUALITY = 'draft'
+
+# Thumbnail widths that may be requested from the on-demand thumbnail
+# URL (thumbnail/<id>/<width>.jpg).  Widths not built by process() are
+# rendered on first request and kept in the thumbnail cache.
+GEOCAM_LENS_ON_DEMAND_THUMB_WIDTHS = (64, 100, 160, 200, 240, 320, 400,
+                                      480, 640, 800, 960, 1280)
+
+# Directory for on-demand thumbnails.  None means
+# DATA_DIR/geocamLens/thumbCache.
+GEOCAM_LENS_THUMB_CACHE_DIR = None
+
+# Byte budget for the thumbnail cache.  Least recently used thumbnails
+# are evicted when it is exceeded.
+GEOCAM_LENS_THUMB_CACHE_MAX_BYTES = 500 * 1024 * 1024
+
+# Directory where uploads are written before they are moved into their
+# final storage dir.  Must be on the same filesystem as DATA_DIR so the
+# move is a rename rather than a copy.  None means
+# DATA_DIR/geocamLens/incoming.
+GEOCAM_LENS_UPLOAD_STAGING_DIR = None
+
+# A resumable upload (upload-r/) that receives no data for this many
+# seconds is abandoned and its partial file deleted.
+GEOCAM_LENS_UPLOAD_SESSION_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# How often, in seconds, upload requests sweep abandoned resumable
+# uploads and staged files left by crashed requests.  lensWorker also
+# sweeps at startup.
+GEOCAM_LENS_STAGING_SWEEP_SECONDS = 60 * 60
+
+# Maximum number of photos accepted in one upload-batch/ request.
+GEOCAM_LENS_MAX_BATCH_UPLOAD_ITEMS = 500
+
+# If True, uploadImage() stores the image as pending and returns right
+# away, leaving thumbnail generation to background workers.  Start the
+# workers with "manage.py lensWorker".  If False, images are processed
+# inline during the upload request.
+GEOCAM_LENS_PROCESS_IN_BACKGROUND = False
+
+# Number of worker processes started by "manage.py lensWorker".
+GEOCAM_LENS_NUM_WORKERS = 2
+
+# Seconds an idle worker waits before polling the job queue again.
+GEOCAM_LENS_WORKER_POLL_SECONDS = 1.0
+
+# A job that fails this many times is marked failed and left in the
+# queue for inspection.
+GEOCAM_LENS_PROCESS_MAX_ATTEMPTS = 3
+
+# A running job whose worker has not reported back within this many
+# seconds is assumed to have crashed and is requeued.
+GEOCAM_LENS_PROCESS_TIMEOUT_SECONDS = 600
+
+# How photo and thumbnail files are sent.  None streams them from Django
+# (with Range and conditional GET support).  'X-Sendfile' (Apache
+# mod_xsendfile, lighttpd) or 'X-Accel-Redirect' (nginx) hands the file
+# off to the front-end server instead.
+GEOCAM_LENS_SENDFILE_MODE = None
+
+# For X-Accel-Redirect: files under GEOCAM_LENS_SENDFILE_ROOT (None means
+# DATA_DIR) are redirected to the same relative path under this internal
+# nginx location.
+GEOCAM_LENS_SENDFILE_ROOT = None
+GEOCAM_LENS_ACCEL_REDIRECT_PREFIX = '/protected/'
@@ -35,6 +35,19 @@ class UploadImageForm(forms.Form):
     folder = forms.CharField(max_length=32, required=False)
 
 
+# metadata sent when starting a resumable upload; the photo itself
+# arrives later in chunks
+class UploadSessionForm(UploadImageForm):
+    filename = forms.CharField(max_length=256, required=False)
+    size = forms.IntegerField(min_value=0, required=False)
+
+    def __init__(self, *args, **kwargs):
+        super(UploadSessionForm, self).__init__(*args, **kwargs)
+        del self.fields['photo']
+        # the uuid is the session key
+        self.fields['uuid'].required = True
+
+
 class EditImageForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         super(EditImageForm, self).__init__(*args, **kwargs)
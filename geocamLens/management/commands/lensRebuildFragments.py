@@ -0,0 +1,36 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from geocamCore.models import PointFeature
+
+from geocamLens.models import FeatureFragment
+from geocamLens.BatchSerializer import iterFeatureBatches
+
+BATCH_SIZE = 100
+
+
+class Command(BaseCommand):
+    help = 'Re-render the stored GeoJSON and KML fragments for all processed point features'
+
+    def handle(self, *args, **options):
+        version = FeatureFragment.getCurrentVersion()
+        features = PointFeature.objects.filter(processed=True)
+        n = 0
+        for batch in iterFeatureBatches(features, BATCH_SIZE):
+            for feature in batch:
+                FeatureFragment.updateForFeature(feature, version)
+                n += 1
+        print 'rendered %d fragments' % n
+        # fragments for old versions, or features that are gone or
+        # no longer processed
+        stale = (FeatureFragment.objects
+                 .filter(~Q(version=version)
+                         | ~Q(featureId__in=features.values('pk'))))
+        print 'deleted %d stale fragments' % stale.count()
+        stale.delete()
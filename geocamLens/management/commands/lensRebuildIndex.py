@@ -0,0 +1,25 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+from django.core.management.base import BaseCommand
+
+from geocamCore.models import PointFeature
+
+from geocamLens.models import SpatialKey, ClusterCell
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the geocamLens spatial index and marker clusters for all point features'
+
+    def handle(self, *args, **options):
+        SpatialKey.objects.all().delete()
+        n = 0
+        for feature in PointFeature.objects.all().iterator():
+            # clusters are rebuilt in one pass below, not per feature
+            SpatialKey.updateForFeature(feature, updateClusters=False)
+            n += 1
+        print 'indexed %d features' % n
+        print 'built %d cluster cells' % ClusterCell.rebuild()
@@ -0,0 +1,25 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+from django.core.management.base import BaseCommand
+
+from geocamLens import ProcessQueue
+
+
+class Command(BaseCommand):
+    help = 'Run background workers that process uploaded images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--numWorkers',
+                            type=int, default=None,
+                            help='Number of worker processes [GEOCAM_LENS_NUM_WORKERS]')
+        parser.add_argument('--exitWhenIdle',
+                            action='store_true', default=False,
+                            help='Exit once the queue is empty instead of polling')
+
+    def handle(self, *args, **options):
+        ProcessQueue.runWorkerPool(numWorkers=options['numWorkers'],
+                                   exitWhenIdle=options['exitWhenIdle'])
@@ -10,18 +10,21 @@ Models for geocamLens app.
 
 import os
 import sys
-import shutil
 import datetime
 import random
 import re
 from cStringIO import StringIO
 import stat
+import hashlib
 
 import pytz
 import PIL.Image
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.core import urlresolvers
 from django.utils.safestring import mark_safe
 from django.contrib.contenttypes.models import ContentType
+from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 
 import tagging
@@ -33,9 +36,13 @@ from geocamUtil.Xmp import Xmp
 from geocamUtil.TimeUtil import parseUploadTime
 from geocamUtil.FileUtil import mkdirP
 from geocamUtil import TimeUtil
+from geocamUtil import anyjson as json
 import geocamCore.models as coreModels
 from geocamFolder.models import Folder
 
+from geocamLens.Ingest import moveIntoPlace, copyIntoPlace, readImageInfo
+from geocamLens import SpatialIndex
+
 from django.conf import settings
 
 # pylint: disable=C1001,E1101
@@ -101,6 +108,19 @@ WORKFLOW_STATUS_CHOICES = (
 )
 DEFAULT_WORKFLOW_STATUS = WF_SUBMITTED_FOR_VALIDATION
 
+JOB_QUEUED = 'q'
+JOB_RUNNING = 'r'
+JOB_FAILED = 'f'
+
+JOB_STATUS_CHOICES = (
+    # waiting for a worker to pick it up
+    (JOB_QUEUED, 'queued'),
+    # claimed by a worker
+    (JOB_RUNNING, 'running'),
+    # gave up after too many attempts, kept for inspection
+    (JOB_FAILED, 'failed'),
+)
+
 CARDINAL_DIRECTIONS = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE',
                        'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
 
@@ -168,6 +188,26 @@ class Image(coreModels.PointFeature):
 
     viewerExtension = '.jpg'
 
+    # the properties getProperties() adds for images, as (name, columns
+    # read, getter).  A fields= projection asking only for these loads
+    # just those columns, see getProjectedGeoJson().
+    IMAGE_PROPERTIES = (('sizePixels', ('widthPixels', 'heightPixels'),
+                         lambda img: [img.widthPixels, img.heightPixels]),
+                        ('pointIcon', ('icon',),
+                         lambda img: img.getIconDict('Point')),
+                        ('rotatedIcon', ('icon', 'yaw'),
+                         lambda img: img.getRotatedIconDict()),
+                        ('roll', ('roll',), lambda img: img.roll),
+                        ('pitch', ('pitch',), lambda img: img.pitch),
+                        ('yaw', ('yaw',), lambda img: img.yaw),
+                        ('yawRef', ('yawRef',), lambda img: YAW_REF_LOOKUP[img.yawRef]))
+
+    # columns getGeoJson() reads outside of getProperties()
+    GEOJSON_COLUMNS = ('uuid', 'latitude', 'longitude')
+
+    # set by getProjectedGeoJson() while it runs
+    projectedFields = None
+
     class Meta:
         abstract = True
 
@@ -196,35 +236,119 @@ class Image(coreModels.PointFeature):
         return os.path.join(self.getDir(version), 'full.jpg')
 
     def getThumbnailUrl(self, width):
-        return '%s/th%d.jpg' % (self.getDirUrl(), width)
-
-    def makeThumbnail0(self, previewOriginalPath, thumbSize):
-        maxOutWidth, maxOutHeight = thumbSize
-        if previewOriginalPath is None:
-            return
+        """
+        Url for a thumbnail of @width, or of the closest width we can
+        serve: the smallest available one at least as wide, else the
+        widest.  A width that is prebuilt under the current settings is
+        still served on demand if this image was processed before it
+        was added.
+        """
+        prebuiltWidths = [w for w, _h in self.getThumbSizes()]
+        availableWidths = sorted(self.getServableThumbWidths())
+        if width not in availableWidths:
+            widerWidths = [w for w in availableWidths if w >= width]
+            if widerWidths:
+                width = widerWidths[0]
+            else:
+                width = availableWidths[-1]
+        if width in prebuiltWidths and os.path.exists(self.getThumbnailPath(width)):
+            # built by process()
+            return '%s/th%d.jpg' % (self.getDirUrl(), width)
+        else:
+            # rendered on first request
+            return urlresolvers.reverse('geocamLens_thumbnail',
+                                        args=[self.id, width])
+
+    def getServableThumbWidths(self):
+        return (set([w for w, _h in self.getThumbSizes()])
+                | set(settings.GEOCAM_LENS_ON_DEMAND_THUMB_WIDTHS))
+
+    def getThumbSizes(self):
+        sizes = settings.GEOCAM_LENS_THUMB_SIZES
+        if sizes is None:
+            sizes = [settings.GEOCAM_AWARE_GALLERY_THUMB_SIZE,
+                     settings.GEOCAM_AWARE_DESC_THUMB_SIZE]
+        return sizes
+
+    def thumbnailIsCurrent(self, previewOriginalPath, maxOutWidth):
         thumbPath = self.getThumbnailPath(maxOutWidth)
-        if os.path.exists(thumbPath):
-            thumbMtime = os.stat(thumbPath)[stat.ST_MTIME]
-            fullMtime = os.stat(previewOriginalPath)[stat.ST_MTIME]
-            if fullMtime < thumbMtime:
-                return
-
+        if not os.path.exists(thumbPath):
+            return False
+        thumbMtime = os.stat(thumbPath)[stat.ST_MTIME]
+        fullMtime = os.stat(previewOriginalPath)[stat.ST_MTIME]
+        return fullMtime < thumbMtime
+
+    def prepThumbnailSource(self, im, largestSize):
+        """
+        Get freshly opened image @im ready to be downsampled to
+        @largestSize.  For JPEGs in 'draft' quality mode, this asks the
+        decoder for a DCT-scaled image (1/2, 1/4 or 1/8 resolution) that
+        is still at least @largestSize, which is much faster than a full
+        decode.  Other formats are decoded normally and converted to a
+        mode that can be antialiased and saved as JPEG.
+        """
+        if (settings.GEOCAM_LENS_THUMB_QUALITY == 'draft'
+                and im.format == 'JPEG'):
+            im.draft(im.mode, largestSize)
+        if im.mode not in ('RGB', 'L'):
+            im = im.convert('RGB')
+        return im
+
+    def writeThumbnail(self, previewOriginalPath, thumbSize, outPath):
+        maxOutWidth, maxOutHeight = thumbSize
         im = PIL.Image.open(previewOriginalPath)
         fullWidth, fullHeight = im.size
         thumbWidth, thumbHeight = \
             self.calcThumbSize(fullWidth, fullHeight,
                                maxOutWidth, maxOutHeight)
-        try:
-            im.thumbnail((thumbWidth, thumbHeight), PIL.Image.ANTIALIAS)
-        except IOError:
-            # fall back to resize
-            im.resize((thumbWidth, thumbHeight), PIL.Image.ANTIALIAS)
+        im = self.prepThumbnailSource(im, (thumbWidth, thumbHeight))
+        if thumbWidth < im.size[0]:
+            im = im.resize((thumbWidth, thumbHeight), PIL.Image.ANTIALIAS)
+        im.save(outPath, 'JPEG')
+
+    def makeThumbnails0(self, previewOriginalPath, thumbSizes):
+        """
+        Build thumbnails for all of @thumbSizes with a single decode of
+        the original.  Sizes are built largest first and each one is
+        downsampled from the previous one rather than from the full
+        image.
+        """
+        if previewOriginalPath is None:
+            return
+        # thumbnail paths are keyed by width, so one size per width
+        sizeLookup = dict(((w, h) for w, h in thumbSizes))
+        todo = [(w, h) for w, h in sizeLookup.iteritems()
+                if not self.thumbnailIsCurrent(previewOriginalPath, w)]
+        if not todo:
+            return
+
+        im = PIL.Image.open(previewOriginalPath)
+        fullWidth, fullHeight = im.size
+        targets = [(self.calcThumbSize(fullWidth, fullHeight,
+                                       maxOutWidth, maxOutHeight),
+                    maxOutWidth)
+                   for maxOutWidth, maxOutHeight in todo]
+        targets.sort(reverse=True)
+        im = self.prepThumbnailSource(im, targets[0][0])
+
         mkdirP(self.getDir())
-        im.save(self.getThumbnailPath(maxOutWidth))
+        current = im
+        for (thumbWidth, thumbHeight), maxOutWidth in targets:
+            # like PIL thumbnail(), never enlarge
+            if thumbWidth < current.size[0]:
+                current = current.resize((thumbWidth, thumbHeight),
+                                         PIL.Image.ANTIALIAS)
+            current.save(self.getThumbnailPath(maxOutWidth))
+
+    def makeThumbnails(self, thumbSizes):
+        previewOriginalPath = self.getImagePath()
+        self.makeThumbnails0(previewOriginalPath, thumbSizes)
+
+    def makeThumbnail0(self, previewOriginalPath, thumbSize):
+        self.makeThumbnails0(previewOriginalPath, [thumbSize])
 
     def makeThumbnail(self, thumbSize):
-        previewOriginalPath = self.getImagePath()
-        self.makeThumbnail0(previewOriginalPath, thumbSize)
+        self.makeThumbnails([thumbSize])
 
     def galleryThumb(self):
         w0, h0 = settings.GEOCAM_AWARE_GALLERY_THUMB_SIZE
@@ -244,15 +368,18 @@ class Image(coreModels.PointFeature):
             rotRounded = 0
         return self.getStyledIconDict(kind='', suffix='%03d' % rotRounded)
 
-    def process(self, importFile=None):
+    def process(self, importFile=None, moveImportFile=False):
         self.status = STATUS_ACTIVE
         self.processed = True
         if importFile and not os.path.exists(self.getImagePath()):
             if not os.path.exists(self.getDir()):
                 mkdirP(self.getDir())
-            shutil.copyfile(importFile, self.getImagePath())
-        self.makeThumbnail(settings.GEOCAM_AWARE_GALLERY_THUMB_SIZE)
-        self.makeThumbnail(settings.GEOCAM_AWARE_DESC_THUMB_SIZE)
+            if moveImportFile:
+                # importFile is ours to consume, e.g. a staged upload
+                moveIntoPlace(importFile, self.getImagePath())
+            else:
+                copyIntoPlace(importFile, self.getImagePath())
+        self.makeThumbnails(self.getThumbSizes())
         # remember to call save() after process()
 
     def getCaptionHtml(self):
@@ -296,7 +423,17 @@ class Image(coreModels.PointFeature):
         xmpVals = xmp.getDict()
         return xmpVals
 
-    def getUploadImageFormVals(self, formData):
+    def getImportXmpVals(self, imageInfo):
+        """
+        XMP/EXIF values for the import described by @imageInfo.  These
+        were already read by readImageInfo(), but a subclass that
+        overrides getXmpVals() still gets it called.
+        """
+        if type(self).getXmpVals.im_func is not Image.getXmpVals.im_func:
+            return self.getXmpVals(imageInfo['path'])
+        return imageInfo['xmpVals']
+
+    def getUploadImageFormVals(self, formData, folderLookup=None):
         yaw, yawRef = Xmp.normalizeYaw(formData.get('yaw', None),
                                        formData.get('yawRef', None))
         Xmp.normalizeYaw(formData.get('altitude', None),
@@ -304,12 +441,19 @@ class Image(coreModels.PointFeature):
 
         folderName = formData.get('folder', None)
         folder = None
-        if folderName:
+        if folderLookup is not None:
+            # folders already resolved by the caller, e.g. a batch
+            # upload.  the None key holds the default folder.
+            folder = folderLookup.get(folderName or None)
+        elif folderName:
             folderMatches = Folder.objects.filter(name=folderName)
             if folderMatches:
                 folder = folderMatches[0]
         if folder is None:
-            folder = Folder.objects.get(id=1)
+            if folderLookup is not None:
+                folder = folderLookup[None]
+            else:
+                folder = Folder.objects.get(id=1)
 
         tzone = pytz.timezone(settings.TIME_ZONE)
         timestampStr = Xmp.checkMissing(formData.get('cameraTime', None))
@@ -385,16 +529,25 @@ class Image(coreModels.PointFeature):
                 vals['icon'] = t
                 break
 
-    def getImportVals(self, storePath=None, uploadImageFormData=None):
+    def getImageInfo(self, storePath):
+        return readImageInfo(storePath)
+
+    def getImportVals(self, storePath=None, uploadImageFormData=None,
+                      imageInfo=None, folderLookup=None):
         vals = {'icon': settings.GEOCAM_LENS_DEFAULT_ICON}
 
-        if storePath is not None:
-            xmpVals = self.getXmpVals(storePath)
+        if imageInfo is None and storePath is not None:
+            imageInfo = self.getImageInfo(storePath)
+        if imageInfo is not None:
+            xmpVals = self.getImportXmpVals(imageInfo)
             print >> sys.stderr, 'getImportVals: exif/xmp data:', xmpVals
             vals.update(xmpVals)
+            vals.update(widthPixels=imageInfo['widthPixels'],
+                        heightPixels=imageInfo['heightPixels'])
 
         if uploadImageFormData is not None:
-            formVals = self.getUploadImageFormVals(uploadImageFormData)
+            formVals = self.getUploadImageFormVals(uploadImageFormData,
+                                                   folderLookup=folderLookup)
             print >> sys.stderr, 'getImportVals: UploadImageForm data:', \
                 formVals
             vals.update(formVals)
@@ -444,17 +597,53 @@ class Image(coreModels.PointFeature):
 </PhotoOverlay>
 """ % dict())
 
+    def getImageProperties(self, fields=None):
+        return dict([(name, getter(self))
+                     for name, _columns, getter in self.IMAGE_PROPERTIES
+                     if fields is None or name in fields])
+
     def getProperties(self):
+        if self.projectedFields is not None:
+            return self.getImageProperties(self.projectedFields)
         result = super(Image, self).getProperties()
-        result.update(sizePixels=[self.widthPixels, self.heightPixels],
-                      pointIcon=self.getIconDict('Point'),
-                      rotatedIcon=self.getRotatedIconDict(),
-                      roll=self.roll,
-                      pitch=self.pitch,
-                      yaw=self.yaw,
-                      yawRef=YAW_REF_LOOKUP[self.yawRef])
+        result.update(self.getImageProperties())
+        return result
+
+    @classmethod
+    def getProjectionColumns(cls, fields):
+        """
+        Returns the columns getProjectedGeoJson() reads for the
+        properties in @fields, or None if some of them need the whole
+        feature.
+        """
+        columnLookup = dict([(name, columns)
+                             for name, columns, _getter in cls.IMAGE_PROPERTIES])
+        if not all([name in columnLookup for name in fields]):
+            return None
+        result = list(cls.GEOJSON_COLUMNS)
+        for name in fields:
+            result.extend([c for c in columnLookup[name] if c not in result])
         return result
 
+    def getProjectedGeoJson(self, fields):
+        """
+        Like getGeoJson() but with only the properties in @fields.  If
+        getProjectionColumns() can handle them, they are built by the
+        getters getProperties() uses and nothing else is read, so the
+        image may have been loaded with only() those columns.
+        """
+        if self.getProjectionColumns(fields) is not None:
+            self.projectedFields = fields
+        try:
+            geoJson = self.getGeoJson()
+        finally:
+            self.projectedFields = None
+        properties = geoJson.get('properties') or {}
+        geoJson['properties'] = dict([(name, properties[name])
+                                      for name in fields
+                                      if name in properties])
+        return geoJson
+
     def getCaptionTimeZone(self):
         return pytz.timezone(settings.DEFAULT_TIME_ZONE['code'])
 
@@ -544,6 +733,488 @@ class Photo(Image):
     objects = FinalModelManager(parentModel=Image)
 
 
+class ProcessingJob(models.Model):
+    """
+    A request to run process() on an image in a background worker.  Jobs
+    are deleted when they complete successfully.
+    """
+    imgType = models.ForeignKey(ContentType, editable=False)
+    imgId = models.PositiveIntegerField()
+    importFile = models.CharField(max_length=1024, blank=True,
+                                  help_text="Uploaded file to import; deleted after processing")
+    status = models.CharField(max_length=1,
+                              choices=JOB_STATUS_CHOICES,
+                              default=JOB_QUEUED,
+                              db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    errorMessage = models.TextField(blank=True)
+    dateCreated = models.DateTimeField()
+    dateUpdated = models.DateTimeField()
+
+    # img is a virtual field, see Snapshot.img
+    img = GenericForeignKey('imgType', 'imgId')
+
+    def save(self, updateDate=True, **kwargs):
+        if updateDate:
+            self.dateUpdated = datetime.datetime.utcnow()
+        if self.dateCreated is None:
+            self.dateCreated = self.dateUpdated
+        super(ProcessingJob, self).save(**kwargs)
+
+    def __unicode__(self):
+        return u'<ProcessingJob %s %s:%s (%s)>' % (self.id, self.imgType_id,
+                                                   self.imgId, self.status)
+
+    class Meta:
+        ordering = ['id']
+
+
+class UploadSession(models.Model):
+    """
+    A resumable upload in progress.  The bytes received so far live in
+    a staging file, so the received offset is just the size of that
+    file.  The session keeps the image metadata sent when the upload was
+    started until the upload is finalized.
+    """
+    uuid = models.CharField(max_length=48, unique=True,
+                            help_text="uuid of the image being uploaded")
+    author = models.ForeignKey(User)
+    name = models.CharField(max_length=256, blank=True)
+    stagingPath = models.CharField(max_length=1024)
+    totalBytes = models.PositiveIntegerField(null=True, blank=True)
+    formData = models.TextField(default='{}',
+                                help_text="JSON-encoded upload form fields")
+    dateCreated = models.DateTimeField()
+
+    def getReceivedBytes(self):
+        if os.path.exists(self.stagingPath):
+            return os.stat(self.stagingPath)[stat.ST_SIZE]
+        else:
+            return 0
+
+    def __unicode__(self):
+        return u'<UploadSession %s (%s)>' % (self.uuid, self.author)
+
+
+class SpatialKey(models.Model):
+    """
+    Quadtree key for the location of a point feature, see SpatialIndex.
+    Kept in a side table since the feature tables belong to geocamCore.
+    Maintained by the post_save handler below.
+    """
+    featureId = models.PositiveIntegerField(unique=True)
+    quadKey = models.CharField(max_length=SpatialIndex.QUADKEY_MAX_LEVEL,
+                               db_index=True)
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    # whether this feature is counted in ClusterCell
+    clustered = models.BooleanField(default=False)
+
+    @staticmethod
+    def isClusterable(feature):
+        return feature.processed and feature.status != STATUS_DELETED
+
+    @classmethod
+    def updateForFeature(cls, feature, updateClusters=True):
+        """
+        Returns the quadkeys of the feature's old and new locations, if
+        any, for ClusterCell.touch().
+        """
+        try:
+            entry = cls.objects.get(featureId=feature.pk)
+        except cls.DoesNotExist:
+            entry = None
+
+        if feature.latitude is None or feature.longitude is None:
+            if entry is not None:
+                entry.remove()
+                return [entry.quadKey]
+            return []
+
+        newEntry = cls(featureId=feature.pk,
+                       quadKey=SpatialIndex.getQuadKey(feature.latitude,
+                                                       feature.longitude),
+                       latitude=feature.latitude,
+                       longitude=feature.longitude,
+                       clustered=cls.isClusterable(feature))
+        if entry is not None:
+            if ((entry.quadKey, entry.latitude, entry.longitude, entry.clustered)
+                    == (newEntry.quadKey, newEntry.latitude, newEntry.longitude,
+                        newEntry.clustered)):
+                # saved without moving, nothing to do
+                return [entry.quadKey]
+            if entry.clustered and updateClusters:
+                ClusterCell.removeEntry(entry)
+            newEntry.id = entry.id
+        newEntry.save()
+        if newEntry.clustered and updateClusters:
+            ClusterCell.addEntry(newEntry)
+        if entry is not None:
+            return [entry.quadKey, newEntry.quadKey]
+        else:
+            return [newEntry.quadKey]
+
+    def remove(self):
+        if self.clustered:
+            ClusterCell.removeEntry(self)
+        self.delete()
+
+    def __unicode__(self):
+        return u'<SpatialKey %s %s>' % (self.featureId, self.quadKey)
+
+
+class ClusterCell(models.Model):
+    """
+    Precomputed marker cluster: the clustered features inside one
+    quadtree tile.  There is a row for each non-empty tile at each level
+    up to GEOCAM_LENS_CLUSTER_MAX_LEVEL, updated incrementally as
+    SpatialKey entries come and go.
+    """
+    quadKey = models.CharField(max_length=SpatialIndex.QUADKEY_MAX_LEVEL,
+                               unique=True)
+    level = models.PositiveIntegerField(db_index=True)
+    count = models.IntegerField(default=0)
+    sumLatitude = models.FloatField(default=0)
+    sumLongitude = models.FloatField(default=0)
+    # newest feature in the cell, shown as its thumbnail
+    representativeId = models.PositiveIntegerField(null=True, blank=True)
+    # FeatureChange sequence number of the last change to a feature in
+    # the cell, for invalidating cached KML tiles
+    version = models.PositiveIntegerField(default=0)
+
+    def getCentroid(self):
+        return (self.sumLatitude / self.count,
+                self.sumLongitude / self.count)
+
+    @staticmethod
+    def getKeysForQuadKey(quadKey):
+        return [quadKey[:level]
+                for level in xrange(0, settings.GEOCAM_LENS_CLUSTER_MAX_LEVEL + 1)]
+
+    @classmethod
+    def getEntryKeys(cls, entry):
+        return cls.getKeysForQuadKey(entry.quadKey)
+
+    @classmethod
+    def touch(cls, quadKeys, version):
+        """
+        Mark the cells containing @quadKeys as changed at @version.
+        """
+        keys = set()
+        for quadKey in quadKeys:
+            keys.update(cls.getKeysForQuadKey(quadKey))
+        keys = sorted(keys)
+        # in batches, since sqlite limits the number of query parameters
+        for i in xrange(0, len(keys), 500):
+            cls.objects.filter(quadKey__in=keys[i:i + 500]).update(version=version)
+
+    @classmethod
+    def createCellsForEntry(cls, keys, entry):
+        """
+        Create the cells in @keys that don't exist yet, holding just
+        @entry, and return the keys of the cells created.  Another
+        worker may create some of the same cells at the same time, in
+        which case we retry with the ones still missing.
+        """
+        while 1:
+            existing = set(cls.objects
+                           .filter(quadKey__in=keys)
+                           .values_list('quadKey', flat=True))
+            missing = [key for key in keys if key not in existing]
+            if not missing:
+                return set()
+            try:
+                with transaction.atomic():
+                    cls.objects.bulk_create([cls(quadKey=key,
+                                                 level=len(key),
+                                                 count=1,
+                                                 sumLatitude=entry.latitude,
+                                                 sumLongitude=entry.longitude,
+                                                 representativeId=entry.featureId)
+                                             for key in missing])
+                return set(missing)
+            except IntegrityError:
+                pass
+
+    @classmethod
+    def addEntry(cls, entry):
+        keys = cls.getEntryKeys(entry)
+        with transaction.atomic():
+            created = cls.createCellsForEntry(keys, entry)
+            existing = [key for key in keys if key not in created]
+            (cls.objects
+             .filter(quadKey__in=existing)
+             .update(count=models.F('count') + 1,
+                     sumLatitude=models.F('sumLatitude') + entry.latitude,
+                     sumLongitude=models.F('sumLongitude') + entry.longitude))
+            (cls.objects
+             .filter(quadKey__in=existing, representativeId__lt=entry.featureId)
+             .update(representativeId=entry.featureId))
+
+    @classmethod
+    def removeEntry(cls, entry):
+        keys = cls.getEntryKeys(entry)
+        with transaction.atomic():
+            cls.removeEntry0(keys, entry)
+
+    @classmethod
+    def removeEntry0(cls, keys, entry):
+        (cls.objects
+         .filter(quadKey__in=keys)
+         .update(count=models.F('count') - 1,
+                 sumLatitude=models.F('sumLatitude') - entry.latitude,
+                 sumLongitude=models.F('sumLongitude') - entry.longitude))
+        cls.objects.filter(quadKey__in=keys, count__lte=0).delete()
+        for cell in cls.objects.filter(quadKey__in=keys,
+                                       representativeId=entry.featureId):
+            low, high = SpatialIndex.getQuadKeyRange(cell.quadKey)
+            cell.representativeId = (SpatialKey.objects
+                                     .filter(clustered=True,
+                                             quadKey__gte=low,
+                                             quadKey__lt=high)
+                                     .exclude(featureId=entry.featureId)
+                                     .aggregate(models.Max('featureId'))
+                                     ['featureId__max'])
+            cell.save()
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Recompute all cells from scratch from the SpatialKey table.
+        """
+        cells = {}
+        for entry in SpatialKey.objects.filter(clustered=True).iterator():
+            for key in cls.getEntryKeys(entry):
+                cell = cells.get(key)
+                if cell is None:
+                    cell = cls(quadKey=key, level=len(key))
+                    cells[key] = cell
+                cell.count += 1
+                cell.sumLatitude += entry.latitude
+                cell.sumLongitude += entry.longitude
+                cell.representativeId = max(cell.representativeId, entry.featureId)
+        # every cell reflects all changes so far
+        version = FeatureChange.getLatestSeq()
+        for cell in cells.itervalues():
+            cell.version = version
+        cls.objects.all().delete()
+        cls.objects.bulk_create(cells.values(), batch_size=500)
+        return len(cells)
+
+    def __unicode__(self):
+        return u'<ClusterCell %s (%d)>' % (self.quadKey, self.count)
+
+
+class FeatureChange(models.Model):
+    """
+    Change sequence for the delta feed.  Each save or delete of a point
+    feature appends a row, and the id of a feature's newest row is the
+    sequence number of its last change.  Older rows for the feature are
+    dropped, so the table holds one row per feature ever seen, including
+    tombstones for deleted features.
+    """
+    featureId = models.PositiveIntegerField(db_index=True)
+    # kept so clients can be told to remove a feature that's gone
+    uuid = models.CharField(max_length=48, blank=True)
+    deleted = models.BooleanField(default=False)
+    dateChanged = models.DateTimeField(db_index=True)
+    # sequence number of the change that made the feature servable
+    # (processed and not deleted), carried over while it stays that
+    # way.  A client synced at or after it has the feature.
+    servedSeq = models.PositiveIntegerField(null=True, blank=True)
+
+    @classmethod
+    def record(cls, feature, deleted=False):
+        previous = cls.objects.filter(featureId=feature.pk).order_by('-id').first()
+        served = feature.processed and not deleted
+        if served and previous is not None:
+            servedSeq = previous.servedSeq
+        else:
+            servedSeq = None
+        # insert before removing the old row: sqlite can reuse the
+        # highest id if it's deleted first, which would move the
+        # sequence backwards
+        change = cls(featureId=feature.pk,
+                     uuid=feature.uuid or '',
+                     deleted=deleted,
+                     dateChanged=datetime.datetime.utcnow(),
+                     servedSeq=servedSeq)
+        change.save()
+        if served and servedSeq is None:
+            change.servedSeq = change.id
+            cls.objects.filter(id=change.id).update(servedSeq=change.id)
+        cls.objects.filter(featureId=feature.pk, id__lt=change.id).delete()
+        return change
+
+    @classmethod
+    def recordBulk(cls, features):
+        """
+        Like record() for each feature in queryset @features, with bulk
+        queries instead of several per feature.  Returns the latest
+        sequence number after the new changes.
+        """
+        featureIds = features.values('pk')
+        servedSeqs = dict(cls.objects
+                          .filter(featureId__in=featureIds, servedSeq__isnull=False)
+                          .values_list('featureId', 'servedSeq'))
+        lastSeq = cls.getLatestSeq()
+        now = datetime.datetime.utcnow()
+        changes = []
+        for feature in features.only('pk', 'uuid', 'processed', 'status').iterator():
+            deleted = (feature.status == STATUS_DELETED)
+            if feature.processed and not deleted:
+                servedSeq = servedSeqs.get(feature.pk)
+            else:
+                servedSeq = None
+            changes.append(cls(featureId=feature.pk,
+                               uuid=feature.uuid or '',
+                               deleted=deleted,
+                               dateChanged=now,
+                               servedSeq=servedSeq))
+        # as in record(), insert before removing the old rows
+        cls.objects.bulk_create(changes, batch_size=500)
+        servedIds = (features
+                     .filter(processed=True)
+                     .exclude(status=STATUS_DELETED)
+                     .values('pk'))
+        (cls.objects
+         .filter(featureId__in=servedIds, id__gt=lastSeq, servedSeq__isnull=True)
+         .update(servedSeq=models.F('id')))
+        cls.objects.filter(featureId__in=featureIds, id__lte=lastSeq).delete()
+        return cls.getLatestSeq()
+
+    @classmethod
+    def getSeqAt(cls, utcDT):
+        """
+        Returns the sequence number of the last change at or before
+        @utcDT.  Rows superseded since then are gone, so this may be a
+        little early, which only means some changes are sent again.
+        """
+        return (cls.objects
+                .filter(dateChanged__lte=utcDT)
+                .aggregate(models.Max('id'))['id__max'] or 0)
+
+    @classmethod
+    def getServedIds(cls, featureIds, seq):
+        """
+        Returns the ids in @featureIds that were already servable at
+        change sequence number @seq.
+        """
+        return set(cls.objects
+                   .filter(featureId__in=featureIds, servedSeq__lte=seq)
+                   .values_list('featureId', flat=True))
+
+    @classmethod
+    def getUuids(cls, featureIds):
+        return (cls.objects
+                .filter(featureId__in=featureIds)
+                .values_list('uuid', flat=True))
+
+    @classmethod
+    def getLatestSeq(cls):
+        return cls.objects.aggregate(models.Max('id'))['id__max'] or 0
+
+    def __unicode__(self):
+        return u'<FeatureChange %s %s%s>' % (self.id, self.featureId,
+                                             ' deleted' if self.deleted else '')
+
+
+# stands for the scheme and host in stored KML fragments, which differ
+# between requests
+KML_ROOT_MARKER = '__GEOCAM_LENS_ROOT__'
+
+# user fields that serialized features may show
+AUTHOR_FIELDS = ('username', 'first_name', 'last_name', 'email')
+
+# settings that change how features are serialized
+FRAGMENT_SETTINGS = ('SCRIPT_NAME',
+                     'STATIC_URL',
+                     'DATA_URL',
+                     'TIME_ZONE',
+                     'DEFAULT_TIME_ZONE',
+                     'GEOCAM_AWARE_GALLERY_THUMB_SIZE',
+                     'GEOCAM_AWARE_DESC_THUMB_SIZE',
+                     'GEOCAM_LENS_THUMB_SIZES',
+                     'GEOCAM_LENS_RENDER_SVG_ICONS',
+                     'GEOCAM_LENS_FRAGMENT_VERSION')
+
+
+class FragmentRequest(object):
+    """
+    Stands in for the request while rendering KML to store.  Absolute
+    urls get KML_ROOT_MARKER in place of the scheme and host.
+    """
+    def build_absolute_uri(self, location=None):
+        if location is None:
+            location = '/'
+        if '://' in location:
+            return location
+        return KML_ROOT_MARKER + location
+
+
+class FeatureFragment(models.Model):
+    """
+    Serialized GeoJSON and KML placemark for a processed point feature,
+    so feeds can concatenate them instead of rendering every feature on
+    every request.  Maintained by the signal handlers below.  Fragments
+    whose version doesn't match getCurrentVersion() are ignored and
+    re-rendered; run lensRebuildFragments after changing templates or
+    the settings in FRAGMENT_SETTINGS.  Edits to the author or folders
+    of a feature drop its fragments, see featureRelatedObjectSaved().
+    """
+    featureId = models.PositiveIntegerField(unique=True)
+    version = models.CharField(max_length=32, db_index=True)
+    geoJson = models.TextField()
+    kml = models.TextField()
+
+    @staticmethod
+    def getCurrentVersion():
+        vals = []
+        for name in FRAGMENT_SETTINGS:
+            val = getattr(settings, name, None)
+            if isinstance(val, dict):
+                # e.g. DEFAULT_TIME_ZONE, repr in a stable order
+                val = sorted(val.iteritems())
+            vals.append((name, val))
+        return hashlib.md5(repr(vals)).hexdigest()
+
+    @staticmethod
+    def getKml(fragmentKml, request):
+        root = request.build_absolute_uri('/')[:-1]
+        return fragmentKml.replace(KML_ROOT_MARKER, root)
+
+    @classmethod
+    def renderForFeature(cls, feature, version=None):
+        if version is None:
+            version = cls.getCurrentVersion()
+        return cls(featureId=feature.pk,
+                   version=version,
+                   geoJson=json.dumps(feature.getGeoJson(), separators=(',', ':')),
+                   kml=feature.getKml(FragmentRequest()))
+
+    @classmethod
+    def updateForFeature(cls, feature, version=None):
+        """
+        Render and store the fragments for @feature, or drop them if
+        it's not being served.  Returns the fragment or None.
+        """
+        if not (settings.GEOCAM_LENS_USE_FRAGMENTS and feature.processed):
+            cls.objects.filter(featureId=feature.pk).delete()
+            return None
+        fragment = cls.renderForFeature(feature, version)
+        numUpdated = (cls.objects
+                      .filter(featureId=feature.pk)
+                      .update(version=fragment.version,
+                              geoJson=fragment.geoJson,
+                              kml=fragment.kml))
+        if not numUpdated:
+            fragment.save()
+        return fragment
+
+    def __unicode__(self):
+        return u'<FeatureFragment %s %s>' % (self.featureId, self.version)
+
+
 class GoogleEarthSession(models.Model):
     """
     Session state for a Google Earth client that is requesting periodic
@@ -574,9 +1245,123 @@ class GoogleEarthSession(models.Model):
         else:
             return None
 
+    def getExtras(self):
+        return json.loads(self.extras or '{}')
+
+    def setExtras(self, extras):
+        self.extras = json.dumps(extras)
+
+    def getChangeSeq(self):
+        """
+        The FeatureChange sequence number the client is up to date with,
+        or None for sessions started before changes were tracked.
+        """
+        return self.getExtras().get('changeSeq')
+
+    def setChangeSeq(self, seq):
+        extras = self.getExtras()
+        extras['changeSeq'] = seq
+        self.setExtras(extras)
+
+    def getInitialUrl(self):
+        return self.getExtras().get('initialUrl')
+
+    def setInitialUrl(self, url):
+        extras = self.getExtras()
+        extras['initialUrl'] = url
+        self.setExtras(extras)
+
     def __unicode__(self):
         return u'<Session %s (%s)>' % (self.sessionId, self.utime)
 
     class Meta:
         verbose_name = 'Google Earth session'
         ordering = ['utime']
+
+
+def pointFeatureSaved(sender, instance, **kwargs):
+    if isinstance(instance, coreModels.PointFeature):
+        quadKeys = SpatialKey.updateForFeature(instance)
+        if instance.status == STATUS_PENDING:
+            # an upload saves the feature several times before its job
+            # finishes processing it.  Only the final save renders;
+            # until then stale fragments are dropped, and a read in
+            # between renders on demand.
+            FeatureFragment.objects.filter(featureId=instance.pk).delete()
+        else:
+            FeatureFragment.updateForFeature(instance)
+        change = FeatureChange.record(instance,
+                                      deleted=(instance.status == STATUS_DELETED))
+        # covers uploadImage, editImage0, process() + save() and admin
+        # edits.  The new change also invalidates the FeatureCache.
+        ClusterCell.touch(quadKeys, change.id)
+
+
+def pointFeatureRelationsChanged(sender, instance, action, **kwargs):
+    # e.g. folders, which are set after the feature is saved
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        pointFeatureSaved(sender, instance)
+
+
+def pointFeaturesRelationsChangedBulk(features):
+    """
+    Do what pointFeatureRelationsChanged() does for @features, after
+    their relations were inserted with bulk_create, which sends no
+    m2m_changed signal.  Unprocessed features aren't served, so they
+    only need any stale fragments dropped.
+    """
+    unprocessedIds = [f.pk for f in features if not f.processed]
+    if unprocessedIds:
+        FeatureFragment.objects.filter(featureId__in=unprocessedIds).delete()
+    for feature in features:
+        if feature.processed:
+            pointFeatureSaved(feature.__class__, feature)
+
+
+def featureRelatedObjectSaved(sender, instance, created=False, update_fields=None, **kwargs):
+    """
+    Fragments embed related objects, such as the author's name and
+    folder names, so when a user or folder is edited the features that
+    refer to it are refreshed.  Their fragments are dropped, to be
+    rendered again when next read, each gets a new change, which
+    invalidates the FeatureCache and sends it to delta clients, and
+    their cluster cells are touched so cached KML tiles are rebuilt.
+    All of it is done with bulk queries, since this runs inside e.g. an
+    admin save and a user may have many features.
+    """
+    if created:
+        return
+    if isinstance(instance, User):
+        if update_fields is not None and not set(update_fields) & set(AUTHOR_FIELDS):
+            # e.g. the last_login update on every login
+            return
+        features = coreModels.PointFeature._base_manager.filter(author=instance)
+    elif isinstance(instance, Folder):
+        features = coreModels.PointFeature._base_manager.filter(folders=instance)
+    else:
+        return
+    featureIds = features.values('pk')
+    with transaction.atomic():
+        FeatureFragment.objects.filter(featureId__in=featureIds).delete()
+        seq = FeatureChange.recordBulk(features)
+        quadKeys = set(SpatialKey.objects
+                       .filter(featureId__in=featureIds)
+                       .values_list('quadKey', flat=True))
+        ClusterCell.touch(quadKeys, seq)
+
+
+def pointFeatureDeleted(sender, instance, **kwargs):
+    if isinstance(instance, coreModels.PointFeature):
+        quadKeys = []
+        for entry in SpatialKey.objects.filter(featureId=instance.pk):
+            entry.remove()
+            quadKeys.append(entry.quadKey)
+        FeatureFragment.objects.filter(featureId=instance.pk).delete()
+        change = FeatureChange.record(instance, deleted=True)
+        ClusterCell.touch(quadKeys, change.id)
+
+post_save.connect(pointFeatureSaved)
+post_save.connect(featureRelatedObjectSaved, sender=User)
+post_save.connect(featureRelatedObjectSaved, sender=Folder)
+m2m_changed.connect(pointFeatureRelationsChanged)
+post_delete.connect(pointFeatureDeleted)
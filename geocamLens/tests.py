@@ -11,8 +11,33 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
+import os
+import zlib
+import math
+import shutil
+import zipfile
+import tempfile
+import StringIO
+
+import PIL.Image
+import struct
+import datetime
+
 # from xml.dom import minidom
-from django.test import TestCase
+from django.test import TestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.db import connection
+from django.contrib.auth.models import User
+
+from geocamUtil import anyjson as json
+from geocamCore.models import PointFeature
+
+from geocamLens.models import Photo, FeatureFragment, STATUS_PENDING, STATUS_ACTIVE
+from geocamLens import FileServe, SpatialIndex, ColumnarFormat, Compression
+from geocamLens.ZipStream import ZipStream
+from geocamLens.SearchAbstract import SearchAbstract, BadQuery
+from geocamLens.BatchSerializer import iterFeatureBatches
+from geocamLens.ViewLensSimple import viewSingleton
 
 
 class ValidKmlTest(TestCase):
@@ -32,3 +57,442 @@ class ValidKmlTest(TestCase):
     #     self.failIfEqual("", response.content)
     #     # check response parses as XML (if not, exception causes failure)
     #     minidom.parseString(response.content)
+
+
+def makePhotos(numPhotos):
+    author, _created = User.objects.get_or_create(username='geocamLensTest')
+    for i in xrange(numPhotos):
+        Photo(name='photo%d' % i,
+              author=author,
+              latitude=37.4 + 0.001 * i,
+              longitude=-122.1,
+              timestamp=datetime.datetime(2010, 1, 1, 0, 0, i),
+              processed=True,
+              widthPixels=640,
+              heightPixels=480).save()
+
+
+class BatchSerializerTest(TestCase):
+    def makePhotos(self, numPhotos):
+        makePhotos(numPhotos)
+
+    def loadAll(self, features, batchSize=100):
+        result = []
+        for batch in iterFeatureBatches(features, batchSize):
+            for f in batch:
+                # the related objects the serializers walk
+                f.author.username
+                list(f.folders.all())
+                list(f.snapshot_set.all())
+                result.append(f)
+        return result
+
+    def countQueries(self, features):
+        with CaptureQueriesContext(connection) as queries:
+            self.loadAll(features)
+        return len(queries)
+
+    def serializeGeoJson(self):
+        request = RequestFactory().get('/geocamLens/features.json', {'n': 'all'})
+        return ''.join(viewSingleton.iterFeaturesGeoJson(request))
+
+    def serializeKml(self):
+        request = RequestFactory().get('/geocamLens/kml/feed.kml')
+        return ''.join(viewSingleton.kmlIterAllFeaturesFolder(request, ''))
+
+    def assertSerializerQueriesFixed(self, serialize):
+        self.makePhotos(1)
+        with CaptureQueriesContext(connection) as queries:
+            serialize()
+        self.makePhotos(49)
+        with self.assertNumQueries(len(queries)):
+            serialize()
+
+    def testResolvesConcreteModels(self):
+        self.makePhotos(5)
+        features = PointFeature.objects.filter(processed=True).order_by('pk')
+        loaded = self.loadAll(features, batchSize=2)
+        self.assertEqual([f.pk for f in loaded],
+                         list(features.values_list('pk', flat=True)))
+        for f in loaded:
+            self.assertTrue(isinstance(f, Photo))
+
+    def testQueryCountDoesNotGrowWithFeatures(self):
+        self.makePhotos(20)
+        features = PointFeature.objects.filter(processed=True).order_by('pk')
+        self.assertEqual(self.countQueries(features[:2]),
+                         self.countQueries(features))
+
+    @override_settings(GEOCAM_LENS_USE_FRAGMENTS=False)
+    def testGeoJsonQueryCountDoesNotGrow(self):
+        self.assertSerializerQueriesFixed(self.serializeGeoJson)
+
+    @override_settings(GEOCAM_LENS_USE_FRAGMENTS=False)
+    def testKmlQueryCountDoesNotGrow(self):
+        self.assertSerializerQueriesFixed(self.serializeKml)
+
+    @override_settings(GEOCAM_LENS_USE_FRAGMENTS=True)
+    def testGeoJsonFragmentQueryCountDoesNotGrow(self):
+        self.assertSerializerQueriesFixed(self.serializeGeoJson)
+
+    @override_settings(GEOCAM_LENS_USE_FRAGMENTS=True)
+    def testKmlFragmentQueryCountDoesNotGrow(self):
+        self.assertSerializerQueriesFixed(self.serializeKml)
+
+
+class FeatureProjectionTest(TestCase):
+    fields = 'name,uuid,timestamp,icon,author,notes,tags'
+    # properties Image can build from its own columns
+    imageFields = 'sizePixels,rotatedIcon,yaw,yawRef'
+
+    def getFeatures(self, params):
+        request = RequestFactory().get('/geocamLens/features.json', params)
+        features = json.loads(viewSingleton.getFeaturesGeoJson(request))['result']['features']
+        return sorted(features, key=lambda f: f['id'])
+
+    def getProjections(self, fields):
+        plain = self.getFeatures({'fields': fields, 'n': 'all'})
+        paged = self.getFeatures({'fields': fields, 'cursor': ''})
+        self.assertEqual(len(plain), 3)
+        self.assertEqual(plain, paged)
+        return plain
+
+    def assertProjectionsMatch(self, fields):
+        full = self.getFeatures({'n': 'all'})
+        for f in full:
+            f['properties'] = dict([(name, val)
+                                    for name, val in f['properties'].iteritems()
+                                    if name in fields.split(',')])
+        with override_settings(GEOCAM_LENS_USE_FRAGMENTS=True):
+            fromFragments = self.getProjections(fields)
+        with override_settings(GEOCAM_LENS_USE_FRAGMENTS=False):
+            fromModels = self.getProjections(fields)
+        self.assertEqual(fromFragments, full)
+        self.assertEqual(fromModels, full)
+
+    def testProjectionMatchesFullFeatures(self):
+        makePhotos(3)
+        self.assertProjectionsMatch(self.fields)
+
+    def testImageProjectionMatchesFullFeatures(self):
+        makePhotos(3)
+        self.assertProjectionsMatch(self.imageFields)
+
+    def testImageProjectionLoadsOnlyItsColumns(self):
+        params = {'fields': self.imageFields, 'n': 'all'}
+        makePhotos(1)
+        with CaptureQueriesContext(connection) as queries:
+            self.getFeatures(params)
+        makePhotos(49)
+        with self.assertNumQueries(len(queries)):
+            self.getFeatures(params)
+        for query in queries.captured_queries:
+            self.assertFalse('notes' in query['sql'], query['sql'])
+            self.assertFalse('auth_user' in query['sql'], query['sql'])
+
+
+@override_settings(GEOCAM_LENS_USE_FRAGMENTS=True)
+class FragmentRenderTest(TestCase):
+    def testPendingSaveDoesNotRender(self):
+        makePhotos(1)
+        photo = Photo.objects.get()
+        self.assertEqual(FeatureFragment.objects.filter(featureId=photo.pk).count(), 1)
+
+        # a reupload queued for processing drops the stale fragment
+        photo.status = STATUS_PENDING
+        photo.save()
+        self.assertEqual(FeatureFragment.objects.filter(featureId=photo.pk).count(), 0)
+
+        photo.status = STATUS_ACTIVE
+        photo.save()
+        self.assertEqual(FeatureFragment.objects.filter(featureId=photo.pk).count(), 1)
+
+
+class ParseRangeTest(TestCase):
+    def testIgnoredHeaders(self):
+        for header in (None, '', 'bytes=-', 'bytes=0-1,5-6', 'items=0-1', 'bytes=a-b'):
+            self.assertEqual(FileServe.parseRange(header, 100), None, header)
+
+    def testRanges(self):
+        self.assertEqual(FileServe.parseRange('bytes=0-0', 100), (0, 0))
+        self.assertEqual(FileServe.parseRange('bytes=10-19', 100), (10, 19))
+        # open-ended and past the end are clamped to the last byte
+        self.assertEqual(FileServe.parseRange('bytes=90-', 100), (90, 99))
+        self.assertEqual(FileServe.parseRange('bytes=90-1000', 100), (90, 99))
+        # suffix ranges
+        self.assertEqual(FileServe.parseRange('bytes=-10', 100), (90, 99))
+        self.assertEqual(FileServe.parseRange('bytes=-1000', 100), (0, 99))
+
+    def testUnsatisfiable(self):
+        for header in ('bytes=100-', 'bytes=20-10', 'bytes=-0'):
+            self.assertRaises(ValueError, FileServe.parseRange, header, 100)
+        self.assertRaises(ValueError, FileServe.parseRange, 'bytes=0-', 0)
+
+
+class CursorTest(TestCase):
+    def testRoundTrip(self):
+        for timestamp in (datetime.datetime(2010, 1, 1, 0, 0, 1, 2345), None):
+            cursor = SearchAbstract.encodeCursor(timestamp, 42)
+            self.assertEqual(SearchAbstract.decodeCursor(cursor), (timestamp, 42))
+
+    def testBadCursor(self):
+        for cursor in ('x', 'bm90IGpzb24=', SearchAbstract.encodeCursor(None, 'a')):
+            self.assertRaises(BadQuery, SearchAbstract.decodeCursor, cursor)
+
+    def getPages(self, pageSize):
+        ids = []
+        cursor = ''
+        while cursor is not None:
+            request = RequestFactory().get('/geocamLens/features.json',
+                                           {'cursor': cursor, 'n': pageSize})
+            result = json.loads(viewSingleton.getFeaturesGeoJson(request))['result']
+            ids += [f['id'] for f in result['features']]
+            cursor = result['next']
+        return ids
+
+    def testPagesCoverAllFeatures(self):
+        makePhotos(5)
+        request = RequestFactory().get('/geocamLens/features.json', {'n': 'all'})
+        allIds = [f['id'] for f in json.loads(viewSingleton.getFeaturesGeoJson(request))['result']['features']]
+        self.assertEqual(len(allIds), 5)
+        self.assertEqual(self.getPages(2), allIds)
+        self.assertEqual(self.getPages(5), allIds)
+
+    def testBadPageSize(self):
+        for pageSize in ('0', '-1'):
+            request = RequestFactory().get('/geocamLens/features.json',
+                                           {'cursor': '', 'n': pageSize})
+            self.assertEqual(viewSingleton.featuresJson(request).status_code, 400)
+
+
+class QuadKeyTest(TestCase):
+    def testTileRoundTrip(self):
+        for quadKey in ('', '0', '3', '0123', '3210' * 6):
+            x, y, level = SpatialIndex.quadKeyToTile(quadKey)
+            self.assertEqual(SpatialIndex.tileToQuadKey(x, y, level), quadKey)
+
+    def testQuadKeyRange(self):
+        low, high = SpatialIndex.getQuadKeyRange('12')
+        for quadKey in ('12', '120', '123', '12' + '3' * 22):
+            self.assertTrue(low <= quadKey < high, quadKey)
+        for quadKey in ('1', '11', '113', '13', '130', '2'):
+            self.assertFalse(low <= quadKey < high, quadKey)
+
+    def testPointInsideItsTile(self):
+        lat, lon = 37.4, -122.1
+        quadKey = SpatialIndex.getQuadKey(lat, lon)
+        self.assertEqual(len(quadKey), SpatialIndex.QUADKEY_MAX_LEVEL)
+        for level in (1, 5, 12):
+            west, south, east, north = SpatialIndex.getTileBounds(quadKey[:level])
+            self.assertTrue(west <= lon <= east and south <= lat <= north)
+
+    def assertCovered(self, bbox, keys, lat, lon):
+        quadKey = SpatialIndex.getQuadKey(lat, lon)
+        ranges = [SpatialIndex.getQuadKeyRange(k) for k in keys]
+        self.assertTrue([low for low, high in ranges if low <= quadKey < high],
+                        (bbox, lat, lon))
+
+    def testCoveringKeys(self):
+        bbox = (-122.2, 37.3, -122.0, 37.5)
+        keys = SpatialIndex.getCoveringKeys(bbox)
+        self.assertTrue(0 < len(keys) <= 16)
+        for lat, lon in ((37.3, -122.2), (37.5, -122.0), (37.4, -122.1)):
+            self.assertCovered(bbox, keys, lat, lon)
+
+    def testCoveringKeysAcrossAntimeridian(self):
+        bbox = (170.0, -10.0, -170.0, 10.0)
+        self.assertEqual(len(SpatialIndex.splitBbox(bbox)), 2)
+        keys = SpatialIndex.getCoveringKeys(bbox)
+        for lat, lon in ((0.0, 175.0), (0.0, -175.0)):
+            self.assertCovered(bbox, keys, lat, lon)
+
+
+class ColumnarFormatTest(TestCase):
+    def decode(self, chunks):
+        data = ''.join(chunks)
+        self.assertEqual(data[:4], ColumnarFormat.MAGIC)
+        count, headerLength = struct.unpack('<II', data[4:12])
+        header = json.loads(data[12:(12 + headerLength)])
+        self.assertEqual(header['count'], count)
+        dataStart = 12 + headerLength
+        self.assertEqual(dataStart % 8, 0)
+        formats = {'float64': 'd', 'uint32': 'I', 'uint16': 'H'}
+        columns = {}
+        for column in header['columns']:
+            self.assertEqual(column['offset'] % 8, 0)
+            start = dataStart + column['offset']
+            columns[column['name']] = struct.unpack('<%d%s' % (count, formats[column['type']]),
+                                                    data[start:(start + column['length'])])
+        return header, columns
+
+    def testRoundTrip(self):
+        rows = [(1, 37.4, -122.1, datetime.datetime(2010, 1, 1, 0, 0, 1, 500000), 'camera'),
+                (2, None, None, None, None),
+                (70000, -10.5, 20.25, datetime.datetime(1970, 1, 1), 'camera'),
+                (3, 0.0, 0.0, None, 'track')]
+        header, columns = self.decode(ColumnarFormat.encodeColumns(rows, {'since': '7'}))
+        self.assertEqual(header['extras'], {'since': '7'})
+        self.assertEqual(header['icons'], ['camera', 'track'])
+        self.assertEqual(columns['id'], (1, 2, 70000, 3))
+        self.assertEqual(columns['icon'], (0, ColumnarFormat.NULL_ICON, 0, 1))
+        self.assertEqual(columns['latitude'][0], 37.4)
+        self.assertEqual(columns['longitude'][2], 20.25)
+        self.assertEqual(columns['timestamp'][0], 1262304001500.0)
+        self.assertEqual(columns['timestamp'][2], 0.0)
+        for name in ('latitude', 'longitude', 'timestamp'):
+            self.assertTrue(math.isnan(columns[name][1]), name)
+        self.assertTrue(math.isnan(columns['timestamp'][3]))
+
+    def testEmpty(self):
+        header, columns = self.decode(ColumnarFormat.encodeColumns([]))
+        self.assertEqual(header['count'], 0)
+        self.assertEqual(header['extras'], {})
+        self.assertEqual(columns['id'], ())
+
+
+class CompressionTest(TestCase):
+    def testParseAcceptEncoding(self):
+        self.assertEqual(Compression.parseAcceptEncoding(''), {})
+        self.assertEqual(Compression.parseAcceptEncoding('gzip, deflate'),
+                         {'gzip': 1.0, 'deflate': 1.0})
+        self.assertEqual(Compression.parseAcceptEncoding('GZIP;q=0.5, br ; q=0, *;q=0.1'),
+                         {'gzip': 0.5, 'br': 0.0, '*': 0.1})
+        # a bad qvalue disables the coding rather than failing
+        self.assertEqual(Compression.parseAcceptEncoding('gzip;q=x,,identity'),
+                         {'gzip': 0.0, 'identity': 1.0})
+
+    @override_settings(GEOCAM_LENS_COMPRESS_RESPONSES=True)
+    def testResponseEncoding(self):
+        def getEncoding(header):
+            request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING=header)
+            return Compression.getResponseEncoding(request)
+        self.assertEqual(getEncoding(''), None)
+        self.assertEqual(getEncoding('gzip;q=0'), None)
+        self.assertEqual(getEncoding('deflate'), None)
+        self.assertEqual(getEncoding('gzip'), 'gzip')
+        self.assertEqual(getEncoding('*'), Compression.getSupportedEncodings()[0])
+        self.assertEqual(getEncoding('*, br;q=0'), 'gzip')
+
+    def testIterCompressed(self):
+        chunks = ['{"a":', u'"\u00e9"', '', '}' * 1000]
+        data = ''.join(Compression.iterCompressed(chunks, 'gzip'))
+        self.assertEqual(zlib.decompress(data, Compression.GZIP_WBITS),
+                         ''.join([c.encode('utf-8') for c in chunks]))
+
+
+class ZipStreamTest(TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def testReadableByZipfile(self):
+        thumbPath = os.path.join(self.tempDir, 'thumb.jpg')
+        thumbData = ''.join([chr(i % 256) for i in xrange(100000)])
+        f = open(thumbPath, 'wb')
+        f.write(thumbData)
+        f.close()
+        emptyPath = os.path.join(self.tempDir, 'empty')
+        open(emptyPath, 'wb').close()
+        docChunks = ['<kml>', u'<name>\u00e9</name>' * 1000, '', '</kml>']
+
+        stream = ZipStream()
+        data = ''.join(list(stream.iterEntry('doc.kml', docChunks))
+                       + list(stream.iterFile(u'files/thumb.jpg', thumbPath))
+                       + list(stream.iterFile('files/empty', emptyPath))
+                       + list(stream.iterFinish()))
+        self.assertEqual(stream.offset, len(data))
+
+        archive = zipfile.ZipFile(StringIO.StringIO(data))
+        self.assertEqual(archive.testzip(), None)
+        self.assertEqual(archive.namelist(), ['doc.kml', 'files/thumb.jpg', 'files/empty'])
+        self.assertEqual(archive.read('doc.kml'),
+                         ''.join([c.encode('utf-8') for c in docChunks]))
+        self.assertEqual(archive.getinfo('doc.kml').compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(archive.read('files/thumb.jpg'), thumbData)
+        self.assertEqual(archive.getinfo('files/thumb.jpg').compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(archive.read('files/empty'), '')
+
+
+class ThumbnailTest(TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.photo = Photo(widthPixels=1600, heightPixels=1200)
+        self.photo.getDir = lambda: self.tempDir
+        self.photo.getThumbnailPath = lambda width: os.path.join(self.tempDir, 'th%d.jpg' % width)
+        self.photo.thumbnailIsCurrent = lambda path, width: False
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def writeImage(self, name, mode='RGB', fmt='JPEG'):
+        path = os.path.join(self.tempDir, name)
+        PIL.Image.new(mode, (1600, 1200)).save(path, fmt)
+        return path
+
+    def testBuildsEverySize(self):
+        path = self.writeImage('full.jpg')
+        self.photo.makeThumbnails0(path, [(160, 120), (640, 480), (640, 480), (3200, 2400)])
+        for width, size in ((160, (160, 120)),
+                            (640, (640, 480)),
+                            # never enlarged
+                            (3200, (1600, 1200))):
+            self.assertEqual(PIL.Image.open(self.photo.getThumbnailPath(width)).size, size)
+
+    @override_settings(GEOCAM_LENS_THUMB_QUALITY='draft')
+    def testDraftDecodesAtReducedScale(self):
+        im = self.photo.prepThumbnailSource(PIL.Image.open(self.writeImage('full.jpg')), (200, 150))
+        # 1/8 scale is the smallest that still covers the thumbnail
+        self.assertEqual(im.size, (200, 150))
+
+    @override_settings(GEOCAM_LENS_THUMB_QUALITY='antialias')
+    def testAntialiasDecodesFullImage(self):
+        im = self.photo.prepThumbnailSource(PIL.Image.open(self.writeImage('full.jpg')), (200, 150))
+        self.assertEqual(im.size, (1600, 1200))
+
+    @override_settings(GEOCAM_LENS_THUMB_QUALITY='draft')
+    def testConvertsPaletteImages(self):
+        path = self.writeImage('full.png', mode='P', fmt='PNG')
+        im = self.photo.prepThumbnailSource(PIL.Image.open(path), (200, 150))
+        self.assertEqual(im.mode, 'RGB')
+        self.assertEqual(im.size, (1600, 1200))
+
+
+class StreamingGeoJsonTest(TestCase):
+    def getResult(self, pretty):
+        request = RequestFactory().get('/geocamLens/features.json', {'n': 'all'})
+        return json.loads(viewSingleton.getFeaturesGeoJson(request, pretty))
+
+    def testCompactMatchesPretty(self):
+        makePhotos(3)
+        for useFragments in (True, False):
+            with override_settings(GEOCAM_LENS_USE_FRAGMENTS=useFragments):
+                compact = self.getResult(False)
+                self.assertEqual(len(compact['result']['features']), 3)
+                self.assertEqual(compact, self.getResult(True))
+
+    def testEmpty(self):
+        self.assertEqual(self.getResult(False)['result']['features'], [])
+
+
+@override_settings(GEOCAM_LENS_FEATURE_CACHE='default', GEOCAM_LENS_COMPRESS_RESPONSES=False)
+class FeatureCacheTest(TestCase):
+    def getFeatures(self, params):
+        request = RequestFactory().get('/geocamLens/features.json', params)
+        response = viewSingleton.featuresJson(request)
+        content = ''.join(response.streaming_content)
+        return response['X-Feature-Cache'], json.loads(content)['result']['features']
+
+    def testSaveInvalidates(self):
+        makePhotos(2)
+        self.assertEqual(self.getFeatures({'n': 'all'})[0], 'miss')
+        status, features = self.getFeatures({'n': 'all'})
+        self.assertEqual((status, len(features)), ('hit', 2))
+        # extra whitespace in a search maps to the same entry
+        self.getFeatures({'n': 'all', 'q': 'photo0'})
+        self.assertEqual(self.getFeatures({'n': 'all', 'q': ' photo0 '})[0], 'hit')
+
+        makePhotos(1)
+        status, features = self.getFeatures({'n': 'all'})
+        self.assertEqual((status, len(features)), ('miss', 3))
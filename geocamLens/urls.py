@@ -21,23 +21,55 @@ urlpatterns = [
      {'challenge': 'basic',
       'readOnly': True},
      'geocamLens_kmlGetSessionResponse'),
+    url(r'^kml/([^/]+)/(initial)\.kmz$', views.kmzGetSessionResponse,
+     {'challenge': 'basic',
+      'readOnly': True},
+     'geocamLens_kmzGetSessionResponse'),
     url(r'^feed\.kml$', views.kmlFeed,
      {'readOnly': True},
      'geocamLens_kml'),
+    url(r'^feed\.kmz$', views.kmzFeed,
+     {'readOnly': True},
+     'geocamLens_kmz'),
+    url(r'^kml/tiles/t([0-3]*)\.kml$', views.kmlTile,
+     {'challenge': 'basic',
+      'readOnly': True},
+     'geocamLens_kmlTile'),
+    url(r'^kml/sessionStats.json', views.kmlSessionStats, {'readOnly': True}),
+    url(r'^kml/kmzStats.json', views.kmzStats, {'readOnly': True}),
 
     # features
     url(r'^features.json', views.featuresJson, {'readOnly': True}),
     url(r'^featuresJson.js', views.featuresJsonJs, {'readOnly': True}),
+    url(r'^clusters.json', views.clustersJson, {'readOnly': True}),
+    url(r'^featureCacheStats.json', views.featureCacheStats, {'readOnly': True}),
     url(r'^galleryDebug.html', views.galleryDebug, {'readOnly': True}),
 
     url(r'^photo/(?P<imgId>[^/]+)/(?:[^/]+)?$', views.viewPhoto,
      {'readOnly': True}),
+    url(r'^thumbnail/(?P<imgId>[^/]+)/(?P<width>\d+)\.jpg$', views.viewThumbnail,
+     {'readOnly': True},
+     'geocamLens_thumbnail'),
+    url(r'^thumbnailCacheStats.json', views.thumbnailCacheStats, {'readOnly': True}),
 
     url(r'^upload/$', views.uploadImageAuth),
     # alternate URL that accepts http basic authentication, used by newer versions of GeoCam Mobile
     url(r'^upload-m/$', views.uploadImageAuth,
      {'challenge': 'basic'}),
 
+    # many photos in one request
+    url(r'^upload-batch/$', views.uploadBatch,
+     {'challenge': 'basic'}),
+
+    # resumable upload: POST metadata to start a session, PUT chunks,
+    # GET the received offset, then POST to finalize
+    url(r'^upload-r/$', views.resumableUploadStart,
+     {'challenge': 'basic'}),
+    url(r'^upload-r/(?P<uuid>[0-9a-fA-F\-]+)/$', views.resumableUpload,
+     {'challenge': 'basic'}),
+    url(r'^upload-r/(?P<uuid>[0-9a-fA-F\-]+)/finalize/$', views.resumableUploadFinalize,
+     {'challenge': 'basic'}),
+
     url(r'^edit/photo/(?P<imgId>[^/]+)/$', views.editImageWrapper),
     url(r'^editWidget/photo/(?P<imgId>[^/]+)/$', views.editImage),
 